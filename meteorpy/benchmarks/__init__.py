@@ -0,0 +1,3 @@
+"""
+Benchmarks of the performance-critical parts of meteorpy
+"""
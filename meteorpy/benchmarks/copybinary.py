@@ -0,0 +1,67 @@
+'''
+Benchmark of the binary COPY ingestion path against the text protocol.
+
+Usage: python -m meteorpy.benchmarks.copybinary [--live SHOWER BEGIN END]
+
+Without arguments, the synthetic season of per-minute flux aggregates of
+the benchmark suite is decoded both ways. With --live, the FluxData query is
+run against the VMO database using both sql2recarray and copy2recarray.
+'''
+import sys
+import numpy as np
+
+from meteorpy import vmo, flux
+from meteorpy.benchmarks import synthetic, suite
+
+COLUMNS = flux.FluxData._columns
+
+
+def encode_binary_copy(data):
+    """ Produce the bytes PostgreSQL sends for COPY ... TO STDOUT WITH BINARY """
+    wire = [("nfields", ">i2")]
+    for k, (name, pgtype) in enumerate(COLUMNS):
+        wire += [("length%d" % k, ">i4"), (name, vmo._BINARY_TYPES[pgtype][0])]
+    wire = np.dtype(wire)
+    raw = np.empty(len(data), dtype=wire)
+    raw["nfields"] = len(COLUMNS)
+    for k, (name, pgtype) in enumerate(COLUMNS):
+        raw["length%d" % k] = wire[name].itemsize
+        if pgtype == "timestamp":
+            raw[name] = (data[name].astype("datetime64[s]").astype(np.int64) - vmo._PG_EPOCH_SECONDS) * 1000000
+        else:
+            raw[name] = data[name]
+    return vmo._BINARY_SIGNATURE + "\0"*8 + raw.tostring() + "\377\377"
+
+
+def run_synthetic(shower="PER", days=90):
+    begin, data = synthetic.season(shower, days)
+    copy = encode_binary_copy(data)
+    
+    t_text = suite.timeit(suite.bench_rows2recarray(shower, begin, days, data))
+    t_binary = suite.timeit(lambda: vmo.decode_binary_copy(copy, COLUMNS))
+    print "Synthetic, %d rows (%d days)" % (len(data), days)
+    print "  text rows -> recarray:  %.4f s" % t_text
+    print "  binary COPY decoding:   %.4f s  (x%.0f)" % (t_binary, t_text/t_binary)
+
+
+def run_live(shower, begin, end):
+    from meteorpy import common
+    fd = flux.FluxData(shower, common.iso2datetime(begin), common.iso2datetime(end))
+    sql = fd._sql()
+    with vmo.pool().connection() as conn:
+        if not conn.supports_binary_copy():
+            print "The database driver does not support binary COPY."
+            return
+        t_text = suite.timeit(lambda: conn.sql2recarray(sql))
+        t_binary = suite.timeit(lambda: conn.copy2recarray(sql, fd._columns))
+        rows = len(conn.copy2recarray(sql, fd._columns) or [])
+    print "Live, %s %s - %s, %d rows" % (shower, begin, end, rows)
+    print "  SELECT + sql2recarray:  %.3f s" % t_text
+    print "  COPY + copy2recarray:   %.3f s  (x%.1f)" % (t_binary, t_text/t_binary)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--live":
+        run_live(*sys.argv[2:])
+    else:
+        run_synthetic()
@@ -0,0 +1,195 @@
+'''
+Benchmark suite of the hot paths behind a flux page, on synthetic data.
+
+Usage: python -m meteorpy.benchmarks.suite [options]
+
+Times common.sollon, the adaptive and fixed binning of FluxData, the
+conversion of query results (vmo.rows2recarray) and FluxGraph.savePlot for
+synthetic seasons of 1 to 90 days. No database is needed. Every run is
+appended to a results file (JSON, one line per run) and compared with the
+baseline of the host, a run stored with --save-baseline (the first run on
+a host becomes its baseline), so that regressions stand out.
+
+Timings are the best of several repeats, each repeat looping a benchmark
+for at least MIN_SAMPLE seconds. A regression is a slowdown by more than
+THRESHOLD which is also longer than MIN_DELTA, since millisecond timings
+vary by more than THRESHOLD from noise alone.
+'''
+import os
+import sys
+import time
+import json
+import socket
+import datetime
+import subprocess
+import cStringIO
+import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
+
+from meteorpy import vmo, flux, common, binning
+from meteorpy.benchmarks import synthetic
+
+# Slowdown which is reported as a regression
+THRESHOLD = 1.2
+# Smallest slowdown (seconds) which is reported
+MIN_DELTA = 0.005
+# Fewest repeats per benchmark, and shortest duration of a repeat (seconds)
+MIN_REPEAT = 3
+MIN_SAMPLE = 0.05
+
+
+def _fluxdata(shower, begin, days, data, **keywords):
+    """ FluxData working on synthetic aggregates instead of the database """
+    fd = flux.FluxData(shower, begin, begin + datetime.timedelta(days=days), popindex=2.0, **keywords)
+    fd._data = data
+    return fd
+
+def bench_sollon(shower, begin, days, data):
+    return lambda: common.sollon(data['time'])
+
+def bench_adaptive(shower, begin, days, data):
+    return lambda: _fluxdata(shower, begin, days, data, min_meteors=20, min_eca=100, \
+                             min_interval=1.0, max_interval=24.0).getBins()
+
+def bench_fixed(shower, begin, days, data):
+    return lambda: _fluxdata(shower, begin, days, data, bin_mode="fixed", min_meteors=20, \
+                             min_eca=0, min_interval=1.0).getBins()
+
+def bench_rows2recarray(shower, begin, days, data):
+    # What the database driver returns for the flux query: a tuple per row
+    rows = zip([str(t).replace("T", " ") for t in data['time']], data['teff'].tolist(), \
+               data['eca'].tolist(), data['met'].tolist(), data['stations'].tolist())
+    names = [name for name, dtype in synthetic.AGGREGATE_DTYPE]
+    return lambda: vmo.rows2recarray(rows, names)
+
+def bench_saveplot(shower, begin, days, data):
+    fd = _fluxdata(shower, begin, days, data, min_meteors=20, min_eca=100, \
+                   min_interval=1.0, max_interval=24.0)
+    def run():
+        graph = flux.FluxGraph(shower, str(begin), str(begin + datetime.timedelta(days=days)), popindex=2.0)
+        graph._fluxdata = fd
+        graph.savePlot(cStringIO.StringIO(), dpi=80, format="png")
+        graph.close()
+    return run
+
+BENCHMARKS = [("sollon", bench_sollon), \
+              ("bin_adaptive", bench_adaptive), \
+              ("bin_fixed", bench_fixed), \
+              ("rows2recarray", bench_rows2recarray), \
+              ("saveplot", bench_saveplot)]
+
+
+def timeit(function, repeat=MIN_REPEAT):
+    """
+    Best time of one call (seconds) over at least MIN_REPEAT repeats, where
+    short functions are called as often as needed to last MIN_SAMPLE seconds
+    """
+    t0 = time.time()
+    function()
+    loops = max(1, int(MIN_SAMPLE / max(time.time()-t0, 1e-6)))
+    best = None
+    for i in range(max(repeat, MIN_REPEAT)):
+        t0 = time.time()
+        for k in xrange(loops):
+            function()
+        t = (time.time()-t0) / loops
+        best = t if best == None else min(best, t)
+    return best
+
+
+def run(shower="PER", days=(1, 10, 90), repeat=MIN_REPEAT, only=None):
+    """ Dict of benchmark name -> best time in seconds, e.g. "bin_adaptive/90d" """
+    results = {}
+    for d in days:
+        begin, data = synthetic.season(shower, d)
+        for name, bench in BENCHMARKS:
+            if only != None and name not in only:
+                continue
+            key = "%s/%dd" % (name, d)
+            results[key] = timeit(bench(shower, begin, d, data), repeat)
+            print "%-22s %8d rows %9.4f s" % (key, len(data), results[key])
+    return results
+
+
+def _revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], \
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline(filename, host):
+    """ Baseline run of host in the baselines file (JSON, host -> run), or None """
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f).get(host)
+
+
+def saveBaseline(filename, host, entry):
+    """ Make entry the baseline of host """
+    baselines = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            baselines = json.load(f)
+    baselines[host] = entry
+    with open(filename, "w") as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+
+
+def compare(results, base):
+    """ Print the change with respect to the baseline, returns the regressions """
+    regressions = []
+    for key in sorted(results):
+        if key not in base["results"]:
+            continue
+        before = base["results"][key]
+        ratio = results[key] / max(before, 1e-9)
+        flag = ""
+        if ratio > THRESHOLD and results[key] - before > MIN_DELTA:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print "%-22s %9.4f s -> %9.4f s  (x%.2f)%s" % (key, before, results[key], ratio, flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--shower", dest="shower", default="PER", type="string", \
+                      metavar="SHOWER", help="activity profile, one of %s" % ", ".join(sorted(synthetic.SHOWERS)))
+    parser.add_option("-d", "--days", dest="days", default="1,10,90", type="string", \
+                      metavar="DAYS", help="lengths of the seasons, default = 1,10,90")
+    parser.add_option("-n", "--repeat", dest="repeat", default=str(MIN_REPEAT), type="int", \
+                      metavar="N", help="runs per benchmark (best is kept), at least %d" % MIN_REPEAT)
+    parser.add_option("-b", "--only", dest="only", default=None, type="string", \
+                      metavar="NAMES", help="benchmarks to run, separated by commas")
+    parser.add_option("-r", "--results", dest="results", default="benchmarks.jsonl", type="string", \
+                      metavar="FILE", help="file to keep the results in, default = benchmarks.jsonl")
+    parser.add_option("-B", "--baseline", dest="baseline", default="benchmarks_baseline.json", type="string", \
+                      metavar="FILE", help="file with the baseline per host, default = benchmarks_baseline.json")
+    parser.add_option("", "--save-baseline", dest="save_baseline", action="store_true", default=False, \
+                      help="make this run the baseline of the host")
+    (opts, args) = parser.parse_args()
+
+    only = opts.only.split(",") if opts.only else None
+    results = run(opts.shower, [int(d) for d in opts.days.split(",")], opts.repeat, only)
+
+    host = socket.gethostname()
+    entry = {"date": datetime.datetime.utcnow().isoformat(), "host": host, \
+             "revision": _revision(), "numpy": np.__version__, \
+             "matplotlib": mpl.__version__, "shower": opts.shower, \
+             "results": results}
+    base = baseline(opts.baseline, host)
+    regressions = []
+    if base != None:
+        print "\nCompared with the baseline of %s (%s):" % (base["date"], base["revision"])
+        regressions = compare(results, base)
+    if base == None or opts.save_baseline:
+        saveBaseline(opts.baseline, host, entry)
+        print "\nStored as the baseline of %s in %s" % (host, opts.baseline)
+    with open(opts.results, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    sys.exit(1 if len(regressions) > 0 else 0)
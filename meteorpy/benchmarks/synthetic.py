@@ -0,0 +1,110 @@
+'''
+Synthetic metrecflux data, for benchmarks and offline tests.
+
+Raw rows mimic the metrecflux table: one row per station and minute, with
+the effective observing time, collecting area, radiant altitude and meteor
+count. Every station observes during its local night, loses nights to the
+weather and has short gaps within a night. The meteor counts follow the
+activity profile of a real shower (double exponential in solar longitude)
+on top of a constant sporadic background.
+'''
+import datetime
+import numpy as np
+
+from meteorpy import common
+
+# Activity profiles: (solar longitude of the peak, ZHR at the peak, slope B before and after the peak)
+# Jenniskens (1994): ZHR = ZHRmax * 10^(-B*|sollon-sollon_max|)
+SHOWERS = {"PER": (140.0, 100.0, 0.20, 0.40), \
+           "GEM": (262.2, 120.0, 0.39, 0.81), \
+           "QUA": (283.15, 120.0, 2.5, 2.5)}
+
+# Columns of the metrecflux table used by FluxData
+RAW_DTYPE = [('time', 'datetime64[s]'), ('station', 'S8'), ('shower', 'S3'), \
+             ('teff', 'f8'), ('eca', 'f8'), ('alt', 'f8'), ('met', 'i8')]
+
+# Result of the GROUP BY time query of FluxData
+AGGREGATE_DTYPE = [('time', 'datetime64[s]'), ('teff', 'f8'), ('eca', 'f8'), \
+                   ('met', 'i8'), ('stations', 'i8')]
+
+
+def zhr(shower, sollon):
+    """ ZHR of the shower at the given solar longitudes """
+    peak, zhrmax, b_before, b_after = SHOWERS[shower]
+    d = (np.asarray(sollon) - peak + 180.0) % 360.0 - 180.0
+    return zhrmax * 10**(-np.where(d < 0, b_before, b_after)*np.abs(d))
+
+
+def zhr2flux(zhr, pop_index=2.0):
+    """ Inverse of FluxGraph.flux2zhr: meteoroids / 1000 km^2 h """
+    r = pop_index
+    return 1000.0 * zhr * ((13.1*r - 16.45) * (r - 1.3)**0.748) / 37200.0
+
+
+def raw(shower, begin, days, stations=20, seed=0):
+    """
+    Per-station, per-minute rows for days after begin (Python datetime),
+    as a structured array with RAW_DTYPE sorted by time.
+    """
+    rng = np.random.RandomState(seed)
+    peak_lon = SHOWERS[shower][0]
+    minutes = np.arange(days*1440)
+    times = np.datetime64(begin, 's') + (minutes*60).astype('timedelta64[s]')
+    flux = zhr2flux(zhr(shower, common.sollon(times)))
+
+    parts = []
+    for k in range(stations):
+        # Local night: start of the night (UT hour) and its length
+        start = rng.uniform(16, 24)
+        length = rng.uniform(5, 10)
+        hours = (minutes/60.0 - start) % 24.0
+        observing = hours < length
+        # Cloudy nights and short gaps (planes, clouds, dawn)
+        night = ((minutes/60.0 - start) // 24.0).astype(int)
+        clear = rng.uniform(size=night.max()+2) < 0.7
+        observing &= clear[night - night.min()]
+        observing &= rng.uniform(size=len(minutes)) > 0.03
+
+        idx = np.flatnonzero(observing)
+        # Radiant rises during the night
+        alt = 10.0 + 60.0*hours[idx]/length + rng.normal(0, 1, len(idx))
+        area = rng.uniform(500, 5000) # km^2
+        teff = np.ones(len(idx))
+        eca = area/60.0 * teff * rng.uniform(0.8, 1.0, len(idx)) # km^2 h
+        expected = flux[idx] * eca/1000.0 * np.sin(np.radians(alt))
+        part = np.zeros(len(idx), dtype=RAW_DTYPE)
+        part['time'] = times[idx]
+        part['station'] = "ST%03d" % k
+        part['shower'] = shower
+        part['teff'], part['eca'], part['alt'] = teff, eca, alt
+        part['met'] = rng.poisson(expected)
+        parts.append(part)
+
+    result = np.concatenate(parts)
+    return result[np.argsort(result['time'], kind='mergesort')]
+
+
+def aggregate(rows, gamma=1.0, delta=0.0, min_alt=0.01):
+    """
+    Same as the GROUP BY time query of FluxData on raw rows: per-minute sums
+    with the zenith-corrected ECA, as a structured array with AGGREGATE_DTYPE.
+    """
+    rows = rows[(rows['alt'] >= min_alt) & (rows['eca'] > 0.5)]
+    times, inverse = np.unique(rows['time'], return_inverse=True)
+    sinalt = np.sin(np.radians(rows['alt']))
+    eca = rows['eca'] * (delta + (1-delta) * sinalt**gamma / sinalt)
+    result = np.zeros(len(times), dtype=AGGREGATE_DTYPE)
+    result['time'] = times
+    result['teff'] = np.bincount(inverse, weights=rows['teff'])
+    result['eca'] = np.bincount(inverse, weights=eca)
+    result['met'] = np.bincount(inverse, weights=rows['met']).astype(np.int64)
+    result['stations'] = np.bincount(inverse)
+    return result
+
+
+def season(shower, days, stations=20, seed=0):
+    """ Per-minute aggregates of days centred on the peak of the shower """
+    year = 2011
+    peak = common.sollon2datetime(SHOWERS[shower][0], year)
+    begin = datetime.datetime(peak.year, peak.month, peak.day) - datetime.timedelta(days=days//2)
+    return begin, aggregate(raw(shower, begin, days, stations, seed))
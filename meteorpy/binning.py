@@ -0,0 +1,314 @@
+'''
+Binning algorithms behind the meteoroid flux profiles.
+
+The functions in this module work on plain NumPy columns (time, teff, eca, met)
+rather than on rows, so that a season of per-minute data can be binned without
+looping over every single record in Python.
+'''
+import datetime
+import calendar
+import numpy as np
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def epoch_seconds(times):
+    """
+    Convert timestamps to integer seconds since 1970-01-01 00:00:00 UT.
+
+    @times: datetime object, or array of ISO strings, datetime objects or datetime64 values
+    """
+    if isinstance(times, datetime.datetime):
+        return calendar.timegm(times.timetuple())
+    return np.asarray(times).astype("datetime64[s]").astype(np.int64)
+
+
+def _seconds_threshold(hours):
+    """
+    Smallest whole number of seconds d for which round(d/3600.0, 6) >= hours,
+    i.e. the test applied by the original row-by-row binning algorithm.
+    Returns None if no realistic time difference can satisfy the test.
+    """
+    if hours > 1e9:
+        return None
+
+    def passes(d):
+        return round(d/3600.0, 6) >= hours
+
+    d = int(np.ceil(hours*3600.0))
+    while passes(d-1):
+        d -= 1
+    while not passes(d):
+        d += 1
+    return d
+
+
+def _search(values, target):
+    """ searchsorted() which tolerates targets beyond the int64 range """
+    if target is None or target > values[-1]:
+        return len(values)
+    return int(np.searchsorted(values, target, side="left"))
+
+
+class AdaptiveBinner(object):
+    """
+    Adaptive binning: a bin is closed as soon as it contains at least
+    min_meteors meteors or min_eca*1000 km^2 h of collecting area, or spans
+    max_interval hours, but never before it spans min_interval hours.
+
+    This is a vectorized version of the original row-by-row algorithm and
+    produces identical bins. Instead of visiting every row, the row which
+    closes a bin is found by bisection of the cumulative sums, hence the
+    number of Python iterations equals the number of bins.
+
+    Data can be added in consecutive chunks (sorted by time); only the rows
+    of the bin which is still open are kept in memory between chunks.
+
+    With trace=True the decision behind every bin is recorded, see trace().
+    """
+
+    def __init__(self, begin, min_meteors, min_eca, min_interval, max_interval, trace=False):
+        """
+        @begin: Python datetime object, nominal start of the first bin
+        @trace: record why every bin was closed
+        """
+        self._begin = begin
+        self._min_meteors = min_meteors
+        self._min_eca = min_eca*1000.0
+        # Interval tests expressed in whole seconds since the start of the bin
+        self._d_min = _seconds_threshold(round(min_interval, 6))
+        self._d_max = _seconds_threshold(round(max_interval, 6))
+        self._d_restart = _seconds_threshold(max_interval)
+        self._step = int(round(max_interval*60))*60
+
+        self.rows = 0
+        self._start = None
+        self._check = 0
+        self._open = None
+        self._bins = [], [], [], []
+        self._trace = [] if trace else None
+
+    def add(self, time, teff, eca, met):
+        """ Add the next chunk of rows (sorted in ascending order of time) """
+        t = epoch_seconds(time)
+        if len(t) == 0:
+            return
+        self.rows += len(t)
+        teff, eca, met = np.asarray(teff), np.asarray(eca), np.asarray(met)
+
+        if self._start is None:
+            # Make sure the first bin starts near the actual data
+            self._start = epoch_seconds(self._begin)
+            step = self._step
+            if step > 0 and self._start + step < t[0]:
+                self._start += ((int(t[0]) - self._start - 1) // step) * step
+        else:
+            # Prepend the rows of the bin which is still open
+            t, teff, eca, met = [np.concatenate((old, new)) for old, new in zip(self._open, (t, teff, eca, met))]
+        n = len(t)
+
+        # Cumulative sums with a leading zero: sum(x[i:j]) == cx[j] - cx[i]
+        cmet = np.concatenate(([0], np.cumsum(met)))
+        ceca = np.concatenate(([0.0], np.cumsum(eca)))
+        ctime = np.concatenate(([0], np.cumsum(t)))
+
+        edges, starts = [], []
+        start, first, check = self._start, 0, self._check
+        while True:
+            # First row at which the bin may be closed, and the first row at
+            # which the meteors, ECA or duration of the bin have been reached
+            j_min = _search(t, start + self._d_min)
+            j_met = _search(cmet, cmet[first] + self._min_meteors)
+            j_eca = _search(ceca, ceca[first] + self._min_eca)
+            j_max = n if self._d_max is None else _search(t, start + self._d_max)
+            j = max(check, j_min, min(j_met, j_eca, j_max))
+            if j >= n:
+                break
+
+            if j > first:
+                edges.append( (first, j) )
+                starts.append( start )
+                if self._trace is not None:
+                    reason = "meteors" if j >= j_met else "eca" if j >= j_eca else "max_interval"
+                    self._trace.append( (start, int(t[j]), j-first, cmet[j]-cmet[first], \
+                                         ceca[j]-ceca[first], reason) )
+
+            # Start counting the duration of the next bin from the end of the last
+            deltaseconds = int(t[j]) - start
+            if self._d_restart is not None and deltaseconds >= self._d_restart:
+                # Previous bin was cut off because of max_interval
+                if self._step > 0:
+                    start += (deltaseconds // self._step) * self._step
+            elif j > first:
+                # Otherwise start from true end of previous bin
+                start += int(round((int(t[j-1]) - start)/60.))*60
+
+            first, check = j, j+1
+
+        for old, new in zip(self._bins, _collect(edges, starts, ctime, teff, eca, met)):
+            old.extend(new)
+        self._start, self._check = start, n - first
+        self._open = t[first:], teff[first:], eca[first:], met[first:]
+
+    def result(self):
+        """
+        Tuple of arrays (time, teff, eca, met) with one element per bin, where
+        time is the mean time of the rows in the bin (Python datetime objects)
+        """
+        bins = [list(b) for b in self._bins]
+        # Final bin
+        if self._final():
+            t, teff, eca, met = self._open
+            ctime = np.concatenate(([0], np.cumsum(t)))
+            for old, new in zip(bins, _collect([(0, len(t))], [self._start], ctime, teff, eca, met)):
+                old.extend(new)
+        return tuple(np.array(b) for b in bins)
+
+    def _final(self):
+        """ Is the bin which is still open kept at the end of the data? """
+        return self._open is not None and len(self._open[0]) > 0 and self._open[3].sum() > 5
+
+    def trace(self):
+        """
+        Structured array with one record per bin (only if trace=True):
+        start -- nominal start of the bin
+        end -- time of the row which closed the bin (the last row for the final bin)
+        rows, met, eca -- number of rows, meteors and collecting area in the bin
+        reason -- why the bin was closed: "meteors", "eca", "max_interval" or "end"
+        """
+        if self._trace is None:
+            raise ValueError("Binning trace is not enabled.")
+        records = list(self._trace)
+        if self._final():
+            t, teff, eca, met = self._open
+            records.append( (self._start, int(t[-1]), len(t), met.sum(), eca.sum(), "end") )
+        if len(records) == 0:
+            return np.zeros(0, dtype=TRACE_DTYPE)
+        return np.array(records, dtype=TRACE_DTYPE)
+
+
+# Records of AdaptiveBinner.trace()
+TRACE_DTYPE = [('start', 'datetime64[s]'), ('end', 'datetime64[s]'), ('rows', 'i8'), \
+               ('met', 'i8'), ('eca', 'f8'), ('reason', 'S12')]
+
+
+def adaptive(time, teff, eca, met, begin, min_meteors, min_eca, min_interval, max_interval):
+    """
+    Adaptive binning of complete columns, see AdaptiveBinner.
+
+    Input:
+    time -- timestamps, sorted in ascending order
+    teff, eca, met -- effective observing time, collecting area and meteor count per row
+    begin -- Python datetime object, nominal start of the first bin
+    min_meteors, min_eca, min_interval, max_interval -- binning parameters
+    """
+    binner = AdaptiveBinner(begin, min_meteors, min_eca, min_interval, max_interval)
+    binner.add(time, teff, eca, met)
+    return binner.result()
+
+
+def _collect(edges, starts, ctime, teff, eca, met):
+    """ Sum the columns over the bins given as (first, last+1) row indices """
+    if len(edges) == 0:
+        return [], [], [], []
+
+    edges = np.array(edges)
+    bins_time = []
+    for (i, j), start in zip(edges, starts):
+        # Mean offset of the rows with respect to the start of the bin
+        offset = (int(ctime[j] - ctime[i]) - (j-i)*start) / float(j-i)
+        bins_time.append( _EPOCH + datetime.timedelta(seconds=start) + datetime.timedelta(seconds=offset) )
+
+    # Bins are contiguous, except for rows which did not end up in any bin
+    bounds = np.unique(edges)
+    if bounds[-1] == len(teff):
+        bounds = bounds[:-1]
+    index = np.searchsorted(bounds, edges[:,0])
+    return bins_time, \
+           np.add.reduceat(teff, bounds)[index], \
+           np.add.reduceat(eca, bounds)[index], \
+           np.add.reduceat(met, bounds)[index]
+
+
+class FixedBinner(object):
+    """
+    Fixed-width binning: rows are grouped in consecutive bins of bin_length
+    hours, counted from begin. Gaps in the data of any length are allowed.
+    Bins with fewer than min_meteors meteors or less than min_eca*1000 km^2 h
+    of collecting area are dropped.
+
+    Data can be added in chunks; only the sums per bin are kept in memory.
+    """
+
+    def __init__(self, begin, bin_length, min_meteors, min_eca):
+        length = datetime.timedelta(bin_length/24.)
+        self._length = (length.days*86400 + length.seconds)*1000000 + length.microseconds
+        if self._length <= 0:
+            raise ValueError("Fixed binning requires a positive bin length.")
+        self._begin = epoch_seconds(begin)*1000000 + begin.microsecond
+        self._min_meteors = min_meteors
+        self._min_eca = min_eca*1000.0
+        self.rows = 0
+        self._sums = []
+
+    def add(self, time, teff, eca, met):
+        """ Add the next chunk of rows """
+        number = self.number(time)
+        if len(number) == 0:
+            return
+        self.rows += len(number)
+        self._sums.append( self._reduce(number, teff, eca, np.asarray(met)) )
+        # Keep the number of partial sums small
+        if len(self._sums) > 1:
+            self._sums = [self._reduce(*[np.concatenate(c) for c in zip(*self._sums)])]
+
+    def number(self, time):
+        """ Number of the bin of every row, counted from begin """
+        return (epoch_seconds(time)*1000000 - self._begin) // self._length
+
+    def index(self, time):
+        """ Index of the bin of every row in the arrays of result(), or -1 if its bin is dropped """
+        number = self.number(time)
+        kept = self._kept()[0]
+        if len(kept) == 0:
+            return np.repeat(-1, len(number))
+        index = np.minimum(np.searchsorted(kept, number), len(kept)-1)
+        index[kept[index] != number] = -1
+        return index
+
+    def _kept(self):
+        """ Sums (number, teff, eca, met) of the bins which are not dropped """
+        if len(self._sums) == 0:
+            return np.array([], dtype=np.int64), np.array([]), np.array([]), np.array([])
+        number, teff, eca, met = self._sums[0]
+        keep = (met >= self._min_meteors) & (eca >= self._min_eca) & (eca > 0)
+        return number[keep], teff[keep], eca[keep], met[keep]
+
+    @staticmethod
+    def _reduce(number, teff, eca, met):
+        """ Sum the columns per bin number """
+        number, inverse = np.unique(number, return_inverse=True)
+        return number, \
+               np.bincount(inverse, weights=teff), \
+               np.bincount(inverse, weights=eca), \
+               np.rint(np.bincount(inverse, weights=met)).astype(met.dtype)
+
+    def result(self):
+        """
+        Tuple of arrays (time, teff, eca, met) with one element per bin, where
+        time is the middle of the bin (Python datetime objects)
+        """
+        if len(self._sums) == 0:
+            return np.array([]), np.array([]), np.array([]), np.array([])
+        number, teff, eca, met = self._kept()
+        middle = self._begin + number*self._length + self._length//2
+        return middle.astype("datetime64[us]").astype(datetime.datetime), teff, eca, met
+
+
+def fixed(time, teff, eca, met, begin, bin_length, min_meteors, min_eca):
+    """
+    Fixed-width binning of complete columns, see FixedBinner.
+    """
+    binner = FixedBinner(begin, bin_length, min_meteors, min_eca)
+    binner.add(time, teff, eca, met)
+    return binner.result()
@@ -0,0 +1,324 @@
+'''
+Local on-disk caches of the per-minute flux aggregates and of rendered graphs.
+
+The GROUP BY time query behind FluxData only depends on the shower, the
+zenith correction (gamma, delta, min_alt) and the stations. Its result is
+kept in one .npy file per shower and UT day, so that requests which only
+change the binning parameters never reach the database.
+
+Rendered graphs are named after a hash of all parameters which determine
+their content, so that identical requests reuse the same files. Graphs
+which may never be looked at can be deferred: a spec is stored instead, as
+JSON and numeric arrays in the private cache directory, and the graph is
+only rendered when it is first requested.
+'''
+import os
+import re
+import time
+import json
+import hashlib
+import datetime
+import tempfile
+import numpy as np
+
+import vmo
+
+
+def _option(name, default):
+    """ Optional setting in the [Cache] section of vmo.ini """
+    if vmo.config().has_option("Cache", name):
+        return type(default)(vmo.config().get("Cache", name))
+    return default
+
+
+def _publish(path, write, mode=None):
+    """
+    Create a file atomically, safe against concurrent readers and writers:
+    write(fileobj) fills a temporary file which is then renamed to path.
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass # Dir already exists
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        if mode != None:
+            os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def _write(path, array):
+    """ Save an array atomically """
+    _publish(path, lambda f: np.save(f, array))
+
+
+def revision(end):
+    """
+    Tag for data which may still change: for intervals ending less than
+    fresh_days ago, the current hour, otherwise None.
+    """
+    now = datetime.datetime.utcnow()
+    if end >= now - datetime.timedelta(days=_option("fresh_days", 2)):
+        return now.strftime("%Y%m%d%H")
+    return None
+
+
+def evict(directory, max_bytes, max_age=None, pattern=None, min_age=0):
+    """
+    Delete the least recently used files below directory until the total size
+    is below max_bytes, as well as files unused for more than max_age seconds.
+    Only files whose name matches pattern (a compiled regex) are considered,
+    and files used less than min_age seconds ago are kept in any case.
+    """
+    files, total = [], 0
+    now = time.time()
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            if pattern != None and not pattern.match(name):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # Removed by another process meanwhile
+            if name.endswith(".tmp") and now-st.st_mtime < 3600:
+                continue # Still being written by another process
+            total += st.st_size
+            if now-st.st_mtime < min_age:
+                continue
+            files.append( (st.st_mtime, st.st_size, path) )
+    files.sort()
+
+    for mtime, size, path in files:
+        if total <= max_bytes and (max_age == None or now-mtime <= max_age):
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _days(chunks, first, last):
+    """
+    Split a stream of chunks (sorted by time, between the UT days first and
+    last) into one array per day: generator of (day, rows), days without rows included
+    """
+    day, parts, dtype = first, [], [('time', 'datetime64[s]')]
+    for chunk in chunks:
+        if chunk is None or len(chunk) == 0:
+            continue
+        dtype = chunk.dtype
+        dates = chunk['time'].astype('datetime64[D]')
+        while True:
+            k = np.searchsorted(dates, day, side="right")
+            parts.append(chunk[:k])
+            chunk, dates = chunk[k:], dates[k:]
+            if len(chunk) == 0:
+                break
+            yield day, np.concatenate(parts)
+            day, parts = day+1, []
+    while day <= last:
+        yield day, np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=dtype)
+        day, parts = day+1, []
+
+
+class AggregateCache(object):
+    '''
+    One memory-mapped .npy file per (database, shower, parameters, day), evicted
+    in least-recently-used order once the cache grows beyond max_bytes.
+    Days which are less than fresh_days old are never cached, because
+    observers are still uploading their data.
+    '''
+
+    def __init__(self, directory=None, max_bytes=None, fresh_days=None, fetch_days=None):
+        '''
+        @directory: default = directory in the [Cache] section of vmo.ini, or a temporary dir
+        @max_bytes: default = max_size in MB in vmo.ini, or 500 MB
+        @fresh_days: default = fresh_days in vmo.ini, or 2
+        @fetch_days: longest run of missing days fetched by one query, default = fetch_days in vmo.ini, or 31
+        '''
+        if directory == None:
+            directory = _option("directory", os.path.join(tempfile.gettempdir(), "meteorpy_cache"))
+        self._directory = os.path.join(directory, "aggregates")
+        self._max_bytes = max_bytes if max_bytes != None else _option("max_size", 500.0)*1024*1024
+        self._fresh_days = fresh_days if fresh_days != None else _option("fresh_days", 2)
+        self._fetch_days = fetch_days if fetch_days != None else _option("fetch_days", 31)
+
+
+    def _path(self, key, day):
+        """ key: tuple (shower, gamma, delta, min_alt, stations) """
+        # Aggregates of another database (e.g. a local snapshot) are never served
+        digest = hashlib.sha1(repr((vmo.identity(),) + tuple(key))).hexdigest()[:16]
+        return os.path.join(self._directory, "%s_%s" % (key[0], digest), "%s.npy" % day)
+
+    def _read(self, path):
+        try:
+            data = np.load(path, mmap_mode="r")
+        except (IOError, ValueError):
+            return None # Not cached (or being replaced)
+        try:
+            os.utime(path, None) # Mark as recently used
+        except OSError:
+            pass
+        return data
+
+
+    def chunks(self, key, begin, end, fetch):
+        """
+        Generator yielding the aggregates between begin and end (inclusive),
+        one array per UT day, each as soon as it is available. Days which are
+        not cached are streamed from fetch(begin, end), once per run of
+        consecutive missing days (at most fetch_days long), so that only the
+        day being collected is held in memory. Days which are only partly requested are fetched
+        for the requested part and never cached.
+
+        @fetch: function returning the aggregates in [begin, end] as an
+                iterable of structured arrays with a 'time' column, sorted by time
+        """
+        lower = np.datetime64(begin, 's')
+        upper = np.datetime64(end, 's')
+        days = np.arange(lower.astype('datetime64[D]'), upper.astype('datetime64[D]')+1)
+        fresh = np.datetime64(datetime.datetime.utcnow().date(), 'D') - self._fresh_days
+        second = np.timedelta64(1, 's')
+
+        def complete(day):
+            return day >= lower and day+1 - second <= upper
+
+        stored = False
+        i = 0
+        while i < len(days):
+            data = self._read(self._path(key, days[i])) if complete(days[i]) else None
+            if data is not None:
+                if len(data) > 0:
+                    yield data
+                i += 1
+                continue
+
+            # Run of consecutive days which are not cached
+            last = i
+            while last+1 < len(days) and last+1-i < self._fetch_days and not (complete(days[last+1]) and \
+                                              os.path.exists(self._path(key, days[last+1]))):
+                last += 1
+            start = max(lower, days[i].astype('datetime64[s]'))
+            stop = min(upper, (days[last]+1) - second)
+            for day, data in _days(fetch(start.astype(datetime.datetime), stop.astype(datetime.datetime)), \
+                                   days[i], days[last]):
+                if complete(day) and day < fresh:
+                    _write(self._path(key, day), data)
+                    stored = True
+                if len(data) > 0:
+                    yield data
+            i = last+1
+
+        if stored:
+            evict(self._directory, self._max_bytes)
+
+    def load(self, key, begin, end, fetch):
+        """ Same as chunks(), but as a single array (None if there is no data) """
+        data = list(self.chunks(key, begin, end, fetch))
+        if len(data) == 0:
+            return None
+        return np.concatenate(data)
+
+    def clear(self):
+        evict(self._directory, 0)
+
+
+class RenderCache(object):
+    '''
+    Rendered graphs in a published directory, one file per hash of the
+    parameters (key), evicted in least-recently-used order once they grow
+    beyond max_bytes or are unused for max_days. Other files in the
+    directory are left alone, and graphs used less than min_minutes ago
+    are kept, since a page which links them may not have been loaded yet.
+    '''
+
+    # Names of the files created by name()
+    _pattern = re.compile(r"^[0-9a-f]{20}\.\w+$")
+
+    def __init__(self, directory, max_bytes=None, max_days=None, min_minutes=None, spec_directory=None):
+        '''
+        @max_bytes: default = render_max_size in MB in vmo.ini, or 200 MB
+        @max_days: default = render_max_days in vmo.ini, or 7
+        @min_minutes: default = render_min_minutes in vmo.ini, or 10
+        @spec_directory: where deferred graphs are recorded, must not be published,
+                         default = specs in the directory of the [Cache] section of vmo.ini
+        '''
+        self._directory = directory
+        if spec_directory == None:
+            spec_directory = os.path.join(_option("directory", os.path.join(tempfile.gettempdir(), "meteorpy_cache")), "specs")
+        self._spec_directory = spec_directory
+        self._max_bytes = max_bytes if max_bytes != None else _option("render_max_size", 200.0)*1024*1024
+        self._max_days = max_days if max_days != None else _option("render_max_days", 7.0)
+        self._min_minutes = min_minutes if min_minutes != None else _option("render_min_minutes", 10.0)
+
+    @staticmethod
+    def name(key, extension):
+        """ Filename for key, e.g. ('PER', ..., 80) and 'png' """
+        return "%s.%s" % (hashlib.sha1(repr(tuple(key))).hexdigest()[:20], extension)
+
+    def _spec(self, name):
+        return os.path.join(self._spec_directory, name + ".npz")
+
+    def defer(self, key, extension, spec, arrays={}):
+        """
+        Record what is needed to render the graph for key later on, spec (a
+        dict which can be written as JSON) and arrays (a dict of numeric
+        arrays), returns the filename the graph will get
+        """
+        name = self.name(key, extension)
+        _publish(self._spec(name), lambda f: np.savez(f, spec=np.array(json.dumps(spec)), **arrays))
+        evict(self._spec_directory, self._max_bytes, self._max_days*86400)
+        return name
+
+    def spec(self, name):
+        """ (spec, arrays) as recorded by defer() for the graph called name, or None """
+        try:
+            with np.load(self._spec(os.path.basename(name)), allow_pickle=False) as data:
+                arrays = dict((field, data[field]) for field in data.files if field != "spec")
+                return json.loads(str(data["spec"])), arrays
+        except (IOError, ValueError):
+            return None
+
+    def has(self, key, extension):
+        """ Is the graph for key cached? """
+        return os.path.exists(os.path.join(self._directory, self.name(key, extension)))
+
+    def get(self, key, extension, render):
+        """
+        Filename (in the directory) of the graph for key, calling
+        render(fileobj, extension) to create it if it is not cached.
+        """
+        return self.getDeferred(self.name(key, extension), render)
+
+    def getDeferred(self, name, render):
+        """ Same as get(), for the graph called name, e.g. as returned by defer() """
+        name = os.path.basename(name)
+        path = os.path.join(self._directory, name)
+        try:
+            os.utime(path, None) # Mark as recently used
+            return name
+        except OSError:
+            pass # Not cached
+        _publish(path, lambda f: render(f, os.path.splitext(name)[1][1:]), mode=0644)
+        evict(self._directory, self._max_bytes, self._max_days*86400, \
+              pattern=self._pattern, min_age=self._min_minutes*60)
+        return name
+
+    def clear(self):
+        evict(self._directory, 0, pattern=self._pattern)
+
+
+""" Cache shared by the whole process """
+default = None
+def aggregates():
+    global default
+    if default == None:
+        default = AggregateCache()
+    return default
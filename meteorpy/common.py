@@ -8,23 +8,40 @@ import datetime
 
 """ Julian date and Solar Longitude """
 
+# Julian Day of the Unix epoch (1970-01-01 00:00:00 UT)
+_JD_UNIX_EPOCH = 2440587.5
+
+# Periodic terms of the solar longitude series.
+# If you wonder about these numbers, see "Astronomical Algorithms" (Jean Meeus) pp 205
+_SOLLON_A0 = np.array([334166.0, 3489.0, 350.0, 342.0, 314.0, 268.0, 234.0, 132.0, 127.0, 120.0, 99.0, 90.0, 86.0, 78.0, 75.0, 51.0, 49.0, 36.0, 32.0, 28.0, 27.0, 24.0, 21.0, 21.0, 20.0, 16.0, 13.0, 13.0])
+_SOLLON_B0 = np.array([4.669257, 4.6261, 2.744, 2.829, 3.628, 4.418, 6.135, 0.742, 2.037, 1.11, 5.233, 2.045, 3.508, 1.179, 2.533, 4.58, 4.21, 2.92, 5.85, 1.90, 0.31, 0.34, 4.81, 1.87, 2.46, 0.83, 3.41, 1.08])
+_SOLLON_C0 = np.array([6283.07585, 12566.1517, 5753.385, 3.523, 77713.771, 7860.419, 3930.210, 11506.77, 529.691, 1577.344, 5884.927, 26.298, 398.149, 5223.694, 5507.553, 18849.23, 775.52, 0.07, 11790.63, 796.30, 10977.08, 5486.78, 2544.31, 5573.14, 6069.78, 213.30, 2942.46, 20.78])
+_SOLLON_A1 = np.array([20606.0, 430.0, 43.0])
+_SOLLON_B1 = np.array([2.67823, 2.635, 1.59])
+
+
 def jd(mydate):
     """Convert a Gregorian date/time in Universal Time to the corresponding Julian Day.
     This is the number of days since Greenwich noon of January 1, 4713 B.C.
     Algorithm from 'Astronomical Algorithms', Jean Meeus, p61.
     
     Input:
-    mydate -- Python DateTime object (UT) to convert
+    mydate -- Python DateTime object (UT) to convert, or an array of 
+              numpy datetime64 values, datetime objects or Julian Days
     
     Output:
-    Decimal Julian Day (float)
+    Decimal Julian Day (float), or an array of them if an array was given
     
     Tests:
     >>> jd(datetime.datetime(2000, 1, 1, 12, 0, 0))
     2451545.0
     >>> jd(datetime.datetime(2000, 1, 1, 12, 0, 0, int(1E5)))
     2451545.0000011576
+    >>> jd(np.array(['2000-01-01T12:00:00', '2000-01-02T00:00:00'], dtype='datetime64[s]'))
+    array([2451545. , 2451545.5])
     """
+    if not isinstance(mydate, datetime.datetime):
+        return _jd_array(mydate)
     
     # Get the day expressed as a decimal number
     year = mydate.year
@@ -45,60 +62,115 @@ def jd(mydate):
     return result
 
 
-def sollon(datetime):
+def _jd_array(dates):
+    """ 
+    Vectorized counterpart of jd() for arrays of timestamps.
+    Numeric input is assumed to be expressed in Julian Days already.
+    """
+    dates = np.asarray(dates)
+    if dates.dtype.kind in "biuf":
+        return dates.astype(np.float64)
+    
+    # Strings and datetime objects are handed over to numpy's own parser
+    us = dates.astype("datetime64[us]")
+    result = us.astype(np.int64) / 86400e6 + _JD_UNIX_EPOCH
+    return np.where(np.isnat(us), np.nan, result)
+
+
+def sollon(mydate):
     """
     -- Calculation of the solar longitude with an accuracy of about .003 deg
     -- Algorithm based on Jean Meeus' "Astronomical Algorithms" and an article by C. Steyaert in WGN
-    -- Parameter 1: timestamp
-    -- Returns: solar longitude in decimal degrees
+    -- Parameter 1: timestamp, or an array of datetime64 values / Julian Days
+    -- Returns: solar longitude in decimal degrees (an array if an array was given)
     -- Original version: 1995 Jan 28 Rainer Arlt, translated to plpgsql by Geert Barentsen in 2004
-    """
     
-    # If you wonder about these numbers, see "Astronomical Algorithms" (Jean Meeus) pp 205
-    a0 = [334166.0, 3489.0, 350.0, 342.0, 314.0, 268.0, 234.0, 132.0, 127.0, 120.0, 99.0, 90.0, 86.0, 78.0, 75.0, 51.0, 49.0, 36.0, 32.0, 28.0, 27.0, 24.0, 21.0, 21.0, 20.0, 16.0, 13.0, 13.0]
-    b0 = [4.669257, 4.6261, 2.744, 2.829, 3.628, 4.418, 6.135, 0.742, 2.037, 1.11, 5.233, 2.045, 3.508, 1.179, 2.533, 4.58, 4.21, 2.92, 5.85, 1.90, 0.31, 0.34, 4.81, 1.87, 2.46, 0.83, 3.41, 1.08]
-    c0 = [6283.07585, 12566.1517, 5753.385, 3.523, 77713.771, 7860.419, 3930.210, 11506.77, 529.691, 1577.344, 5884.927, 26.298, 398.149, 5223.694, 5507.553, 18849.23, 775.52, 0.07, 11790.63, 796.30, 10977.08, 5486.78, 2544.31, 5573.14, 6069.78, 213.30, 2942.46, 20.78]
-    a1 = [20606.0, 430.0, 43.0]
-    b1 = [2.67823, 2.635, 1.59]
-
-    julian = jd(datetime)
-    T = (julian - 2451545.0) / 365250.0
+    Tests:
+    >>> round(sollon(datetime.datetime(2011, 8, 13, 0, 0, 0)), 3)
+    139.769
+    >>> np.round(sollon(np.array(['2011-08-13', '2011-12-14'], dtype='datetime64[s]')), 3)
+    array([139.769, 261.458])
+    """
+    julian = jd(mydate)
+    T = (np.asarray(julian, dtype=np.float64) - 2451545.0) / 365250.0
     result = 4.8950627 + T * (6283.0758500 - T * 0.0000099)
     
-    # Calculate s0
-    s0 = 0.0
-    for n in range(len(b0)):
-        angle = b0[n] + c0[n] * T
-        s0 = s0 + a0[n] * np.cos(angle)
+    # Evaluate all periodic terms for all timestamps at once
+    s0 = np.dot(np.cos(_SOLLON_B0 + np.multiply.outer(T, _SOLLON_C0)), _SOLLON_A0)
+    s1 = np.dot(np.cos(_SOLLON_B1 + np.multiply.outer(T, _SOLLON_C0[:3])), _SOLLON_A1)
+    s2 = 872.0 * np.cos(1.073 + _SOLLON_C0[0] * T) + 29 * np.cos(0.44 + _SOLLON_C0[1] * T)
+    s3 = 29.0 * np.cos(5.84 + _SOLLON_C0[0] * T)
+    
+    # The required longitude in radians is given by:
+    result = result + ( s0 + T * ( s1 + T * ( s2 + T * s3 ) ) ) * 1.0e-7
+    
+    # Normalize the angle and return the result (DEGREES!)
+    return np.degrees(np.mod(result, 2.0*np.pi))
+
+# Mean motion of the Sun in solar longitude (degrees per day)
+_SOLLON_RATE = 360.0 / 365.242191
 
-    # Calculate s1
-    s1 = 0.0
-    for n in range(3):
-        angle = b1[n] + c0[n] * T
-        s1 = s1 + a1[n] * np.cos(angle)
 
-    # Calculate s2
-    angle = 1.073 + c0[0] * T
-    angle1 = 0.44 + c0[1] * T
-    s2 = 872.0 * np.cos(angle) + 29 * np.cos(angle1)
+def sollon2jd(lon, year, tolerance=1e-7, maxiter=20):
+    """
+    Inverse of sollon(): find the Julian Day at which the Sun reaches a given
+    solar longitude (J2000.0). For each target longitude the solution is the
+    first passage on or after 1 January 00:00 UT of the given year.
     
-    # Calculate s3
-    angle = 5.84 + c0[0] * T
-    s3 = 29.0 * np.cos(angle)
+    The series of sollon() is solved with Newton iterations using the mean
+    motion of the Sun as derivative, for all targets at once.
     
-    # The required longitude in radians is given by:
-    result = result + ( s0 + T * ( s1 + T * ( s2 + T * s3 ) ) ) * 1.0e-7
+    Input:
+    lon -- solar longitude in degrees, scalar or array
+    year -- year(s) in which to look, broadcast against lon
+    tolerance -- convergence criterion (days), default 1E-7 days (< 0.01 s)
     
-    # Normalize the angle
-    while result > 2.0*np.pi:
-        result = result - 2.0*np.pi
-    while result < 0:
-        result = result + 2.0*np.pi
+    Output:
+    Decimal Julian Day (float), or an array of them if an array was given
     
-    # Return the result (DEGREES!)
-    return np.degrees(result)
+    Tests:
+    >>> round(sollon(sollon2jd(140.0, 2011)), 6)
+    140.0
+    """
+    lon = np.mod(np.asarray(lon, dtype=np.float64), 360.0)
+    year = np.asarray(year, dtype=np.int64)
+    lon, year = np.broadcast_arrays(lon, year)
+    
+    # Start from the longitude of the Sun on January 1st
+    newyear = (year - 1970).astype("datetime64[Y]").astype("datetime64[D]").astype(np.int64) + _JD_UNIX_EPOCH
+    result = newyear + np.mod(lon - sollon(newyear), 360.0) / _SOLLON_RATE
+    
+    for i in range(maxiter):
+        step = (np.mod(lon - sollon(result) + 180.0, 360.0) - 180.0) / _SOLLON_RATE
+        result = result + step
+        if result.size == 0 or np.max(np.abs(step)) < tolerance:
+            break
+    
+    if result.ndim == 0:
+        return float(result)
+    return result
 
 
+def sollon2datetime(lon, year):
+    """
+    Find the UT instant at which the Sun reaches a given solar longitude, 
+    see sollon2jd().
+    
+    Output:
+    Python DateTime object (UT) for scalar input, otherwise an array of 
+    numpy datetime64[us] values
+    
+    Tests:
+    >>> sollon2datetime(140.0, 2011).strftime('%Y-%m-%d %H:%M:%S')
+    '2011-08-13 05:47:02'
+    """
+    julian = np.asarray(sollon2jd(lon, year))
+    microseconds = np.round((julian - _JD_UNIX_EPOCH) * 86400e6).astype(np.int64)
+    result = microseconds.astype("datetime64[us]")
+    if result.ndim == 0:
+        return result.astype(datetime.datetime)
+    return result
+
 
 
 def iso2datetime(iso):
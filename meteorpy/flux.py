@@ -13,10 +13,21 @@ import matplotlib.pyplot as plt
 
 import datetime
 import os
+import collections
+import threading
+import weakref
+import cStringIO
+import json
+import csv
+import multiprocessing
 import pg
 
 import vmo
 import common
+import binning
+import cache
+import rollup
+import timing
 
 class FluxData(object):
     '''
@@ -30,17 +41,30 @@ class FluxData(object):
     _max_interval = 24 # Hours
     _stations = ""
     _bin_mode = "adaptive"
+    # Columns returned by the query in _sql()
+    _columns = [('time', 'timestamp'), ('teff', 'float8'), ('eca', 'float8'), \
+                ('met', 'int8'), ('stations', 'int8')]
+    # Rows per chunk when streaming data from the database
+    _chunksize = vmo.CHUNKSIZE
+    # Longest interval fetched by a single binary COPY when streaming (days)
+    _copy_days = 31
+    # Keep the per-minute aggregates in the local cache (see cache.py)
+    _cache = True
+    # Read from the rollup table (see rollup.py), default = [Rollup] enabled in vmo.ini
+    _rollup = None
+    # Record why every adaptive bin was closed, see getTrace()
+    _trace = False
 
     def __init__(self, shower, begin, end, **keywords):
         '''
         Constructor
         @shower: three-letter code
-        @begin: Python datetime object
-        @end: Python datetime object
+        @begin: Python datetime object or ISO string
+        @end: Python datetime object or ISO string
         '''
         self._shower = shower
-        self._begin = begin
-        self._end = end
+        self._begin = common.iso2datetime(begin) if isinstance(begin, basestring) else begin
+        self._end = common.iso2datetime(end) if isinstance(end, basestring) else end
         
         # Set other parameters which have been supplied
         for kw in keywords.keys():
@@ -57,11 +81,26 @@ class FluxData(object):
             self._min_alt = 0.01
             
         
-    def _load(self):
-        if self._stations != "":
-            stationcond = " AND UPPER(station) = UPPER('%s') "  % pg.escape_string(self._stations)
-        else:
-            stationcond = ""
+    def _sql(self, begin=None, end=None):
+        """ SQL Query for the per-minute aggregates between begin and end (default: the whole interval) """
+        if begin == None:
+            begin, end = self._begin, self._end
+        
+        # Read the pre-aggregated rollup if it holds the requested parameters
+        use_rollup = rollup.enabled() if self._rollup == None else self._rollup
+        if use_rollup and rollup.covers(self._gamma, self._min_alt, self._stations):
+            return rollup.sql(self._shower, begin, end, self._gamma, self._delta, self._min_alt)
+        
+        return self._aggregateSql(begin, end, "shower = '%s'" % pg.escape_string(self._shower))
+    
+    
+    def _aggregateSql(self, begin, end, showercond, key=None):
+        """
+        SQL Query for the per-minute aggregates of the showers selected by 
+        showercond, optionally also grouped by the column expression key 
+        (which is then returned as first column)
+        """
+        stationcond = self._stationcond()
         
         """ SQL Query: fetch the raw counts """
         """
@@ -70,189 +109,126 @@ class FluxData(object):
         else:
             time = "date_trunc('hour',time)"
         """    
-        sql = """SELECT 
-                    time, 
-                    SUM(teff) AS teff, 
+        sql = """SELECT %s
+                    time::timestamp AS time, 
+                    SUM(teff)::float8 AS teff, 
                     -- SUM(eca) AS eca,
-                    SUM( eca * (%.7f + (1-%.7f) * (sin(radians(alt))^%.7f) / sin(radians(alt))) ) AS eca,
-                    SUM(met) AS met,
-                    COUNT(*) AS stations
+                    SUM( eca * (%.7f + (1-%.7f) * (sin(radians(alt))^%.7f) / sin(radians(alt))) )::float8 AS eca,
+                    SUM(met)::int8 AS met,
+                    COUNT(*)::int8 AS stations
                  FROM metrecflux
                  WHERE 
                      time >= '%s'::timestamp 
                      AND time <= '%s'::timestamp
-                     AND shower = '%s'
+                     AND %s
                      AND eca IS NOT NULL
                      AND alt >= %.7f
                      AND eca > 0.50
                      %s
-                 GROUP BY time 
-                 ORDER BY time""" % (self._delta, self._delta, self._gamma, \
-                                     pg.escape_string(str(self._begin)), \
-                                     pg.escape_string(str(self._end)), \
-                                     pg.escape_string(self._shower), \
+                 GROUP BY %s 
+                 ORDER BY %s""" % ("" if key == None else key + ",", \
+                                     self._delta, self._delta, self._gamma, \
+                                     pg.escape_string(str(begin)), \
+                                     pg.escape_string(str(end)), \
+                                     showercond, \
                                      self._min_alt, \
-                                     stationcond)
+                                     stationcond, \
+                                     "time" if key == None else "1, time", \
+                                     "time" if key == None else "1, time")
+        return sql
         
-        result = vmo.sql(sql)
-        if result != None:
+        
+    def getStations(self):
+        """ Requested station codes (upper case), empty list = all stations """
+        return [code.strip().upper() for code in self._stations.split(",") if code.strip() != ""]
+    
+    def _stationcond(self):
+        """ SQL condition selecting the requested stations (if any) """
+        stations = self.getStations()
+        if len(stations) > 0:
+            return " AND UPPER(station) IN (%s) " % ", ".join("'%s'" % pg.escape_string(code) for code in stations)
+        return ""
+    
+    def _keywords(self):
+        """ Correction and binning parameters, as keywords for another FluxData """
+        return dict((kw[1:], getattr(self, kw)) for kw in ["_gamma", "_delta", "_min_alt", "_stations", \
+                    "_bin_mode", "_min_meteors", "_min_eca", "_min_interval", "_max_interval"])
+    
+    def _fetch(self, begin, end):
+        with timing.Span("flux.fetch") as span:
+            result = vmo.copy(self._sql(begin, end), self._columns)
+            span.rows = 0 if result is None else len(result)
+        return result
+    
+    def _fetchChunks(self, begin, end):
+        """ 
+        Per-minute aggregates between begin and end, streamed in chunks of 
+        at most _chunksize rows. Every _copy_days are fetched with one binary
+        COPY (see _fetch), so only that much needs to fit in memory.
+        """
+        step = datetime.timedelta(days=self._copy_days)
+        second = datetime.timedelta(seconds=1)
+        while True:
+            # Both ends are inclusive, like in _sql()
+            stop = min(begin+step-second, end)
+            result = self._fetch(begin, stop)
+            if result is not None:
+                for start in range(0, len(result), self._chunksize):
+                    yield result[start:start+self._chunksize]
+            if stop >= end:
+                break
+            begin = stop+second
+    
+    def _cachekey(self):
+        """ Parameters which determine the result of the query, apart from the time interval """
+        return (self._shower, self._gamma, self._delta, self._min_alt, ",".join(self.getStations()))
+    
+    def _load(self):
+        if self._cache:
+            result = cache.aggregates().load(self._cachekey(), self._begin, self._end, self._fetchChunks)
+        else:
+            result = self._fetch(self._begin, self._end)
+        if result is not None:
             self._data = result
         else:
             self._data = []
         
     
     def _bin(self):
-        # Make sure data has been loaded
-        if not hasattr(self, '_data'):
-            self._load()
-        # If data has been loaded but none is available, the result is the empty set!
-        if len(self._data) == 0:
-            self._bins = []
-            return None
-        
         # We should support different binning algorithms
-        if self._bin_mode == "adaptive":
-            self._bin_adaptive()
-        elif self._bin_mode == "fixed":
-            self._bin_fixed()
+        if self._bin_mode == "fixed":
+            binner = binning.FixedBinner(self._begin, self._min_interval, \
+                                         self._min_meteors, self._min_eca)
         else:
-            self._bin_adaptive()
-    
-    
-    def _bin_adaptive(self):
-        bins_time, bins_teff, bins_eca, bins_met = [], [], [], []
-        
-        current_bin_deltaseconds = []
-        current_bin_start = self._begin
-        current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
-      
-        my_max_interval = round(self._max_interval, 6) # hours
-        my_min_interval = round(self._min_interval, 6) # hours
-
-
-	# Make sure the first bin starts near the actual data
-	delta_max = datetime.timedelta(minutes=round(self._max_interval*60))
-        firsttime = datetime.datetime.strptime(self._data[0]['time'], "%Y-%m-%d %H:%M:%S")
-	while (current_bin_start+delta_max) < firsttime:
-		current_bin_start += delta_max
-        
-	import logging
-	logging.basicConfig(level=logging.INFO, filename="/tmp/fluxviewer_binning.log")
-	logging.debug("min/max interval = %s/%s" % (my_min_interval, my_max_interval))
-	logging.debug("Starting first bin at %s" % current_bin_start)
-
-        for row in self._data:
-            rowtime = datetime.datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S")
-            
-            deltaseconds = self.diff_seconds(rowtime - current_bin_start)
-            deltahours = round(deltaseconds/3600.0, 6)
-            
-	
-	    logging.debug("%s: N=%s ECA=%s dH=%s" % (rowtime, current_bin_met, current_bin_eca, deltahours))
-
-            if (current_bin_met >= self._min_meteors or current_bin_eca >= (self._min_eca*1000.0) \
-            or deltahours >= my_max_interval) and (deltahours >= my_min_interval):
-
-		logging.debug("New bin at %s" % rowtime)		
-
-                if len(current_bin_deltaseconds) > 0:
-                    bins_time.append( current_bin_start+datetime.timedelta(seconds=np.mean(current_bin_deltaseconds)) )
-                    bins_teff.append( current_bin_teff )
-                    bins_eca.append( current_bin_eca )
-                    bins_met.append( current_bin_met )
-		else:
-		    logging.debug("Skipping this bin because it's the first one.")
-
-
-                
-                # Start counting the duration of the next bin from the end of the last
-                if (deltahours >= self._max_interval):
-                    # If previous bin was cut off because of max_interval
-                    #current_bin_start += datetime.timedelta(minutes=round(self._max_interval*60))
-
-		    while (current_bin_start+delta_max) <= rowtime:
-                    	current_bin_start += delta_max
-		    logging.debug("Next bin starting at +max_interval: %s" % current_bin_start)
-                else:
-                    # Otherwise start from true end of previous bin
-                    current_bin_start += datetime.timedelta(minutes=round(current_bin_deltaseconds[-1]/60.))
-		    logging.debug("Next bin starting from TRUE END: %s" % current_bin_start)
-
-                
-                #print "New bin starts at %s" % current_bin_start
-                # Reset bins
-                current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
-                current_bin_deltaseconds = []
-                deltaseconds = self.diff_seconds(rowtime - current_bin_start)
-                #print deltaseconds
-            
-            current_bin_deltaseconds.append( deltaseconds )
-            current_bin_teff += row['teff']
-            current_bin_eca += row['eca']
-            current_bin_met += row['met']
-
-        if current_bin_met > 5:
-            bins_time.append( current_bin_start+datetime.timedelta(seconds=np.mean(current_bin_deltaseconds)) )
-            bins_teff.append( current_bin_teff )
-            bins_eca.append( current_bin_eca )
-            bins_met.append( current_bin_met )
-                
-        time = np.array(bins_time)
-        eca = np.array(bins_eca)
-        teff = np.array(bins_teff)
-        count = np.array(bins_met)
-        # Units: meteoroids / 1000 km^2 h
-        flux = 1000.0*((count+0.5)/eca) 
-        e_flux = 1000.0*np.sqrt(count+0.5)/eca
-        self._bins = {'shower':self._shower, \
-                'time':time, 'teff':teff, \
-                'flux':flux, 'e_flux':e_flux, \
-                'met':count, 'eca':eca}
-
-
-    def _bin_fixed(self):
-        # Lists to hold the bins
-        bins_time, bins_teff, bins_eca, bins_met = [], [], [], []
+            binner = binning.AdaptiveBinner(self._begin, self._min_meteors, self._min_eca, \
+                                            self._min_interval, self._max_interval, trace=self._trace)
         
-        # Bin length
-        bin_length = datetime.timedelta(self._min_interval/24.)
+        # Use the data if it has been loaded already, otherwise stream it 
+        # from the cache or the database straight into the binning
+        if hasattr(self, '_data'):
+            chunks = [self._data]
+        elif self._cache:
+            chunks = cache.aggregates().chunks(self._cachekey(), self._begin, self._end, self._fetchChunks)
+        else:
+            chunks = self._fetchChunks(self._begin, self._end)
+        for chunk in chunks:
+            if len(chunk) > 0:
+                with timing.Span("flux.bin", rows=len(chunk)):
+                    binner.add(chunk['time'], chunk['teff'], chunk['eca'], chunk['met'])
         
-        # Temporary variables
-        current_bin_end = self._begin + bin_length
-        current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
+        if self._trace:
+            # For getTrace() and getStationMatrix()
+            self._binner = binner
         
-        # Loop over data
-        for row in self._data:
-            # Convert SQL datetime string into Python datetime object
-            rowtime = datetime.datetime.strptime(row['time'], "%Y-%m-%d %H:%M:%S") 
-            
-            # Create new bin if boundary passed
-            if (rowtime >= current_bin_end):
-                if (current_bin_met >= self._min_meteors \
-                    and current_bin_eca >= (self._min_eca*1000.0) \
-                    and current_bin_eca > 0): 
-                    bins_time.append( current_bin_end - bin_length/2 )
-                    bins_teff.append( current_bin_teff )
-                    bins_eca.append( current_bin_eca )
-                    bins_met.append( current_bin_met )
-                
-                current_bin_end += bin_length
-                current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
-            
-            # Add data to current bin
-            current_bin_teff += row['teff']
-            current_bin_eca += row['eca']
-            current_bin_met += row['met']
-        
-        # Final bin
-        if (current_bin_met >= self._min_meteors \
-            and current_bin_eca >= (self._min_eca*1000.0) \
-            and current_bin_eca > 0):
-            bins_time.append( current_bin_end - bin_length/2 )
-            bins_teff.append( current_bin_teff )
-            bins_eca.append( current_bin_eca )
-            bins_met.append( current_bin_met )
-                
+        # If no data is available, the result is the empty set!
+        if binner.rows == 0:
+            self._bins = []
+        else:
+            with timing.Span("flux.bin"):
+                self._setBins(*binner.result())
+    
+    
+    def _setBins(self, bins_time, bins_teff, bins_eca, bins_met):
         time = np.array(bins_time)
         eca = np.array(bins_eca)
         teff = np.array(bins_teff)
@@ -276,23 +252,258 @@ class FluxData(object):
             self._bin()
         return self._bins
     
+    def getTrace(self):
+        """ Per-bin decisions of the adaptive binning (requires trace=True), see binning.AdaptiveBinner.trace() """
+        if not self._trace or self._bin_mode == "fixed":
+            raise ValueError("Binning trace requires trace=True and adaptive binning.")
+        if not hasattr(self, '_binner'):
+            self._bin()
+        return self._binner.trace()
+    
+    
+    def _stationSql(self):
+        """ SQL Query for the per-minute aggregates of every station, sorted by station """
+        stations = self.getStations()
+        if len(stations) > 0:
+            # Index in the list of stations, which keeps the binary COPY fast
+            key = "CASE UPPER(station) %s END::int2 AS station" % " ".join("WHEN '%s' THEN %d" \
+                  % (pg.escape_string(code), i) for i, code in enumerate(stations))
+        else:
+            key = "UPPER(station)::text AS station"
+        return self._aggregateSql(self._begin, self._end, "shower = '%s'" % pg.escape_string(self._shower), key)
+    
+    def _fetchStations(self):
+        stations = self.getStations()
+        columns = [('station', 'int2' if len(stations) > 0 else 'text')] + self._columns
+        with timing.Span("flux.fetch") as span:
+            data = vmo.copy(self._stationSql(), columns)
+            span.rows = 0 if data is None else len(data)
+        if data is not None and len(stations) > 0:
+            # Station codes instead of their index
+            names = np.array(stations)[data['station']]
+            result = np.empty(len(data), dtype=[('station', names.dtype)] + data.dtype.descr[1:])
+            for name in data.dtype.names[1:]:
+                result[name] = data[name]
+            result['station'] = names
+            data = result
+        return data
+    
+    def getStationMatrix(self):
+        """
+        Contribution of every station to the bins of the combined profile, 
+        from a single query: dict with 'stations', 'time' (as in getBins) and 
+        'teff', 'eca', 'met', 'flux', 'e_flux' as arrays of shape (stations, bins). 
+        The sums over the stations equal the combined bins. 
+        """
+        if hasattr(self, '_stationMatrix'):
+            return self._stationMatrix
+        data = self._fetchStations()
+        if data is None or len(data) == 0:
+            data = np.zeros(0, dtype=[('station', 'S8')] + [(name, vmo._BINARY_TYPES[t][1]) for name, t in self._columns])
+        
+        with timing.Span("flux.stations", rows=len(data)):
+            # Combined per-minute aggregates, as returned by _sql()
+            times, minute = np.unique(data['time'], return_inverse=True)
+            combined = np.zeros(len(times), dtype=[(name, vmo._BINARY_TYPES[t][1]) for name, t in self._columns])
+            combined['time'] = times
+            for name in ['teff', 'eca', 'met', 'stations']:
+                combined[name] = np.bincount(minute, weights=data[name], minlength=len(times))
+            
+            fd = FluxData(self._shower, self._begin, self._end, trace=True, **self._keywords())
+            fd._data = combined
+            bins = fd.getBins()
+            nbins = 0 if len(bins) == 0 else len(bins['time'])
+            
+            # Bin of every minute, or nbins if it is not part of any bin
+            if nbins == 0:
+                index = np.zeros(len(times), dtype=int)
+            elif self._bin_mode == "fixed":
+                # The bins of the FixedBinner of getBins()
+                index = fd._binner.index(times)
+                index[index < 0] = nbins
+            else:
+                trace = fd.getTrace()
+                # A bin ends before the row which closed it, the final bin includes its last row
+                closed = trace['end'][trace['reason'] != "end"]
+                index = np.searchsorted(closed, times.astype(closed.dtype), side="right")
+                if len(closed) == len(trace):
+                    index[times.astype(closed.dtype) >= closed[-1]] = nbins
+            
+            stations, station = np.unique(data['station'], return_inverse=True)
+            cell = station * (nbins+1) + index[minute]
+            matrix = {'stations': stations, 'time': bins['time'] if nbins > 0 else np.array([])}
+            for name in ['teff', 'eca', 'met']:
+                matrix[name] = np.bincount(cell, weights=data[name], \
+                                           minlength=len(stations)*(nbins+1)).reshape(len(stations), nbins+1)[:,:nbins]
+            matrix['met'] = np.rint(matrix['met']).astype(np.int64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                matrix['flux'] = np.where(matrix['eca'] > 0, 1000.0*(matrix['met']+0.5)/matrix['eca'], np.nan)
+                matrix['e_flux'] = np.where(matrix['eca'] > 0, 1000.0*np.sqrt(matrix['met']+0.5)/matrix['eca'], np.nan)
+        self._stationMatrix = matrix
+        return matrix
+    
     
     @staticmethod
     def diff_seconds(timedelta):
         """ Convert a datetime.timedelta object to a value in seconds """
         return (timedelta.days*3600.0*24.0 + timedelta.seconds + timedelta.microseconds/100000.0)
     
+
+
+def _bin(job):
+    """ Bin one profile, in a worker process: (shower, begin, end, keywords, data) -> bins """
+    shower, begin, end, keywords, data = job
+    fd = FluxData(shower, begin, end, **keywords)
+    fd._data = data if data is not None else []
+    return fd.getBins()
+
+def binParallel(jobs, processes=None, pool=None):
+    """
+    Bins of per-minute aggregates which have been fetched already, 
+    one job = (shower, begin, end, keywords, data) per profile.
+    @processes: number of worker processes, default = number of CPUs
+    @pool: multiprocessing pool to use instead, e.g. for several calls
+    """
+    if pool != None:
+        return pool.map(_bin, jobs)
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            return pool.map(_bin, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return map(_bin, jobs)
+
+
+
+class MultiFluxData(FluxData):
+    '''
+    Flux profiles of several showers over the same interval, 
+    from a single GROUP BY shower, time query
+    '''
+    
+    # Columns returned by the query in _sql(): index of the shower in the list, then as FluxData
+    _columns = [('shower', 'int2')] + FluxData._columns
+    # The cache of aggregates is kept per shower
+    _cache = False
+    # Number of worker processes for the binning, default = number of CPUs
+    _processes = None
+    
+    def __init__(self, showers, begin, end, **keywords):
+        '''
+        @showers: list of three-letter codes
+        @begin, end: Python datetime objects
+        @keywords: as for FluxData, plus processes
+        '''
+        FluxData.__init__(self, ",".join(showers), begin, end, **keywords)
+        self._showers = list(showers)
+        if len(self._showers) == 0:
+            raise ValueError("No showers given.")
+    
+    def _sql(self, begin=None, end=None):
+        if begin == None:
+            begin, end = self._begin, self._end
+        
+        use_rollup = rollup.enabled() if self._rollup == None else self._rollup
+        if use_rollup and rollup.covers(self._gamma, self._min_alt, self._stations):
+            sql = ["SELECT %d::int2 AS shower, r%d.* FROM (%s) AS r%d" \
+                   % (i, i, rollup.sql(shower, begin, end, self._gamma, self._delta, self._min_alt), i) \
+                   for i, shower in enumerate(self._showers)]
+            return "SELECT * FROM (%s) AS showers ORDER BY 1, 2" % " UNION ALL ".join(sql)
+        
+        codes = ["'%s'" % pg.escape_string(shower) for shower in self._showers]
+        index = "CASE shower %s END::int2 AS shower" \
+                % " ".join("WHEN %s THEN %d" % (code, i) for i, code in enumerate(codes))
+        return self._aggregateSql(begin, end, "shower IN (%s)" % ", ".join(codes), index)
+    
+    def _load(self):
+        result = self._fetch(self._begin, self._end)
+        self._data = result if result is not None else []
+    
+    def getData(self, shower=None):
+        """ Per-minute aggregates of all showers, or views on those of one shower """
+        data = FluxData.getData(self)
+        if shower == None:
+            return data
+        return self._split()[shower]
+    
+    def _split(self):
+        """ Dict shower -> slice of the result, which is sorted by shower and time """
+        data = FluxData.getData(self)
+        if len(data) == 0:
+            return dict((shower, data) for shower in self._showers)
+        bounds = np.searchsorted(data['shower'], np.arange(len(self._showers)+1))
+        return dict((shower, data[bounds[i]:bounds[i+1]]) for i, shower in enumerate(self._showers))
+    
+    def _bin(self):
+        parts = self._split()
+        jobs = [(shower, self._begin, self._end, self._keywords(), parts[shower]) for shower in self._showers]
+        with timing.Span("flux.bin", rows=sum(len(part) for part in parts.values())):
+            self._bins = dict(zip(self._showers, binParallel(jobs, self._processes)))
+    
+    def getBins(self, shower=None):
+        """ Dict shower -> bins (see FluxData.getBins), or the bins of one shower """
+        bins = FluxData.getBins(self)
+        if shower == None:
+            return bins
+        return bins[shower]
+    
+    def getTrace(self):
+        raise ValueError("Binning trace is not available for several showers.")
+    
  
  
  
  
  
+class BatchFormatter(mpl.ticker.Formatter):
+    '''
+    Tick formatter which computes the labels of all ticks of a draw with
+    a single call of labels(values). Labels are remembered by (tick value,
+    variant()), where variant() returns whatever else determines the label,
+    e.g. its precision. At most max_size labels are kept.
+    '''
+    
+    def __init__(self, labels, variant, max_size=256):
+        self._labels = labels
+        self._variant = variant
+        self._max_size = max_size
+        self._cache = collections.OrderedDict()
+    
+    def set_locs(self, locs):
+        self.locs = locs
+        variant = self._variant()
+        missing = [v for v in locs if (v, variant) not in self._cache]
+        if len(missing) > 0:
+            for v, label in zip(missing, self._labels(missing)):
+                self._cache[(v, variant)] = label
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+    
+    def __call__(self, x, pos=None):
+        label = self._cache.get( (x, self._variant()) )
+        if label == None:
+            label = self._labels([x])[0]
+        return label
+
+
+
 class FluxGraph(object):
     '''
     classdocs
     '''
     _debug = False
     _ymax = None
+    # Longest time interval allowed (seconds); the aggregates are streamed 
+    # into the binning one day at a time, also when they are not cached yet
+    _max_timespan = 366*86400
+    # Figures ready for reuse, per class of timespan (see _createPlot), shared by all threads
+    _templates = {}
+    _templates_lock = threading.Lock()
+    # Number of unused figures kept per class
+    _max_templates = 1
 
     def __init__(self, shower, begin, end, **keywords):
         self._shower = shower
@@ -306,7 +517,7 @@ class FluxGraph(object):
         
         # Total number of seconds represented along X axis
         self._timespan = (self._end-self._begin).total_seconds()
-        if self._timespan > (90*86400):
+        if self._timespan > self._max_timespan:
             raise Exception("Requested time interval too long.")
             
         
@@ -314,69 +525,60 @@ class FluxGraph(object):
 
         
     
-    def _createPlot(self):
-        bins = self._fluxdata.getBins()
+    def _timespanClass(self):
+        """ Plots of the same class share the layout of the time axis (see _newTemplate) """
+        if self._timespan > 5*24*3600: # 5 days
+            return ("days", 0)
+        elif self._timespan > 1*24*3600:
+            if self._timespan > 3*24*3600:
+                return ("hours", 12)
+            elif self._timespan > 1.5*24*3600:
+                return ("hours", 6)
+            return ("hours", 3)
+        else:
+            for hours in [18, 12, 6, 3, 1]:
+                if self._timespan > hours*3600:
+                    return ("minutes", hours)
+            return ("minutes", 0)
+    
+    @staticmethod
+    def _newTemplate(timespanclass):
+        """
+        Figure, axes, locators and formatters for a class of plots.
+        The tick labels are produced by the FluxGraph in template['graph'],
+        a weak reference so that graphs which are not closed are freed.
+        """
+        template = {'class':timespanclass, 'graph':None, 'errorbar':None}
         
-        self._fig = plt.figure(figsize=(11,6), dpi=80) # 11*80 = 880 pixels wide !
+        fig = plt.figure(figsize=(11,6), dpi=80) # 11*80 = 880 pixels wide !
         ax = plt.subplot(111)
-        self._fig.subplots_adjust(0.1,0.17,0.92,0.87)
+        fig.subplots_adjust(0.1,0.17,0.92,0.87)
                        
         ax_zhr = plt.twinx(ax=ax)
-        ax_zhr.set_ylabel("ZHR (r=%.1f, $\gamma$=%.2f)" % (self._fluxdata._popindex, self._fluxdata._gamma), fontsize=16)
-        ax_zhr.yaxis.set_major_formatter(plt.FuncFormatter(self.zhr_formatter))
+        ax_zhr.yaxis.set_major_formatter(BatchFormatter(lambda a: template['graph']().zhr_labels(a), \
+                                                        lambda: template['graph']()._fluxdata._popindex))
         
         ax2 = plt.twiny(ax=ax)
         ax2.set_xlabel("Solar longitude (J2000.0)", fontsize=16)
-        ax2.xaxis.set_major_formatter(plt.FuncFormatter(self.sollon_formatter))
+        ax2.xaxis.set_major_formatter(BatchFormatter(lambda a: template['graph']().sollon_labels(a), \
+                                                     lambda: template['graph']().sollon_precision()))
           
         ax.grid(which="both")
+        # Set up the date axes before any data is plotted, which would replace the formatters
+        for a in (ax, ax2, ax_zhr):
+            a.xaxis_date()
         
-        if len(bins) > 0 and len(bins['time']) > 0:
-            ax.errorbar(bins['time'], bins['flux'], yerr=bins['e_flux'], fmt="s", ms=4, lw=1.0, c='red' )    #fmt="+", ms=8    
-        
-        ax.set_xlim([self._begin, self._end])
-        ax2.set_xlim([self._begin, self._end])
-        ax_zhr.set_xlim([self._begin, self._end])
-        
-        # Determine the limit of the Y axis
-        if self._ymax:
-            my_ymax = self._ymax
-        elif len(bins) == 0 or len(bins['time']) == 0:
-        	my_ymax = 100
-        else:
-            my_ymax = 1.1*max(bins['flux']+bins['e_flux'])
-        
-        if len(bins) > 0:
-            ax.set_ylim([0, my_ymax])
-            ax2.set_ylim([0, my_ymax])
-            ax_zhr.set_ylim([0, my_ymax])        
-        
-        
-        if self._timespan > 90*24*3600: # 90 days
-            """ More than 5 days: only show dates """
-            majorLocator = mpl.dates.AutoDateLocator(maxticks=10)
-            sollonLocator = majorLocator
-            majorFormatter = mpl.dates.DateFormatter('%d %b')
-            xlabel = "Date (UT, %s)" % self._begin.year   
-                    
-        elif self._timespan > 5*24*3600: # 5 days
+        kind, t = timespanclass
+        if kind == "days":
             """ More than 5 days: only show dates """
             majorLocator = mpl.dates.AutoDateLocator(maxticks=10)
             sollonLocator = majorLocator
             majorFormatter = mpl.dates.DateFormatter('%d %b')
-            xlabel = "Date (UT, %s)" % self._begin.year   
         
-        elif self._timespan > 1*24*3600:
+        elif kind == "hours":
             """ Between 1 and 5 days: show hours """
             majorLocator = mpl.dates.HourLocator(byhour=[0])
             majorFormatter = mpl.dates.DateFormatter('%d %b')
-            
-            if self._timespan > 3*24*3600:
-                t = 12
-            elif self._timespan > 1.5*24*3600:
-                t = 6
-            else:
-                t = 3
             byhour = np.arange(t, 24, t)
             
             minorLocator = mpl.dates.HourLocator(byhour=byhour)
@@ -384,49 +586,86 @@ class FluxGraph(object):
             sollonLocator = mpl.dates.HourLocator(byhour=np.append(0, byhour))
             fmt2 = mpl.dates.DateFormatter('%H:%M')        
             ax.xaxis.set_minor_formatter(plt.FuncFormatter(fmt2))
-            xlabel = "Date (UT, %s)" % self._begin.year   
             
         else:
-            if self._timespan > 18*3600:
+            if t == 18:
                 majorLocator = mpl.dates.HourLocator( np.arange(0, 24, 3) ) 
                 minorLocator = mpl.dates.HourLocator( np.arange(0, 24, 1) ) 
-            elif self._timespan > 12*3600:
+            elif t == 12:
                 majorLocator = mpl.dates.HourLocator( np.arange(0, 24, 2) ) 
                 minorLocator = mpl.dates.HourLocator( np.arange(1, 24, 2) ) 
-            elif self._timespan > 6*3600:
+            elif t == 6:
                 majorLocator = mpl.dates.HourLocator( np.arange(0, 24, 1) ) 
                 minorLocator = mpl.dates.MinuteLocator(  np.arange(0,60,30)  )
-            elif self._timespan > 3*3600:
+            elif t == 3:
                 majorLocator = mpl.dates.MinuteLocator(  np.arange(0,60,30)  )
                 minorLocator = mpl.dates.MinuteLocator(  np.arange(0,60,15)  )
-            elif self._timespan > 1*3600:
+            elif t == 1:
                 majorLocator = mpl.dates.MinuteLocator( np.arange(0,60,15) ) 
                 minorLocator = mpl.dates.MinuteLocator(  np.arange(0,60,5) )
             else:
                 majorLocator = mpl.dates.MinuteLocator( np.arange(0,60,10) ) 
                 minorLocator = mpl.dates.MinuteLocator(  np.arange(0,60,2) )
                 
-            
             majorFormatter = mpl.dates.DateFormatter('%H:%M')  
             ax.xaxis.set_minor_locator(minorLocator)
             sollonLocator = majorLocator
-            xlabel = "Time (UT, %s)" % self._begin.strftime('%d %b %Y')
         
         ax.xaxis.set_major_formatter(plt.FuncFormatter(majorFormatter))    
         ax2.xaxis.set_major_locator(sollonLocator)
         ax.xaxis.set_major_locator(majorLocator)
-        
-        
                 
         ax.set_ylabel("Meteoroids / 1000$\cdot$km$^{2}\cdot$h", fontsize=18)
-        ax.set_xlabel(xlabel, fontsize=18)
+        ax.tick_params(axis="x", which="major", labelrotation=45, labelsize=14)
+        ax.tick_params(axis="x", which="minor", labelrotation=45, labelsize=12)
         
-        labels = ax.get_xmajorticklabels()
-        plt.setp(labels, rotation=45, fontsize=14) 
-        labels = ax.get_xminorticklabels()
-        plt.setp(labels, rotation=45, fontsize=12)
+        template.update({'fig':fig, 'ax':ax, 'ax_zhr':ax_zhr, 'ax2':ax2, \
+                         'ylim':[a.get_ylim() for a in (ax, ax2, ax_zhr)]})
+        return template
+    
+    def _createPlot(self):
+        bins = self._fluxdata.getBins()
+        with timing.Span("graph.create"):
+            self._updatePlot(bins)
+    
+    def _updatePlot(self, bins):
+        # Reuse a figure of the same class of plots, if one is available
+        timespanclass = self._timespanClass()
+        with FluxGraph._templates_lock:
+            free = FluxGraph._templates.setdefault(timespanclass, [])
+            template = free.pop() if len(free) > 0 else None
+        if template == None:
+            template = self._newTemplate(timespanclass)
+        template['graph'] = weakref.ref(self)
+        self._template = template
+        self._fig = template['fig']
+        ax, ax_zhr, ax2 = template['ax'], template['ax_zhr'], template['ax2']
+        
+        ax_zhr.set_ylabel("ZHR (r=%.1f, $\gamma$=%.2f)" % (self._fluxdata._popindex, self._fluxdata._gamma), fontsize=16)
+        if timespanclass[0] == "minutes":
+            ax.set_xlabel("Time (UT, %s)" % self._begin.strftime('%d %b %Y'), fontsize=18)
+        else:
+            ax.set_xlabel("Date (UT, %s)" % self._begin.year, fontsize=18)
+        
+        if len(bins) > 0 and len(bins['time']) > 0:
+            template['errorbar'] = ax.errorbar(bins['time'], bins['flux'], yerr=bins['e_flux'], fmt="s", ms=4, lw=1.0, c='red' )    #fmt="+", ms=8    
+        
+        ax.set_xlim([self._begin, self._end])
+        ax2.set_xlim([self._begin, self._end])
+        ax_zhr.set_xlim([self._begin, self._end])
         
-        #plt.close()
+        # Determine the limit of the Y axis
+        if self._ymax:
+            my_ymax = self._ymax
+        elif len(bins) == 0 or len(bins['time']) == 0:
+        	my_ymax = 100
+        else:
+            my_ymax = 1.1*max(bins['flux']+bins['e_flux'])
+        
+        if len(bins) > 0:
+            ax.set_ylim([0, my_ymax])
+            ax2.set_ylim([0, my_ymax])
+            ax_zhr.set_ylim([0, my_ymax])
     
     def _coveragePlot(self):
         data = self._fluxdata.getData()
@@ -437,7 +676,7 @@ class FluxGraph(object):
         ax1 = plt.subplot(211)
         ax2 = plt.subplot(212)
         
-        t = [datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S") for t in data['time']]
+        t = data['time'].astype(datetime.datetime)
         ax1.bar(t, data['stations'], width=1.0/(24.0*60.0), edgecolor='none', facecolor='#ff4444')
         
         ax2.bar(t, data['met'], width=1.0/(24.0*60.0), edgecolor='none', facecolor='#ff4444')
@@ -448,44 +687,101 @@ class FluxGraph(object):
         #ax.plot( t, data['stations'], fillstyle="full" )
         
             
+    def close(self):
+        """ Release the figures, the flux plot is kept for reuse by the next graph of its class """
+        if hasattr(self, '_template'):
+            template = self._template
+            if template['errorbar'] != None:
+                template['errorbar'].remove()
+            template['errorbar'], template['graph'] = None, None
+            # As a new figure for the next graph
+            for a, ylim in zip((template['ax'], template['ax2'], template['ax_zhr']), template['ylim']):
+                a.set_ylim(ylim)
+            with FluxGraph._templates_lock:
+                free = FluxGraph._templates.setdefault(template['class'], [])
+                keep = len(free) < self._max_templates
+                if keep:
+                    free.append(template)
+            if not keep:
+                plt.close(template['fig'])
+            del self._template, self._fig
+        if hasattr(self, '_figCoverage'):
+            plt.close(self._figCoverage)
+            del self._figCoverage
+    
+    def __del__(self):
+        self.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+            
     def show(self):
         if not hasattr(self, '_fig'):
             self._createPlot()
         self._fig.show()        
         
-    def savePlot(self, filename, dpi=100):
+    def savePlot(self, filename, dpi=100, format=None):
+        """ filename: path or file object, format: e.g. "png" (default: from the filename) """
         if not hasattr(self, '_fig'):
             self._createPlot()
-        self._fig.savefig(filename, dpi=dpi)
+        with timing.Span("graph.savefig") as span:
+            self._fig.savefig(filename, dpi=dpi, format=format)
+            try:
+                span.bytes = filename.tell() if hasattr(filename, "tell") else os.path.getsize(filename)
+            except (IOError, OSError):
+                pass
+    
+    def renderKey(self, dpi):
+        """ All parameters which determine the content of a plot rendered at dpi """
+        fd = self._fluxdata
+        return (self._shower, str(self._begin), str(self._end), \
+                fd._bin_mode, fd._min_meteors, fd._min_eca, fd._min_interval, fd._max_interval, \
+                getattr(fd, '_popindex', None), fd._gamma, fd._delta, fd._min_alt, fd._stations, \
+                self._ymax, dpi, cache.revision(self._end))
     
     
     def getFluxTable(self, format="html"):
+        """ Table of the flux bins, format: "html", "json" or "csv" """
         bins = self._fluxdata.getBins()
+        with timing.Span("graph.fluxtable", rows=len(bins['time']) if len(bins) > 0 else 0):
+            return self._fluxTable(bins, format)
+    
+    def _fluxTable(self, bins, format):
         if len(bins) == 0:
-            html = "<div>No bins found</div>"
-        else:
-            """ Take a list of flux bins and produce a nice HTML table """
-            html = "<table>\n"
-            html += "\t<thead><th>Time<br/>[UT]</th><th>Solarlon<br/>[deg]</th><th>Teff<br/>[h]</th><th>ECA<br/>[10<sup>3</sup>&#183;km<sup>2</sup>&#183;h]</th>"
-            html += "<th>n%s</th><th>Flux<br/>[10<sup>-3</sup>&#183;km<sup>-2</sup>&#183;h<sup>-1</sup>]</th><th>ZHR<sup>*</sup></th></thead>\n" % bins['shower']
-            for i in range(len(bins['time'])):
-                html += "\t<tr>"
-                html += "<td>%s</td><td>%.3f</td><td>%.1f</td><td>%.1f</td><td>%d</td><td>%.1f &plusmn; %.1f</td><td>%.0f</td>" \
-                    % ( str(bins['time'][i])[0:16], common.sollon(bins['time'][i]), bins['teff'][i]/60.0, bins['eca'][i]/1000.0, bins['met'][i], bins['flux'][i], bins['e_flux'][i], self.flux2zhr(bins['flux'][i], self._fluxdata._popindex) )
-                html += "</tr>\n"
-            html += "</table>"
-            html += "<p style='text-align:center;'>(*) ZHR estimate derived following (<a href='http://adsabs.harvard.edu/abs/1990JIMO...18..119K'>Koschack &amp; Rendtel 1990b, Eqn. 41</a>)</p>"
+            bins = dict((name, np.array([])) for name in ['time', 'teff', 'eca', 'met', 'flux', 'e_flux'])
         
+        columns = [('time', [str(t)[0:16] for t in bins['time']]), \
+                   ('sollon', common.sollon(bins['time']) if len(bins['time']) > 0 else np.array([])), \
+                   ('teff', bins['teff']/60.0), \
+                   ('eca', bins['eca']/1000.0), \
+                   ('met', np.asarray(bins['met'], dtype=int)), \
+                   ('flux', bins['flux']), \
+                   ('e_flux', bins['e_flux']), \
+                   ('zhr', self.flux2zhr(bins['flux'], self._fluxdata._popindex))]
+        if format != "html":
+            return self._table(format, columns, shower=self._shower)
         
-        return html
+        if len(bins['time']) == 0:
+            return "<div>No bins found</div>"
+        
+        """ Take a list of flux bins and produce a nice HTML table """
+        rows = ["\t<tr><td>%s</td><td>%.3f</td><td>%.1f</td><td>%.1f</td><td>%d</td><td>%.1f &plusmn; %.1f</td><td>%.0f</td></tr>\n" % row \
+                for row in zip(*[c for name, c in columns])]
+        return "".join(["<table>\n", \
+            "\t<thead><th>Time<br/>[UT]</th><th>Solarlon<br/>[deg]</th><th>Teff<br/>[h]</th><th>ECA<br/>[10<sup>3</sup>&#183;km<sup>2</sup>&#183;h]</th>", \
+            "<th>n%s</th><th>Flux<br/>[10<sup>-3</sup>&#183;km<sup>-2</sup>&#183;h<sup>-1</sup>]</th><th>ZHR<sup>*</sup></th></thead>\n" % self._shower] \
+            + rows + \
+            ["</table>", \
+             "<p style='text-align:center;'>(*) ZHR estimate derived following (<a href='http://adsabs.harvard.edu/abs/1990JIMO...18..119K'>Koschack &amp; Rendtel 1990b, Eqn. 41</a>)</p>"])
     
     
     def getObserverTable(self, format="html"):
+        """ Table of the contributing stations, format: "html", "json" or "csv" """
         if not hasattr(self, '_stationdata'):
-            if self._fluxdata._stations != "":
-                stationcond = " AND upper(station) = upper('%s') "  % pg.escape_string(self._fluxdata._stations)
-            else:
-                stationcond = ""
+            stationcond = self._fluxdata._stationcond()
             
             sql = """SELECT a.station, a.observer, a.country, a.teff, a.eca, a.met, b.spo
                         FROM (
@@ -521,21 +817,64 @@ class FluxGraph(object):
                          """ % (pg.escape_string(str(self._begin)), pg.escape_string(str(self._end)), \
                                 pg.escape_string(self._shower), stationcond, \
                                 pg.escape_string(str(self._begin)), pg.escape_string(str(self._end)))
-            self._stationdata = vmo.sql(sql)
+            with timing.Span("graph.observers") as span:
+                self._stationdata = vmo.sql(sql)
+                span.rows = 0 if self._stationdata is None else len(self._stationdata)
         
-            if self._stationdata == None:
+        data = self._stationdata
+        if data is None or len(data) == 0:
+            if format == "html":
                 return ""
-    
-        html = u"<table>\n"
-        html += u"\t<thead><th style='text-align:left;'>Station<br/> </th><th style='text-align:left;'>Observer<br/> </th><th style='text-align:left;'>Country<br/> </th>"
-        html += u"<th>Teff<br/>[h]</th><th>ECA<br/>[10<sup>3</sup>&#183;km<sup>2</sup>&#183;h]</th><th>n%s<br/> </th><th>nSPO<br/> </th></thead>\n" % self._shower
+            data = np.zeros(0, dtype=[('station', 'U8'), ('observer', 'U64'), ('country', 'U64'), \
+                                      ('teff', np.float64), ('eca', np.float64), ('met', np.int64), ('spo', np.int64)])
         
-        for row in self._stationdata:
-            html += u"\t<tr><td style='text-align:left;'>%s</td><td style='text-align:left;'>%s</td><td style='text-align:left;'>%s</td>" % (row['station'], row['observer'].decode("utf-8"), row['country'])
-            html += u"<td>%.0f</td><td>%.0f</td><td>%d</td><td>%d</td></tr>\n" % (row['teff']/60.0, row['eca']/1000.0, row['met'], row['spo'])
-            
-        html += u"<table>\n"
-        return html
+        def text(column):
+            # NULL: empty strings, or NaN if the whole column is NULL
+            return [None if isinstance(v, float) or v in ("", u"") else \
+                    v.decode("utf-8") if isinstance(v, str) else unicode(v) for v in column]
+        
+        columns = [('station', text(data['station'])), \
+                   ('observer', text(data['observer'])), \
+                   ('country', text(data['country'])), \
+                   ('teff', data['teff']/60.0), \
+                   ('eca', data['eca']/1000.0), \
+                   ('met', np.nan_to_num(data['met']).astype(int)), \
+                   ('spo', np.nan_to_num(data['spo']).astype(int))]
+        if format != "html":
+            return self._table(format, columns, shower=self._shower)
+    
+        rows = [u"\t<tr><td style='text-align:left;'>%s</td><td style='text-align:left;'>%s</td><td style='text-align:left;'>%s</td>" \
+                u"<td>%.0f</td><td>%.0f</td><td>%d</td><td>%d</td></tr>\n" % tuple(u"" if v is None else v for v in row) \
+                for row in zip(*[c for name, c in columns])]
+        return u"".join([u"<table>\n", \
+            u"\t<thead><th style='text-align:left;'>Station<br/> </th><th style='text-align:left;'>Observer<br/> </th><th style='text-align:left;'>Country<br/> </th>", \
+            u"<th>Teff<br/>[h]</th><th>ECA<br/>[10<sup>3</sup>&#183;km<sup>2</sup>&#183;h]</th><th>n%s<br/> </th><th>nSPO<br/> </th></thead>\n" % self._shower] \
+            + rows + [u"<table>\n"])
+    
+    
+    @staticmethod
+    def _table(format, columns, **meta):
+        """
+        Machine-readable table (UTF-8 encoded str)
+        @format: "json" (meta and a list of rows as objects) or "csv" (header and rows)
+        @columns: list of (name, values)
+        Missing values (None, NaN) are null in JSON and empty in CSV.
+        """
+        def value(v):
+            return None if isinstance(v, float) and not np.isfinite(v) else v
+        names = [name for name, values in columns]
+        rows = zip(*[[value(v) for v in np.asarray(values).tolist()] for name, values in columns])
+        if format == "json":
+            meta["rows"] = [dict(zip(names, row)) for row in rows]
+            return json.dumps(meta, allow_nan=False)
+        elif format == "csv":
+            out = cStringIO.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(names)
+            for row in rows:
+                writer.writerow([v.encode("utf-8") if isinstance(v, unicode) else v for v in row])
+            return out.getvalue()
+        raise ValueError("Unknown table format '%s'." % format)
     
     
     @staticmethod
@@ -557,19 +896,26 @@ class FluxGraph(object):
         b: tick nr 
         Usage: ax.xaxis.set_major_formatter(pylab.FuncFormatter(sollon_formatter)) 
         """
-        
-        
+        return self.sollon_labels([a])[0]
+    
+    def sollon_precision(self):
+        """ Format of the solar longitude labels """
         # 10 days
         if self._timespan > 10*24*3600:
-            fmt = "%.1f"
+            return "%.1f"
         # 1 day
         elif self._timespan > 24*3600:
-            fmt = "%.2f"
+            return "%.2f"
         else:
-            fmt = "%.3f"
-        
-        d = datetime.datetime.fromordinal(int(a))+datetime.timedelta(a-int(a))
-        return fmt % common.sollon(d)
+            return "%.3f"
+    
+    def sollon_labels(self, a):
+        """ Solar longitude labels for an array of ordinal datetimes """
+        a = np.asarray(a, dtype=float)
+        # Ordinal 1 is 0001-01-01 00:00 UT
+        d = np.datetime64('0001-01-01T00:00:00', 'us') + np.round((a-1)*86400e6).astype('timedelta64[us]')
+        fmt = self.sollon_precision()
+        return [fmt % lon for lon in np.atleast_1d(common.sollon(d))]
 
     def date_formatter(self, a, b):
         """
@@ -587,62 +933,241 @@ class FluxGraph(object):
         return d.strftime(fmt)
 
     def zhr_formatter(self, a, b):
-        zhr = FluxGraph.flux2zhr(a, self._fluxdata._popindex)
-        if round(zhr) < 10:
-            return "%.1f" % zhr
-        else:
-            return "%.0f" % zhr
+        return self.zhr_labels([a])[0]
+    
+    def zhr_labels(self, a):
+        """ ZHR labels for an array of fluxes """
+        zhr = FluxGraph.flux2zhr(np.asarray(a, dtype=float), self._fluxdata._popindex)
+        # round(zhr) < 10
+        return [("%.1f" if z < 9.5 else "%.0f") % z for z in zhr]
         
     
 
 
 class FluxPage(object):
     """ HTML overview of the meteoroid flux """
+    # Render the high-resolution graphs in a pool of child processes, see renderers()
+    _parallel = True
+    
     def __init__(self, shower, begin, end, **keywords):           
         self._fluxgraph = FluxGraph(shower, begin, end, **keywords)    
+        self._arguments = (shower, begin, end, keywords)
     
     
-    def printHTML(self, output, plotdir):        
+    def printHTML(self, output, plotdir, stream=None, url="/flx/tmp", lazy=False, timings=False):
+        """
+        Write the HTML fragments of the page to stream (default: stdout) as soon as they are ready
+        @output: "full" or "graph"
+        @plotdir: where to store the graphs
+        @url: where the graphs in plotdir are published
+        @lazy: only record how to render the high-resolution graphs, see renderDeferred()
+               (requires the graphs to be published through service.py)
+        @timings: append a table with the time spent per stage (see timing.py)
+        
+        In "full" mode the high-resolution graphs are rendered by the pool of
+        renderers() and the observer table is queried in a thread, while the
+        flux table is being written.
+        """
+        if stream == None:
+            stream = sys.stdout
+        if timings:
+            with timing.record() as spans:
+                self.printHTML(output, plotdir, stream, url, lazy)
+            self._write(stream, timing.html(spans))
+            return
+        
+        with timing.Span("page.html"):
+            self._printHTML(output, plotdir, stream, url, lazy)
+    
+    def _printHTML(self, output, plotdir, stream, url, lazy):        
         # Make sure the directory to save plots exists
         try:
             os.makedirs(plotdir)
         except OSError:
             pass # Dir already exists
             
-            
-        prefix = "%s_%06d" % (datetime.datetime.now().strftime("%Y%m%d%H%M%S"), np.random.uniform(0,999999))
-        self._fluxgraph.savePlot("%s/%s.png" % (plotdir, prefix), dpi=80)
+        
+        # Graphs are named after their parameters, identical requests reuse them
+        renders = cache.RenderCache(plotdir)
+        keys = dict((dpi, self._fluxgraph.renderKey(dpi)) for dpi in (80, 100, 300))
+        png = self._render(renders, keys[80], 80, "png")
         
         html = ""
         html += "<div id='fluxplot' style='text-align:center;'>\n"
-        html += "<img src='/flx/tmp/%s.png'/>\n" % prefix
+        html += "<img src='%s/%s'/>\n" % (url, png)
         if output == "full":
-            html += "<br/>(High-resolution: <a href='/flx/tmp/%s.pdf'>PDF</a> | <a href='/flx/tmp/%s_dpi300.png'>PNG</a>)\n" % (prefix, prefix)
+            pdf = renders.name(keys[100], "pdf")
+            png300 = renders.name(keys[300], "png")
+            html += "<br/>(High-resolution: <a href='%s/%s'>PDF</a> | <a href='%s/%s'>PNG</a>)\n" % (url, pdf, url, png300)
         html += "</div>\n"
-        print html.encode("utf8")
-        sys.stdout.flush()
+        
+        if output == "full":
+            jobs = [(key, dpi, format) for key, dpi, format in [(keys[300], 300, "png"), (keys[100], 100, "pdf")] \
+                    if not renders.has(key, format)]
+            pending = None
+            if lazy:
+                for key, dpi, format in jobs:
+                    renders.defer(key, format, *self._spec(dpi))
+                jobs = []
+            elif self._parallel and hasattr(os, "fork") and len(jobs) > 0:
+                # The pool is created before any thread is started
+                pending = renderers().map_async(renderSpec, \
+                              [(plotdir, renders.name(key, format)) + self._spec(dpi) for key, dpi, format in jobs])
+                jobs = []
+            observers = self._thread(self._fluxgraph.getObserverTable, format="html")
+        
+        self._write(stream, html)
     
         if output == "full":
             html = ""
             html += "<div id='fluxtable'>\n"
             html += self._fluxgraph.getFluxTable(format="html")
             html += "</div>\n"
-            print html.encode("utf8")
-            sys.stdout.flush()
-
-            self._fluxgraph.savePlot("%s/%s_dpi300.png" % (plotdir, prefix), dpi=300)
-            self._fluxgraph.savePlot("%s/%s.pdf" % (plotdir, prefix), dpi=100)
+            self._write(stream, html)
             
             html = ""
             html += "<div id='showertable'>\n"
-            html += self._fluxgraph.getObserverTable(format="html")
+            html += observers()
             html += "</div>\n"
-            print html.encode("utf8")
-            sys.stdout.flush()
+            self._write(stream, html)
+            
+            # The links to the high-resolution graphs must work once the page is complete
+            with timing.Span("page.wait"):
+                if pending != None:
+                    for spans in pending.get():
+                        timing.merge(spans)
+            for job in jobs:
+                self._render(renders, *job)
+    
+    
+    def printTable(self, table, format, stream=None):
+        """
+        Write the flux bins (table="flux") or the contributing stations
+        (table="observers") as "json", "csv" or "html" to stream (default: stdout)
+        """
+        if stream == None:
+            stream = sys.stdout
+        if table == "flux":
+            text = self._fluxgraph.getFluxTable(format=format)
+        elif table == "observers":
+            text = self._fluxgraph.getObserverTable(format=format)
+        else:
+            raise ValueError("Unknown table '%s'." % table)
+        if isinstance(text, unicode):
+            text = text.encode("utf8")
+        stream.write(text)
+        stream.flush()
+    
+    def _render(self, renders, key, dpi, format):
+        """ Filename of the graph in the render cache, rendered if needed """
+        return renders.get(key, format, \
+                           lambda f, fmt: self._fluxgraph.savePlot(f, dpi=dpi, format=fmt))
+    
+    def _spec(self, dpi):
+        """ Everything renderDeferred() needs: the arguments as JSON and the bins as arrays """
+        shower, begin, end, keywords = self._arguments
+        spec = {'shower':shower, 'begin':str(begin), 'end':str(end), 'keywords':keywords, 'dpi':dpi}
+        bins = self._fluxgraph._fluxdata.getBins()
+        if len(bins) == 0:
+            return spec, {}
+        return spec, {'time':np.array(bins['time'], dtype='datetime64[us]'), \
+                      'teff':bins['teff'], 'eca':bins['eca'], 'met':bins['met']}
+    
+    @staticmethod
+    def _thread(function, *args, **keywords):
+        """ Call function in a thread, returns a function which waits for its result """
+        result = {}
+        function = timing.wrap(function) # Its spans belong to this page
+        def run():
+            try:
+                result['value'] = function(*args, **keywords)
+            except Exception, e:
+                result['error'] = e
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        def wait():
+            thread.join()
+            if 'error' in result:
+                raise result['error']
+            return result['value']
+        return wait
+    
+    @staticmethod
+    def _write(stream, html):
+        stream.write(html.encode("utf8") + "\n")
+        stream.flush()
+    
+    def close(self):
+        """ Release the figures, to keep the memory use of long-running processes stable """
+        self._fluxgraph.close()
             
 
         
 
+# Pool of processes rendering graphs, (pid of its owner, pool)
+_renderers = (None, None)
+_renderers_size = 2
+
+def renderers():
+    """
+    The pool of processes which render the high-resolution graphs of
+    FluxPage, created once per process (e.g. once per worker of service.py)
+    """
+    global _renderers
+    pid, pool = _renderers
+    if pid != os.getpid():
+        pool = multiprocessing.Pool(_renderers_size, reopenFonts)
+        _renderers = (os.getpid(), pool)
+    return pool
+
+def reopenFonts():
+    """
+    Open the fonts and figures again in a forked process (a process of the
+    pool, a worker of service.py): font files opened by the parent share
+    their file offset with it, and must not be read by several processes
+    at the same time
+    """
+    if hasattr(mpl.font_manager, "_get_font"):
+        mpl.font_manager._get_font.cache_clear()
+    FluxGraph._templates.clear()
+
+
+def renderDeferred(plotdir, name):
+    """
+    Render a graph deferred by FluxPage.printHTML(lazy=True), from the
+    bins stored with it. Returns False if there is no such graph.
+    """
+    recorded = cache.RenderCache(plotdir).spec(name)
+    if recorded == None:
+        return False
+    renderSpec((plotdir, name) + recorded)
+    return True
+
+
+def renderSpec(job):
+    """
+    Render a graph from job = (plotdir, name, spec, arrays), see FluxPage._spec().
+    Returns the spans recorded meanwhile, for the timings of the page.
+    """
+    with timing.record() as spans:
+        _renderSpec(*job)
+    return spans
+
+def _renderSpec(plotdir, name, spec, arrays):
+    keywords = dict((str(k), v) for k, v in spec['keywords'].items())
+    graph = FluxGraph(str(spec['shower']), str(spec['begin']), str(spec['end']), **keywords)
+    if len(arrays) == 0:
+        graph._fluxdata._bins = []
+    else:
+        graph._fluxdata._setBins(arrays['time'].astype(object), \
+                                 arrays['teff'], arrays['eca'], arrays['met'])
+    try:
+        cache.RenderCache(plotdir).getDeferred(name, lambda f, fmt: graph.savePlot(f, dpi=spec['dpi'], format=fmt))
+    finally:
+        graph.close()
+
+
 
 if __name__ == '__main__':
     """
@@ -678,7 +1203,9 @@ if __name__ == '__main__':
     parser.add_option("-d", "--plot-dir", dest="plot_dir", default="/export/metrecflux/public_html/tmp/", type="string", \
                       metavar="DIR", help="where to store the graphs?")      
     parser.add_option("-o", "--output", dest="output", default="full", type="string", \
-                      metavar="MODE", help="what to output? (e.g. graph, full)")      
+                      metavar="MODE", help="what to output? (e.g. graph, full, json, csv)")      
+    parser.add_option("-t", "--timing", dest="timing", action="store_true", default=False, \
+                      help="show the time spent per stage")
     (opts, args) = parser.parse_args()
     
     if len(args) != 3:
@@ -690,7 +1217,11 @@ if __name__ == '__main__':
                    min_interval=opts.min_interval, max_interval=opts.max_interval, \
                    popindex=opts.popindex, gamma=opts.gamma, delta=opts.delta, min_alt=opts.min_alt, \
                    stations=opts.stations)
-    fg.printHTML(output=opts.output, plotdir=opts.plot_dir)
+    if opts.output in ("json", "csv"):
+        # Machine-readable flux bins, without plots
+        fg.printTable("flux", opts.output)
+        sys.exit(0)
+    fg.printHTML(output=opts.output, plotdir=opts.plot_dir, timings=opts.timing)
     
     time_finish = datetime.datetime.now()
     print "<div>Computation time: %.1f s</div>" % ( (time_finish-time_start).total_seconds() )
@@ -0,0 +1,215 @@
+'''
+Multi-year activity profiles of a shower, aligned on solar longitude.
+
+The per-minute aggregates of all years are fetched with a single query,
+every year is binned by FluxData (in parallel worker processes) and the
+profiles are resampled onto a common grid of solar longitude, so that the
+years can be compared or averaged directly.
+
+Usage: python profiles.py [options] shower sollon_begin sollon_end year1,year2,...
+'''
+import sys
+import datetime
+import numpy as np
+import matplotlib as mpl
+if __name__ == '__main__':
+    sys.path.append("/export/metrecflux/py/")
+    mpl.use('Agg')
+import matplotlib.pyplot as plt
+
+import vmo
+import common
+import flux
+import timing
+
+
+class StackedProfiles(object):
+    '''
+    Flux profiles of one shower in several years, between two solar longitudes
+    '''
+
+    def __init__(self, shower, sollon_begin, sollon_end, years, step=0.05, max_gap=1.0, processes=None, **keywords):
+        '''
+        @sollon_begin, sollon_end: solar longitudes (J2000.0, degrees), may wrap around 360
+        @years: list of years, the interval starts in each of them
+        @step: spacing of the common solar longitude grid (degrees)
+        @max_gap: no values are interpolated between bins which are further apart (degrees)
+        @processes: number of worker processes for the binning, default = number of CPUs
+        @keywords: binning and correction parameters of FluxData, e.g. min_meteors, gamma
+        '''
+        self._shower = shower
+        self._sollon_begin = sollon_begin % 360.0
+        self._width = (sollon_end - sollon_begin) % 360.0
+        if self._width == 0:
+            raise ValueError("Empty solar longitude interval.")
+        self._years = list(years)
+        self._step = step
+        self._max_gap = max_gap
+        self._processes = processes
+        self._keywords = keywords
+        self._popindex = keywords.get("popindex", 2.0)
+
+        # Begin and end of the interval in every year, solved for all years at once
+        years = np.array(self._years)
+        begins = common.sollon2datetime(np.repeat(self._sollon_begin, len(years)), years)
+        ends = common.sollon2datetime(np.repeat(self._sollon_begin + self._width, len(years)), years)
+        # Intervals which wrap around 360 degrees end in the next year
+        nextyear = common.sollon2datetime(np.repeat(self._sollon_begin + self._width, len(years)), years+1)
+        ends = np.where(ends <= begins, nextyear, ends)
+        self._intervals = [(b.astype('datetime64[s]').astype(datetime.datetime), \
+                            e.astype('datetime64[s]').astype(datetime.datetime)) for b, e in zip(begins, ends)]
+
+
+    def getIntervals(self):
+        """ List of (begin, end) Python datetime objects, one per year """
+        return self._intervals
+
+
+    def _fetch(self):
+        """ Per-minute aggregates of all years, with a single query """
+        sql = [flux.FluxData(self._shower, begin, end, **self._keywords)._sql() for begin, end in self._intervals]
+        sql = "SELECT * FROM (%s) AS years ORDER BY time" \
+              % " UNION ALL ".join("SELECT * FROM (%s) AS y%d" % (s, k) for k, s in enumerate(sql))
+        with timing.Span("profiles.fetch") as span:
+            result = vmo.copy(sql, flux.FluxData._columns)
+            span.rows = 0 if result is None else len(result)
+        return result
+
+
+    def _bin(self):
+        data = self._fetch()
+        jobs = []
+        for begin, end in self._intervals:
+            part = None
+            if data is not None:
+                # Views on the result, sorted by time
+                lower = np.searchsorted(data['time'], np.datetime64(begin, 's'), side="left")
+                upper = np.searchsorted(data['time'], np.datetime64(end, 's'), side="right")
+                part = data[lower:upper]
+            jobs.append( (self._shower, begin, end, self._keywords, part) )
+
+        with timing.Span("profiles.bin", rows=0 if data is None else len(data)):
+            self._bins = flux.binParallel(jobs, self._processes)
+
+
+    def getBins(self):
+        """ List with the bins of every year (see FluxData.getBins), plus their solar longitude """
+        if not hasattr(self, '_bins'):
+            self._bin()
+            for bins in self._bins:
+                if len(bins) > 0:
+                    bins['sollon'] = self._unwrap(common.sollon(bins['time']))
+        return self._bins
+
+
+    def _unwrap(self, sollon):
+        """ Solar longitudes continuous over the interval, even if it passes 360 degrees """
+        return self._sollon_begin + (np.asarray(sollon) - self._sollon_begin) % 360.0
+
+
+    def getProfiles(self):
+        """
+        Profiles resampled onto the common solar longitude grid:
+        dict with 'sollon' (grid), 'years', and 'flux', 'e_flux', 'zhr', 'met'
+        as arrays of shape (years, grid), where 'met' is the number of meteors
+        in the bin nearest to the grid point. Grid points without data are NaN.
+        """
+        if hasattr(self, '_profiles'):
+            return self._profiles
+        grid = self._sollon_begin + np.arange(0, self._width + self._step/2.0, self._step)
+        result = {'sollon': grid, 'years': np.array(self._years)}
+        for name in ['flux', 'e_flux', 'met']:
+            result[name] = np.empty( (len(self._years), len(grid)) )
+            result[name].fill(np.nan)
+
+        for k, bins in enumerate(self.getBins()):
+            if len(bins) == 0 or len(bins['time']) == 0:
+                continue
+            x = bins['sollon']
+            # Grid points which are not bracketed by bins close enough to each other
+            right = np.clip(np.searchsorted(x, grid), 1, max(len(x)-1, 1))
+            gap = np.abs(x[right] - x[right-1]) if len(x) > 1 else np.zeros(len(grid))
+            valid = (grid >= x[0]) & (grid <= x[-1]) & (gap <= self._max_gap)
+            for name in ['flux', 'e_flux']:
+                result[name][k, valid] = np.interp(grid[valid], x, bins[name])
+            nearest = np.where(np.abs(grid - x[right-1]) <= np.abs(x[right] - grid), right-1, right)
+            result['met'][k, valid] = np.asarray(bins['met'])[nearest[valid]]
+
+        result['zhr'] = flux.FluxGraph.flux2zhr(result['flux'], self._popindex)
+        self._profiles = result
+        return result
+
+
+    def getMeanProfile(self):
+        """ Average over the years of the resampled flux, weighted by 1/e_flux^2: (sollon, flux, e_flux) """
+        p = self.getProfiles()
+        weights = 1.0/p['e_flux']**2
+        weights[np.isnan(weights)] = 0
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(np.nan_to_num(p['flux'])*weights, axis=0) / total
+            error = 1.0/np.sqrt(total)
+        return p['sollon'], mean, error
+
+
+    def savePlot(self, filename, dpi=100, format=None):
+        """ All years in one graph against solar longitude """
+        bins = self.getBins()
+        fig = plt.figure(figsize=(11,6), dpi=80)
+        try:
+            ax = fig.add_subplot(111)
+            fig.subplots_adjust(0.1,0.12,0.92,0.92)
+            colors = plt.cm.viridis(np.linspace(0, 0.9, max(len(self._years), 1)))
+            ymax = 0
+            for year, b, color in zip(self._years, bins, colors):
+                if len(b) == 0 or len(b['time']) == 0:
+                    continue
+                ax.errorbar(b['sollon'], b['flux'], yerr=b['e_flux'], fmt="s", ms=4, lw=1.0, \
+                            c=color, label=str(year))
+                ymax = max(ymax, 1.1*max(b['flux']+b['e_flux']))
+            ax.set_xlim(self._sollon_begin, self._sollon_begin + self._width)
+            ax.set_ylim(0, self._keywords.get("ymax") or ymax or 100)
+            ax.xaxis.set_major_formatter(plt.FuncFormatter(lambda a, b: "%.1f" % (a % 360.0)))
+            ax.grid(which="both")
+            ax.set_xlabel("Solar longitude (J2000.0)", fontsize=16)
+            ax.set_ylabel("Meteoroids / 1000$\\cdot$km$^{2}\\cdot$h", fontsize=16)
+
+            ax_zhr = ax.twinx()
+            ax_zhr.set_ylim(ax.get_ylim())
+            ax_zhr.set_ylabel("ZHR (r=%.1f)" % self._popindex, fontsize=16)
+            ax_zhr.yaxis.set_major_formatter(plt.FuncFormatter( \
+                lambda a, b: "%.0f" % flux.FluxGraph.flux2zhr(a, self._popindex)))
+            if len(ax.get_legend_handles_labels()[0]) > 0:
+                ax.legend(loc="upper right", numpoints=1, title=self._shower)
+            fig.savefig(filename, dpi=dpi, format=format)
+        finally:
+            plt.close(fig)
+
+
+if __name__ == '__main__':
+    """
+    Example: python profiles.py -d /tmp PER 135 145 2011,2012,2013
+    """
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options] shower sollon_begin sollon_end years")
+    parser.add_option("-m", "--min-meteors", dest="min_meteors", default="20", type="int", \
+                      metavar="N", help="minimum number of meteors per bin, default = 20")
+    parser.add_option("-i", "--min-interval", dest="min_interval", default="1.0", type="float", \
+                      metavar="HOURS", help="minimum bin length, default = 1 h")
+    parser.add_option("-j", "--max-interval", dest="max_interval", default="24.0", type="float", \
+                      metavar="HOURS", help="maximum bin length, default = 24 h")
+    parser.add_option("-r", "--popindex", dest="popindex", default="2.0", type="float", \
+                      metavar="POPINDEX", help="population index")
+    parser.add_option("-g", "--gamma", dest="gamma", default="1.0", type="float", \
+                      metavar="GAMMA", help="correction for radiant elevation")
+    parser.add_option("-o", "--output", dest="output", default="profiles.png", type="string", \
+                      metavar="FILE", help="where to save the graph?")
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 4:
+        parser.error("need 4 arguments")
+    stack = StackedProfiles(args[0], float(args[1]), float(args[2]), [int(y) for y in args[3].split(",")], \
+                            min_meteors=opts.min_meteors, min_interval=opts.min_interval, \
+                            max_interval=opts.max_interval, popindex=opts.popindex, gamma=opts.gamma)
+    stack.savePlot(opts.output)
+    print "Saved %s" % opts.output
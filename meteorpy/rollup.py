@@ -0,0 +1,285 @@
+'''
+Pre-aggregated per-minute rollups of the metrecflux table.
+
+The flux query sums teff, met and the zenith-corrected ECA over all stations
+for every minute. Evaluating sin(radians(alt))^gamma for every raw row on
+every request is wasteful, so this module maintains a table with one row per
+(shower, minute, whole degree of radiant altitude) holding:
+
+ - the gamma-independent sums teff, eca, met and the number of stations
+ - the sums of eca*sin(alt)^(gamma-1) for a set of common gamma values
+
+The corrected ECA, (delta + (1-delta)*sin(alt)^gamma/sin(alt)) * eca, then
+follows as delta*eca + (1-delta)*eca_gamma for any delta.
+
+The rollup is refreshed incrementally. The files table records a fingerprint
+(rows, meteors, ECA, first and last minute) of every MetRec file which has
+been aggregated. A refresh compares it with the fingerprints of metrecflux,
+taken with a single scan: new files are added in batches, while for files
+which have been replaced or removed the rollup of the minutes they cover
+(together with all files overlapping those) is computed again. Rows without
+a filename are fingerprinted together, as if they came from the file ''.
+
+Usage: python rollup.py [--create] [--rebuild] [--batch N]
+'''
+import sys
+import numpy as np
+import pg
+
+import vmo
+
+TABLE = "metrecflux_rollup"
+FILES_TABLE = "metrecflux_rollup_files"
+
+# Values of gamma for which the corrected ECA is stored
+GAMMAS = [1.0, 1.25, 1.5, 1.75, 2.0, 2.25, 2.5, 3.0]
+
+# Radiant altitudes below this are never taken into account (degrees),
+# this equals the default min_alt of FluxData
+MIN_ALT = 0.01
+
+
+def column(gamma):
+    """ Name of the column holding SUM(eca*sin(alt)^(gamma-1)) """
+    return "eca_g%03d" % round(gamma*100)
+
+
+def enabled():
+    """ Should FluxData read from the rollup? ([Rollup] enabled in vmo.ini) """
+    c = vmo.config()
+    return c.has_option("Rollup", "enabled") and c.getboolean("Rollup", "enabled")
+
+
+def covers(gamma, min_alt, stations):
+    """
+    Can the rollup answer a flux query with these parameters exactly?
+    Stations are not kept apart and altitudes are only known per whole degree.
+    """
+    if stations != "":
+        return False
+    if not any(abs(gamma - g) < 1e-9 for g in GAMMAS):
+        return False
+    return abs(min_alt - MIN_ALT) < 1e-9 or (min_alt >= 1 and min_alt == int(min_alt))
+
+
+def sql(shower, begin, end, gamma, delta, min_alt):
+    """ Same result as the raw query of FluxData._sql(), read from the rollup """
+    if min_alt >= 1:
+        altcond = "AND alt_bucket >= %d" % int(min_alt)
+    else:
+        altcond = ""
+    return """SELECT
+                time,
+                SUM(teff)::float8 AS teff,
+                (%.7f * SUM(eca) + (1-%.7f) * SUM(%s))::float8 AS eca,
+                SUM(met)::int8 AS met,
+                SUM(stations)::int8 AS stations
+             FROM %s
+             WHERE
+                 time >= '%s'::timestamp
+                 AND time <= '%s'::timestamp
+                 AND shower = '%s'
+                 %s
+             GROUP BY time
+             ORDER BY time""" % (delta, delta, column(gamma), TABLE, \
+                                 pg.escape_string(str(begin)), \
+                                 pg.escape_string(str(end)), \
+                                 pg.escape_string(shower), altcond)
+
+
+def _aggregate(filecond):
+    """ SELECT producing rollup rows for the raw rows of some MetRec files """
+    sums = ",\n                ".join("SUM(eca * sin(radians(alt))^%.7f) AS %s" % (g-1.0, column(g)) for g in GAMMAS)
+    return """SELECT
+                shower, time, floor(alt)::smallint AS alt_bucket,
+                SUM(teff) AS teff, SUM(eca) AS eca,
+                %s,
+                SUM(met) AS met, COUNT(*) AS stations
+             FROM metrecflux
+             WHERE
+                 eca IS NOT NULL
+                 AND eca > 0.50
+                 AND alt >= %.7f
+                 AND %s
+             GROUP BY shower, time, floor(alt)""" % (sums, MIN_ALT, filecond)
+
+
+def create(conn):
+    """ Create the rollup tables """
+    eca_columns = "".join("%s float8 NOT NULL,\n                " % column(g) for g in GAMMAS)
+    conn.query("""CREATE TABLE %s (
+                shower text NOT NULL,
+                time timestamp NOT NULL,
+                alt_bucket smallint NOT NULL,
+                teff float8 NOT NULL,
+                eca float8 NOT NULL,
+                %smet int8 NOT NULL,
+                stations int8 NOT NULL,
+                PRIMARY KEY (shower, time, alt_bucket))""" % (TABLE, eca_columns))
+    conn.query("""CREATE TABLE %s (
+                filename text PRIMARY KEY,
+                n int8 NOT NULL,
+                met int8 NOT NULL,
+                eca float8 NOT NULL,
+                first_time timestamp NOT NULL,
+                last_time timestamp NOT NULL,
+                processed timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP)""" % FILES_TABLE)
+
+
+# Columns of a fingerprint, as in the files table
+_FINGERPRINT = ["filename", "n", "met", "eca", "first_time", "last_time"]
+
+
+def _fingerprints(conn, sql):
+    """ Dict filename -> (n, met, eca, first_time, last_time) """
+    data = conn.sql2recarray(sql)
+    if data is None:
+        return {}
+    return dict((row[0], tuple(row[1:])) for row in zip(*[data[c].tolist() for c in _FINGERPRINT]))
+
+
+def _filecond(files):
+    """ SQL condition selecting the rows of files, where '' stands for the rows without a filename """
+    names = [f for f in files if f != ""]
+    cond = []
+    if len(names) > 0:
+        cond.append("filename IN (%s)" % ", ".join("'%s'" % pg.escape_string(f) for f in names))
+    if len(names) < len(files):
+        cond.append("filename IS NULL OR filename = ''")
+    return "(%s)" % " OR ".join(cond)
+
+
+def _timestamp(t):
+    """ SQL literal of a timestamp """
+    return "'%s'" % str(np.datetime64(t, 's')).replace("T", " ")
+
+
+def _record(conn, files):
+    """ Store the fingerprints of files, a dict as returned by _fingerprints() """
+    values = ", ".join("('%s', %d, %d, %r, %s, %s)" % (pg.escape_string(f), n, met, float(eca), \
+                                                     _timestamp(first), _timestamp(last)) \
+                       for f, (n, met, eca, first, last) in files.items())
+    conn.query("""INSERT INTO %s (%s) VALUES %s
+                  ON CONFLICT (filename) DO UPDATE SET %s""" \
+               % (FILES_TABLE, ", ".join(_FINGERPRINT), values, \
+                  ", ".join("%s = EXCLUDED.%s" % (c, c) for c in _FINGERPRINT[1:] + ["processed"])))
+
+
+def _changed(old, new):
+    """ Do two fingerprints differ? ECA sums may differ in the last digits """
+    return old[:2] != new[:2] or old[3:] != new[3:] or abs(old[2] - new[2]) > 1e-9*max(abs(new[2]), 1.0)
+
+
+def _windows(current, affected):
+    """
+    Time windows which have to be aggregated again: the intervals of the
+    affected files, extended by all files overlapping them (transitively),
+    so that every file lies either completely inside a window or outside.
+    @current: dict of fingerprints, @affected: list of (first_time, last_time)
+    """
+    intervals = sorted([(np.datetime64(first, 's'), np.datetime64(last, 's'), False) \
+                        for n, met, eca, first, last in current.values()] + \
+                       [(np.datetime64(first, 's'), np.datetime64(last, 's'), True) for first, last in affected])
+    windows = []
+    start, stop, hit = None, None, False
+    for first, last, isaffected in intervals:
+        if start is not None and first > stop:
+            if hit:
+                windows.append( (start, stop) )
+            start, stop, hit = None, None, False
+        if start is None:
+            start, stop = first, last
+        stop = max(stop, last)
+        hit = hit or isaffected
+    if hit:
+        windows.append( (start, stop) )
+    return windows
+
+
+def refresh(conn, batch=500):
+    """
+    Bring the rollup up to date with metrecflux, batch new files per
+    transaction. Returns the number of files which were new, replaced or removed.
+    """
+    current = _fingerprints(conn, """SELECT COALESCE(filename, '') AS filename, COUNT(*)::int8 AS n,
+                                            SUM(met)::int8 AS met, SUM(eca)::float8 AS eca,
+                                            MIN(time)::timestamp AS first_time,
+                                            MAX(time)::timestamp AS last_time
+                                     FROM metrecflux
+                                     GROUP BY COALESCE(filename, '')""")
+    recorded = _fingerprints(conn, "SELECT %s FROM %s" % (", ".join(_FINGERPRINT), FILES_TABLE))
+    new = [f for f in current if f not in recorded]
+    changed = [f for f in current if f in recorded and _changed(recorded[f], current[f])]
+    removed = [f for f in recorded if f not in current]
+
+    # Replaced and removed files: aggregate the minutes they cover again
+    affected = [recorded[f][3:] for f in changed + removed] + [current[f][3:] for f in changed]
+    updates = ", ".join("%s = r.%s + EXCLUDED.%s" % (c, c, c) \
+                        for c in ["teff", "eca"] + [column(g) for g in GAMMAS] + ["met", "stations"])
+    done = set()
+    for first, last in _windows(current, affected):
+        timecond = "time >= %s AND time <= %s" % (_timestamp(first), _timestamp(last))
+        inside = dict((f, fp) for f, fp in current.items() \
+                      if np.datetime64(fp[3], 's') >= first and np.datetime64(fp[4], 's') <= last)
+        gone = [f for f in removed if np.datetime64(recorded[f][3], 's') >= first \
+                                      and np.datetime64(recorded[f][4], 's') <= last]
+        conn.query("BEGIN")
+        try:
+            conn.query("DELETE FROM %s WHERE %s" % (TABLE, timecond))
+            conn.query("INSERT INTO %s %s" % (TABLE, _aggregate(timecond)))
+            if len(inside) > 0:
+                _record(conn, inside)
+            if len(gone) > 0:
+                conn.query("DELETE FROM %s WHERE filename IN (%s)" \
+                           % (FILES_TABLE, ", ".join("'%s'" % pg.escape_string(f) for f in gone)))
+            conn.query("COMMIT")
+        except:
+            conn.query("ROLLBACK")
+            raise
+        done.update(inside)
+
+    # New files outside those windows are added to the rollup
+    new = [f for f in new if f not in done]
+    for k in range(0, len(new), batch):
+        files = new[k:k+batch]
+        filecond = _filecond(files)
+        conn.query("BEGIN")
+        try:
+            conn.query("""INSERT INTO %s AS r %s
+                          ON CONFLICT (shower, time, alt_bucket) DO UPDATE SET %s""" \
+                       % (TABLE, _aggregate(filecond), updates))
+            _record(conn, dict((f, current[f]) for f in files))
+            conn.query("COMMIT")
+        except:
+            conn.query("ROLLBACK")
+            raise
+    return len(new) + len(changed) + len(removed)
+
+
+def rebuild(conn, batch=500):
+    """ Throw away the rollup and process all MetRec files again """
+    conn.query("DELETE FROM %s" % TABLE)
+    conn.query("DELETE FROM %s" % FILES_TABLE)
+    return refresh(conn, batch)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("", "--create", dest="create", action="store_true", default=False, \
+                      help="create the rollup tables first")
+    parser.add_option("", "--rebuild", dest="rebuild", action="store_true", default=False, \
+                      help="rebuild the rollup from scratch")
+    parser.add_option("", "--batch", dest="batch", default="500", type="int", \
+                      metavar="N", help="files per transaction, default = 500")
+    (opts, args) = parser.parse_args()
+
+    with vmo.pool().connection() as conn:
+        if opts.create:
+            create(conn)
+        if opts.rebuild:
+            n = rebuild(conn, opts.batch)
+        else:
+            n = refresh(conn, opts.batch)
+    print "Processed %d new, replaced or removed MetRec files" % n
+    sys.exit(0)
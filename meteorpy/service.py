@@ -0,0 +1,240 @@
+'''
+Long-running HTTP service behind MetRec FluxViewer.
+
+Running "python flux.py" for every request means paying for the Python
+start-up, the import of NumPy and matplotlib, a new database connection
+and the font set-up each time. This WSGI application keeps all of that
+warm: database connections are pooled (see vmo.py) and the aggregate cache
+(see cache.py) is shared between requests.
+
+Endpoints:
+  /flux?shower=PER&begin_iso=...&end_iso=...&min_meteors=...  HTML fragments, as printed by flux.py
+                                                               (&timing=1 appends the time spent per stage)
+  /flux.json, /flux.csv, /observers.json, /observers.csv      the tables of a flux page, same parameters
+  /tmp/<file>                                                  the graphs referenced by the HTML,
+                                                               high-resolution ones are rendered on first request
+
+Usage: python service.py [options]
+
+The built-in server forks a pool of worker processes which share the
+listening socket. The application can also be deployed in a WSGI container,
+provided it runs in processes rather than threads: matplotlib figures are
+not thread-safe.
+'''
+import os
+import sys
+import time
+import signal
+import urlparse
+import mimetypes
+import cStringIO
+import matplotlib as mpl
+# Force matplotlib to not use any Xwindows backend.
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+
+import flux
+
+
+# Parameters of a flux page: (type, default), the defaults of the flux.py command line
+PARAMETERS = {"bin_mode": (str, "adaptive"), \
+              "min_meteors": (int, 20), \
+              "min_eca": (float, 100.0), \
+              "min_interval": (float, 1.0), \
+              "max_interval": (float, 24.0), \
+              "popindex": (float, 2.0), \
+              "gamma": (float, 1.0), \
+              "delta": (float, 0.0), \
+              "min_alt": (float, 0.01), \
+              "ymax": (float, None), \
+              "stations": (str, "")}
+
+
+class FluxService(object):
+    '''
+    WSGI application serving flux pages
+    '''
+    # Paths of the machine-readable tables and their content types
+    TABLES = {"/flux.json": "application/json", \
+              "/flux.csv": "text/csv; charset=utf-8", \
+              "/observers.json": "application/json", \
+              "/observers.csv": "text/csv; charset=utf-8"}
+
+    def __init__(self, plotdir, url="/flx/tmp", lazy=True):
+        '''
+        @plotdir: where to store the graphs
+        @url: where the graphs in plotdir are published, e.g. /tmp if served by this application
+        @lazy: render the high-resolution graphs only when they are requested,
+               requires url to point to this application
+        '''
+        self._plotdir = plotdir
+        self._url = url
+        self._lazy = lazy
+
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path.startswith("/tmp/"):
+            return self._file(path[5:], start_response)
+        if path in ("", "/", "/flux"):
+            return self._page(environ, start_response)
+        if path in self.TABLES:
+            return self._table(path, environ, start_response)
+        return self._error(start_response, "404 Not Found", "Unknown path.")
+
+
+    @staticmethod
+    def parse(query):
+        """
+        Convert a query string into the arguments of FluxPage:
+        (shower, begin, end, output, keywords)
+        """
+        args = dict((k, v[-1]) for k, v in urlparse.parse_qs(query, keep_blank_values=True).items())
+        for name in ("shower", "begin", "end"):
+            if name not in args and name+"_iso" in args:
+                args[name] = args[name+"_iso"]
+            if name not in args:
+                raise ValueError("Missing parameter '%s'." % name)
+
+        keywords = {}
+        for name, (cast, default) in PARAMETERS.items():
+            value = args.get(name, "").strip()
+            try:
+                keywords[name] = default if value == "" else cast(value)
+            except ValueError:
+                raise ValueError("Illegal value for parameter '%s'." % name)
+        return args["shower"], args["begin"], args["end"], args.get("output", "full"), keywords
+
+
+    def _page(self, environ, start_response):
+        time_start = time.time()
+        try:
+            shower, begin, end, output, keywords = self.parse(environ.get("QUERY_STRING", ""))
+            page = flux.FluxPage(shower, begin, end, **keywords)
+        except Exception, e:
+            return self._error(start_response, "400 Bad Request", str(e))
+
+        timings = urlparse.parse_qs(environ.get("QUERY_STRING", "")).get("timing", [""])[-1] not in ("", "0")
+        html = cStringIO.StringIO()
+        try:
+            page.printHTML(output, self._plotdir, stream=html, url=self._url, lazy=self._lazy, timings=timings)
+        finally:
+            page.close()
+        html.write("<div>Computation time: %.1f s</div>\n" % (time.time()-time_start))
+
+        body = html.getvalue()
+        start_response("200 OK", [("Content-Type", "text/html; charset=utf-8"), \
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+
+    def _table(self, path, environ, start_response):
+        table, format = path[1:].split(".")
+        try:
+            shower, begin, end, output, keywords = self.parse(environ.get("QUERY_STRING", ""))
+            page = flux.FluxPage(shower, begin, end, **keywords)
+        except Exception, e:
+            return self._error(start_response, "400 Bad Request", str(e))
+        
+        out = cStringIO.StringIO()
+        page.printTable(table, format, stream=out)
+        body = out.getvalue()
+        start_response("200 OK", [("Content-Type", self.TABLES[path]), \
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+
+    def _file(self, name, start_response):
+        name = os.path.basename(name)
+        path = os.path.join(self._plotdir, name)
+        if not os.path.exists(path):
+            # Deferred high-resolution graph
+            try:
+                flux.renderDeferred(self._plotdir, name)
+            except Exception, e:
+                return self._error(start_response, "500 Internal Server Error", str(e))
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+        except IOError:
+            return self._error(start_response, "404 Not Found", "No such file.")
+        start_response("200 OK", [("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream"), \
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+
+    @staticmethod
+    def _error(start_response, status, message):
+        body = "<div>Error: %s</div>\n" % message
+        start_response(status, [("Content-Type", "text/html; charset=utf-8"), \
+                                ("Content-Length", str(len(body)))])
+        return [body]
+
+
+def warmup():
+    """ Load fonts and renderers, in every worker before its first request """
+    fig = plt.figure(figsize=(2, 2), dpi=80)
+    plt.plot([0, 1], [0, 1])
+    plt.xlabel("$\gamma$")
+    for fmt in ("png", "pdf"):
+        fig.savefig(cStringIO.StringIO(), format=fmt)
+    plt.close(fig)
+
+
+def serve(app, host="", port=8080, workers=4):
+    """
+    Serve app with a pool of forked worker processes sharing one socket.
+    Workers which die are replaced.
+    """
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+    class Handler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = make_server(host, port, app, handler_class=Handler)
+
+    children = set()
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                # Fonts opened before the fork must not be shared with the other workers
+                flux.reopenFonts()
+                warmup()
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    for i in range(workers):
+        spawn()
+    try:
+        while True:
+            pid, status = os.wait()
+            children.discard(pid)
+            spawn()
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("", "--host", dest="host", default="", type="string", \
+                      metavar="HOST", help="address to listen on, default = all")
+    parser.add_option("-p", "--port", dest="port", default="8080", type="int", \
+                      metavar="PORT", help="port to listen on, default = 8080")
+    parser.add_option("-w", "--workers", dest="workers", default="4", type="int", \
+                      metavar="N", help="number of worker processes, default = 4")
+    parser.add_option("-d", "--plot-dir", dest="plot_dir", default="/export/metrecflux/public_html/tmp/", type="string", \
+                      metavar="DIR", help="where to store the graphs?")
+    parser.add_option("-u", "--plot-url", dest="plot_url", default="/flx/tmp", type="string", \
+                      metavar="URL", help="where are the graphs published? (must map to /tmp of this service)")
+    parser.add_option("", "--eager", dest="lazy", action="store_false", default=True, \
+                      help="render high-resolution graphs right away, e.g. if they are published by another web server")
+    (opts, args) = parser.parse_args()
+
+    serve(FluxService(opts.plot_dir, opts.plot_url, opts.lazy), opts.host, opts.port, opts.workers)
@@ -0,0 +1,222 @@
+'''
+Sweeps of the zenith correction parameters gamma, delta and min_alt.
+
+The corrected ECA of FluxData,
+
+    SUM( eca * (delta + (1-delta) * sin(alt)^gamma / sin(alt)) ),
+
+depends on the radiant altitude of every row. Instead of running the query
+once per parameter set, ParameterSweep fetches sufficient statistics per
+minute and altitude level once:
+
+    SUM(teff), SUM(eca), SUM(eca*sin(alt)^gamma/sin(alt)) per gamma, SUM(met), COUNT(*)
+
+and recomputes the corrected ECA and the bins of any (gamma, delta, min_alt)
+locally. The altitude level of a row is the number of values of min_alt
+it reaches, so that the rows of every min_alt are selected exactly as by
+FluxData; the result equals the query of FluxData up to rounding.
+'''
+import datetime
+import multiprocessing
+import numpy as np
+import pg
+
+import vmo
+import common
+import flux
+import timing
+
+
+def columns(gammas):
+    """ Columns returned by ParameterSweep._sql() """
+    return [('time', 'timestamp'), ('alt_level', 'int2'), ('teff', 'float8'), ('eca', 'float8')] \
+           + [('eca_g%d' % k, 'float8') for k in range(len(gammas))] \
+           + [('met', 'int8'), ('stations', 'int8')]
+
+
+def _dtype(columns):
+    return [(name, vmo._BINARY_TYPES[pgtype][1]) for name, pgtype in columns]
+
+
+def statistics(rows, gammas, min_alts):
+    """
+    Same as the query of ParameterSweep on raw metrecflux rows (structured
+    array with time, teff, eca, alt and met), e.g. for offline analysis
+    """
+    min_alts = np.unique(min_alts)
+    rows = rows[(rows['eca'] > 0.5) & (rows['alt'] >= min_alts[0])]
+    keys = np.zeros(len(rows), dtype=[('time', 'datetime64[s]'), ('alt_level', 'i2')])
+    keys['time'] = rows['time']
+    keys['alt_level'] = np.searchsorted(min_alts, rows['alt'], side='right') - 1
+    keys, inverse = np.unique(keys, return_inverse=True)
+    result = np.zeros(len(keys), dtype=_dtype(columns(gammas)))
+    result['time'], result['alt_level'] = keys['time'], keys['alt_level']
+    result['teff'] = np.bincount(inverse, weights=rows['teff'])
+    result['eca'] = np.bincount(inverse, weights=rows['eca'])
+    sinalt = np.sin(np.radians(rows['alt']))
+    for k, gamma in enumerate(gammas):
+        result['eca_g%d' % k] = np.bincount(inverse, weights=rows['eca'] * sinalt**gamma / sinalt)
+    result['met'] = np.rint(np.bincount(inverse, weights=rows['met'])).astype(np.int64)
+    result['stations'] = np.bincount(inverse)
+    return result
+
+
+class ParameterSweep(object):
+    '''
+    Flux profiles of one shower for a grid of zenith correction parameters,
+    from a single database query
+    '''
+
+    def __init__(self, shower, begin, end, gammas, deltas=(0.0,), min_alts=(0.01,), processes=None, **keywords):
+        '''
+        @begin, end: Python datetime objects or ISO strings
+        @gammas, deltas, min_alts: values of the parameters, all combinations are computed
+        @processes: number of worker processes for the binning, default = number of CPUs
+        @keywords: binning parameters and stations, as for FluxData
+        '''
+        self._shower = shower
+        self._begin = common.iso2datetime(begin) if isinstance(begin, basestring) else begin
+        self._end = common.iso2datetime(end) if isinstance(end, basestring) else end
+        self._gammas = np.atleast_1d(np.asarray(gammas, dtype=float))
+        self._deltas = np.atleast_1d(np.asarray(deltas, dtype=float))
+        self._min_alts = np.atleast_1d(np.asarray(min_alts, dtype=float))
+        self._processes = processes
+        self._keywords = keywords
+        # Binning and station selection as in a normal flux profile
+        self._fluxdata = flux.FluxData(shower, self._begin, self._end, **keywords)
+
+
+    def _sql(self):
+        levels = np.unique(self._min_alts)
+        level = " + ".join("(CASE WHEN alt >= %.7f THEN 1 ELSE 0 END)" % m for m in levels[1:]) or "0"
+        sums = "".join("SUM( eca * (sin(radians(alt))^%.7f) / sin(radians(alt)) )::float8 AS eca_g%d,\n                    " \
+                       % (gamma, k) for k, gamma in enumerate(self._gammas))
+        return """SELECT
+                    time::timestamp AS time,
+                    (%s)::int2 AS alt_level,
+                    SUM(teff)::float8 AS teff,
+                    SUM(eca)::float8 AS eca,
+                    %sSUM(met)::int8 AS met,
+                    COUNT(*)::int8 AS stations
+                 FROM metrecflux
+                 WHERE
+                     time >= '%s'::timestamp
+                     AND time <= '%s'::timestamp
+                     AND shower = '%s'
+                     AND eca IS NOT NULL
+                     AND alt >= %.7f
+                     AND eca > 0.50
+                     %s
+                 GROUP BY 1, 2
+                 ORDER BY 1, 2""" % (level, sums, \
+                                     pg.escape_string(str(self._begin)), \
+                                     pg.escape_string(str(self._end)), \
+                                     pg.escape_string(self._shower), \
+                                     levels[0], \
+                                     self._fluxdata._stationcond())
+
+    def _fetch(self):
+        with timing.Span("sweep.fetch") as span:
+            result = vmo.copy(self._sql(), columns(self._gammas))
+            span.rows = 0 if result is None else len(result)
+        return result
+
+    def getStatistics(self):
+        """ Sums per minute and altitude level, sorted by time (None if there is no data) """
+        if not hasattr(self, '_statistics'):
+            self._statistics = self._fetch()
+        return self._statistics
+
+
+    def aggregates(self):
+        """
+        Generator yielding (gamma, delta, min_alt, data) for all parameter sets,
+        where data holds the per-minute aggregates as returned by the query of
+        FluxData with these parameters. data is overwritten by the next set,
+        copy it to keep it.
+        """
+        stats = self.getStatistics()
+        if stats is None or len(stats) == 0:
+            return
+        levels = np.unique(self._min_alts)
+        for min_alt in self._min_alts:
+            rows = stats[stats['alt_level'] >= np.searchsorted(levels, min_alt)]
+            if len(rows) == 0:
+                continue
+            # First row of every minute
+            first = np.flatnonzero(np.concatenate(([True], rows['time'][1:] != rows['time'][:-1])))
+            data = np.zeros(len(first), dtype=_dtype(flux.FluxData._columns))
+            data['time'] = rows['time'][first]
+            data['teff'] = np.add.reduceat(rows['teff'], first)
+            data['met'] = np.add.reduceat(rows['met'], first)
+            data['stations'] = np.add.reduceat(rows['stations'], first)
+            eca = np.add.reduceat(rows['eca'], first)
+            for k, gamma in enumerate(self._gammas):
+                eca_gamma = np.add.reduceat(rows['eca_g%d' % k], first)
+                for delta in self._deltas:
+                    data['eca'] = delta*eca + (1.0-delta)*eca_gamma
+                    yield gamma, delta, min_alt, data
+
+
+    def _bins(self, data, **keywords):
+        """ Bin per-minute aggregates with FluxData """
+        params = dict(self._keywords)
+        params.update(keywords)
+        fd = flux.FluxData(self._shower, self._begin, self._end, **params)
+        fd._data = data
+        return fd.getBins()
+
+    def getBins(self):
+        """ Dict (gamma, delta, min_alt) -> bins, see FluxData.getBins() """
+        if not hasattr(self, '_sweep'):
+            with timing.Span("sweep.bin") as span:
+                # Only as many copies of the aggregates as there are processes
+                processes = self._processes or multiprocessing.cpu_count()
+                pool = multiprocessing.Pool(processes) if processes > 1 else None
+                try:
+                    self._sweep = {}
+                    keys, jobs = [], []
+                    for gamma, delta, min_alt, data in self.aggregates():
+                        keys.append( (gamma, delta, min_alt) )
+                        jobs.append( (self._shower, self._begin, self._end, self._keywords, data.copy()) )
+                        if len(jobs) == processes:
+                            self._sweep.update(zip(keys, flux.binParallel(jobs, 1, pool)))
+                            keys, jobs = [], []
+                    self._sweep.update(zip(keys, flux.binParallel(jobs, 1, pool)))
+                finally:
+                    if pool != None:
+                        pool.close()
+                        pool.join()
+                span.rows = len(self._sweep)
+        return self._sweep
+
+
+    def getCube(self, bin_length=1.0, min_meteors=0, min_eca=0):
+        """
+        Profiles on a common time axis, by fixed-width binning (hours).
+        Returns a dict with 'gamma', 'delta', 'min_alt', 'time' (middle of the
+        bins) and 'flux', 'e_flux', 'eca', 'met' as arrays of shape
+        (gammas, deltas, min_alts, bins). Bins which are dropped are NaN.
+        """
+        length = datetime.timedelta(hours=bin_length)
+        nbins = int(np.ceil((self._end-self._begin).total_seconds() / length.total_seconds()))
+        time = np.array([self._begin + length*k + length/2 for k in range(nbins)])
+        shape = (len(self._gammas), len(self._deltas), len(self._min_alts), nbins)
+        cube = {'gamma':self._gammas, 'delta':self._deltas, 'min_alt':self._min_alts, 'time':time}
+        for name in ['flux', 'e_flux', 'eca', 'met']:
+            cube[name] = np.empty(shape)
+            cube[name].fill(np.nan)
+
+        index = lambda values, v: int(np.flatnonzero(values == v)[0])
+        for gamma, delta, min_alt, data in self.aggregates():
+            bins = self._bins(data, bin_mode="fixed", min_interval=bin_length, \
+                              min_meteors=min_meteors, min_eca=min_eca)
+            if len(bins) == 0 or len(bins['time']) == 0:
+                continue
+            k = (np.array(bins['time'], dtype='datetime64[us]') - np.datetime64(self._begin, 'us')) \
+                // np.timedelta64(length)
+            keep = (k >= 0) & (k < nbins)
+            at = (index(self._gammas, gamma), index(self._deltas, delta), index(self._min_alts, min_alt))
+            for name in ['flux', 'e_flux', 'eca', 'met']:
+                cube[name][at][k[keep]] = bins[name][keep]
+        return cube
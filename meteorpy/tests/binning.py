@@ -0,0 +1,183 @@
+'''
+Tests for the vectorized binning algorithms
+'''
+import unittest
+import datetime
+import numpy as np
+from meteorpy import binning
+
+
+def reference_adaptive(times, teff, eca, met, begin, min_meteors, min_eca, min_interval, max_interval):
+    """ The original row-by-row adaptive binning of FluxData, used as reference """
+    bins_time, bins_teff, bins_eca, bins_met = [], [], [], []
+    current_bin_deltaseconds = []
+    current_bin_start = begin
+    current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
+    my_max_interval = round(max_interval, 6)
+    my_min_interval = round(min_interval, 6)
+    delta_max = datetime.timedelta(minutes=round(max_interval*60))
+    while (current_bin_start+delta_max) < times[0]:
+        current_bin_start += delta_max
+    for k in range(len(times)):
+        rowtime = times[k]
+        deltaseconds = (rowtime - current_bin_start).total_seconds()
+        deltahours = round(deltaseconds/3600.0, 6)
+        if (current_bin_met >= min_meteors or current_bin_eca >= (min_eca*1000.0) \
+            or deltahours >= my_max_interval) and (deltahours >= my_min_interval):
+            if len(current_bin_deltaseconds) > 0:
+                bins_time.append( current_bin_start+datetime.timedelta(seconds=np.mean(current_bin_deltaseconds)) )
+                bins_teff.append( current_bin_teff )
+                bins_eca.append( current_bin_eca )
+                bins_met.append( current_bin_met )
+            if (deltahours >= max_interval):
+                while (current_bin_start+delta_max) <= rowtime:
+                    current_bin_start += delta_max
+            else:
+                current_bin_start += datetime.timedelta(minutes=round(current_bin_deltaseconds[-1]/60.))
+            current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
+            current_bin_deltaseconds = []
+            deltaseconds = (rowtime - current_bin_start).total_seconds()
+        current_bin_deltaseconds.append( deltaseconds )
+        current_bin_teff += teff[k]
+        current_bin_eca += eca[k]
+        current_bin_met += met[k]
+    if current_bin_met > 5:
+        bins_time.append( current_bin_start+datetime.timedelta(seconds=np.mean(current_bin_deltaseconds)) )
+        bins_teff.append( current_bin_teff )
+        bins_eca.append( current_bin_eca )
+        bins_met.append( current_bin_met )
+    return bins_time, bins_teff, bins_eca, bins_met
+
+
+def reference_fixed(times, teff, eca, met, begin, bin_length, min_meteors, min_eca):
+    """ The original row-by-row fixed-width binning of FluxData, used as reference """
+    bins_time, bins_teff, bins_eca, bins_met = [], [], [], []
+    bin_length = datetime.timedelta(bin_length/24.)
+    current_bin_end = begin + bin_length
+    current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
+    for k in range(len(times)):
+        if (times[k] >= current_bin_end):
+            if (current_bin_met >= min_meteors and current_bin_eca >= (min_eca*1000.0) and current_bin_eca > 0):
+                bins_time.append( current_bin_end - bin_length/2 )
+                bins_teff.append( current_bin_teff )
+                bins_eca.append( current_bin_eca )
+                bins_met.append( current_bin_met )
+            current_bin_end += bin_length
+            current_bin_teff, current_bin_eca, current_bin_met = 0, 0, 0
+        current_bin_teff += teff[k]
+        current_bin_eca += eca[k]
+        current_bin_met += met[k]
+    if (current_bin_met >= min_meteors and current_bin_eca >= (min_eca*1000.0) and current_bin_eca > 0):
+        bins_time.append( current_bin_end - bin_length/2 )
+        bins_teff.append( current_bin_teff )
+        bins_eca.append( current_bin_eca )
+        bins_met.append( current_bin_met )
+    return bins_time, bins_teff, bins_eca, bins_met
+
+
+def synthetic(days, seed=1):
+    """ Per-minute rows with nightly gaps, shaped like a minor shower """
+    rng = np.random.RandomState(seed)
+    begin = datetime.datetime(2011, 8, 1)
+    minutes = np.arange(days*1440)
+    minutes = minutes[(minutes % 1440) < 480]
+    minutes = minutes[rng.uniform(size=len(minutes)) < 0.9]
+    times = np.datetime64(begin, 's') + (minutes*60).astype('timedelta64[s]')
+    eca = rng.uniform(0.5, 400.0, len(minutes))
+    met = rng.poisson(0.3, len(minutes))
+    teff = rng.randint(1, 20, len(minutes))
+    return begin, times, teff, eca, met
+
+
+class TestBinning(unittest.TestCase):
+
+    def compare(self, days, **params):
+        begin, times, teff, eca, met = synthetic(days)
+        expected = reference_adaptive(list(times.astype(datetime.datetime)), teff, eca, met, begin, **params)
+        result = binning.adaptive(times, teff, eca, met, begin, **params)
+        self.assertEqual(list(result[0]), expected[0])
+        np.testing.assert_allclose(result[1], expected[1])
+        np.testing.assert_allclose(result[2], expected[2])
+        np.testing.assert_array_equal(result[3], expected[3])
+
+    def testAdaptive(self):
+        self.compare(10, min_meteors=20, min_eca=100, min_interval=1.0, max_interval=24.0)
+
+    def testAdaptiveShortIntervals(self):
+        self.compare(3, min_meteors=5, min_eca=50, min_interval=0.2, max_interval=2.5)
+
+    def testAdaptiveFirstBinAlignment(self):
+        self.compare(6, min_meteors=40, min_eca=40, min_interval=0, max_interval=3.0)
+        self.compare(6, min_meteors=1000, min_eca=1e6, min_interval=0.5, max_interval=1.0)
+
+    def testAdaptiveUnlimited(self):
+        begin, times, teff, eca, met = synthetic(2)
+        result = binning.adaptive(times, teff, eca, met, begin, 40, 40, 0, 9e99)
+        assert( len(result[0]) > 0 )
+
+    def testChunks(self):
+        """ Feeding the data in chunks must not change the bins """
+        begin, times, teff, eca, met = synthetic(10)
+        for binner, params in [(binning.AdaptiveBinner, (20, 100, 1.0, 24.0)), \
+                               (binning.AdaptiveBinner, (5, 50, 0.2, 2.5)), \
+                               (binning.FixedBinner, (0.5, 5, 10))]:
+            expected = binner(begin, *params)
+            expected.add(times, teff, eca, met)
+            chunked = binner(begin, *params)
+            for i in range(0, len(times), 997):
+                chunked.add(times[i:i+997], teff[i:i+997], eca[i:i+997], met[i:i+997])
+            for a, b in zip(chunked.result(), expected.result()):
+                self.assertEqual(len(a), len(b))
+                assert( np.all(a == b) or np.allclose(a, b) )
+
+    def testTrace(self):
+        """ One trace record per bin, matching the bins """
+        begin, times, teff, eca, met = synthetic(10)
+        binner = binning.AdaptiveBinner(begin, 20, 100, 1.0, 24.0, trace=True)
+        for i in range(0, len(times), 997):
+            binner.add(times[i:i+997], teff[i:i+997], eca[i:i+997], met[i:i+997])
+        result = binner.result()
+        trace = binner.trace()
+        self.assertEqual(len(trace), len(result[0]))
+        np.testing.assert_array_equal(trace['met'], result[3])
+        np.testing.assert_allclose(trace['eca'], result[2])
+        assert( trace['rows'].sum() <= len(times) )
+        assert( np.all(trace['end'] > trace['start']) )
+        assert( set(trace['reason']) <= set(["meteors", "eca", "max_interval", "end"]) )
+        self.assertEqual(trace['reason'][-1], "end")
+        self.assertRaises(ValueError, binning.AdaptiveBinner(begin, 20, 100, 1.0, 24.0).trace)
+
+    def testFixed(self):
+        """ Without gaps the result must equal the original algorithm """
+        begin = datetime.datetime(2011, 8, 12)
+        times = np.datetime64(begin, 's') + (np.arange(1440)*60).astype('timedelta64[s]')
+        rng = np.random.RandomState(3)
+        teff, eca, met = rng.randint(1, 20, 1440), rng.uniform(0.5, 400.0, 1440), rng.poisson(0.5, 1440)
+        expected = reference_fixed(list(times.astype(datetime.datetime)), teff, eca, met, begin, 0.2, 5, 10)
+        result = binning.fixed(times, teff, eca, met, begin, 0.2, 5, 10)
+        self.assertEqual(list(result[0]), expected[0])
+        np.testing.assert_allclose(result[2], expected[2])
+        np.testing.assert_array_equal(result[3], expected[3])
+
+    def testFixedGaps(self):
+        """ Rows after a long gap must end up in the bin they belong to """
+        begin = datetime.datetime(2011, 8, 12)
+        times = np.array(['2011-08-12 00:10:00', '2011-08-12 05:30:00', '2011-08-12 05:50:00'], dtype='datetime64[s]')
+        result = binning.fixed(times, [10, 10, 10], [1000.0, 1000.0, 1000.0], [1, 2, 3], begin, 1.0, 0, 0)
+        self.assertEqual(list(result[0]), [datetime.datetime(2011, 8, 12, 0, 30), datetime.datetime(2011, 8, 12, 5, 30)])
+        self.assertEqual(list(result[3]), [1, 5])
+
+    def testFixedIndex(self):
+        """ Bin of every row in the result, -1 for dropped bins """
+        begin = datetime.datetime(2011, 8, 12)
+        times = np.array(['2011-08-12 00:10:00', '2011-08-12 02:30:00', '2011-08-12 05:30:00', \
+                          '2011-08-12 05:50:00'], dtype='datetime64[s]')
+        binner = binning.FixedBinner(begin, 1.0, 2, 0)
+        binner.add(times, [10]*4, [1000.0]*4, [1, 3, 1, 1])
+        self.assertEqual(list(binner.index(times)), [-1, 0, 1, 1])
+        self.assertEqual(len(binner.result()[0]), 2)
+        self.assertEqual(list(binning.FixedBinner(begin, 1.0, 2, 0).index(times)), [-1]*4)
+
+
+if __name__ == "__main__":
+    unittest.main()
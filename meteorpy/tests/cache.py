@@ -0,0 +1,160 @@
+'''
+Tests for the local cache of flux aggregates
+'''
+import unittest
+import tempfile
+import shutil
+import datetime
+import numpy as np
+from meteorpy import cache
+
+
+class TestAggregateCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._calls = []
+        times = np.datetime64('2011-08-10T00:00:00') + np.arange(5*1440).astype('timedelta64[m]')
+        self._all = np.zeros(len(times), dtype=[('time', 'datetime64[s]'), ('eca', 'f8')])
+        self._all['time'] = times
+        self._all['eca'] = np.arange(len(times))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def fetch(self, begin, end):
+        """ Stands in for vmo.chunks: the rows in [begin, end] in chunks of 1000 """
+        self._calls.append( (begin, end) )
+        t = self._all['time']
+        rows = self._all[(t >= np.datetime64(begin)) & (t <= np.datetime64(end))]
+        for k in range(0, len(rows), 1000):
+            self._fetched = k + 1000
+            yield rows[k:k+1000]
+
+    def rows(self, begin, end):
+        t = self._all['time']
+        return self._all[(t >= np.datetime64(begin)) & (t <= np.datetime64(end))]
+
+    def testLoad(self):
+        c = cache.AggregateCache(self._dir)
+        key = ('PER', 2.0, 0.0, 0.01, '')
+        begin, end = datetime.datetime(2011, 8, 11), datetime.datetime(2011, 8, 13, 23, 59, 59)
+        first = c.load(key, begin, end, self.fetch)
+        self.assertEqual(self._calls, [(begin, end)])
+        np.testing.assert_array_equal(first, self.rows(begin, end))
+        # Re-binning the same interval must not reach the database
+        second = c.load(key, begin, end, self.fetch)
+        self.assertEqual(len(self._calls), 1)
+        np.testing.assert_array_equal(first, second)
+        # Days which are only partly requested are fetched for that part only
+        begin, end = datetime.datetime(2011, 8, 11, 6), datetime.datetime(2011, 8, 14, 6)
+        np.testing.assert_array_equal(c.load(key, begin, end, self.fetch), self.rows(begin, end))
+        self.assertEqual(self._calls[1:], [(begin, datetime.datetime(2011, 8, 11, 23, 59, 59)), \
+                                           (datetime.datetime(2011, 8, 14), end)])
+        # Another zenith correction is a different entry
+        c.load(('PER', 1.5, 0.0, 0.01, ''), begin, end, self.fetch)
+        self.assertEqual(self._calls[-1], (begin, end))
+
+    def testStreaming(self):
+        """ Every day is passed on before the next one is fetched """
+        c = cache.AggregateCache(self._dir)
+        chunks = c.chunks(('PER', 2.0, 0.0, 0.01, ''), datetime.datetime(2011, 8, 10), \
+                          datetime.datetime(2011, 8, 14, 23, 59, 59), self.fetch)
+        day = chunks.next()
+        self.assertEqual(len(day), 1440)
+        assert( self._fetched <= 2000 )
+        self.assertEqual(sum(len(d) for d in chunks), 4*1440)
+
+    def testFetchDays(self):
+        """ Long runs of missing days are split into several queries """
+        c = cache.AggregateCache(self._dir, fetch_days=2)
+        data = c.load(('PER', 2.0, 0.0, 0.01, ''), datetime.datetime(2011, 8, 10), \
+                      datetime.datetime(2011, 8, 14, 23, 59, 59), self.fetch)
+        self.assertEqual(len(data), 5*1440)
+        self.assertEqual([b.day for b, e in self._calls], [10, 12, 14])
+
+    def testEviction(self):
+        c = cache.AggregateCache(self._dir, max_bytes=40000)
+        key = ('PER', 2.0, 0.0, 0.01, '')
+        c.load(key, datetime.datetime(2011, 8, 10), datetime.datetime(2011, 8, 14), self.fetch)
+        total = 0
+        import os
+        for root, dirs, names in os.walk(self._dir):
+            total += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+        assert( 0 < total <= 40000 )
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._renders = []
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def render(self, f, extension):
+        self._renders.append(extension)
+        f.write("x"*1000)
+
+    def testGet(self):
+        import os
+        c = cache.RenderCache(self._dir)
+        key = ('PER', '2011-08-10 00:00:00', '2011-08-14 00:00:00', 'adaptive', 20, 80)
+        name = c.get(key, "png", self.render)
+        self.assertEqual(c.get(key, "png", self.render), name)
+        self.assertEqual(self._renders, ["png"])
+        self.assertEqual(os.listdir(self._dir), [name])
+        # Another format or another parameter is another file
+        assert( c.get(key, "pdf", self.render) != name )
+        assert( c.get(key[:-1] + (300,), "png", self.render) != name )
+        self.assertEqual(len(self._renders), 3)
+
+    def testEviction(self):
+        import os
+        c = cache.RenderCache(self._dir, max_bytes=2500, min_minutes=0)
+        for i in range(5):
+            c.get(('PER', i), "png", self.render)
+        assert( len(os.listdir(self._dir)) <= 2 )
+
+    def testDefer(self):
+        import os
+        import numpy as np
+        specs = os.path.join(self._dir, "private")
+        c = cache.RenderCache(os.path.join(self._dir, "public"), spec_directory=specs)
+        key = ('PER', '2011-08-10 00:00:00', '2011-08-14 00:00:00', 'adaptive', 20, 300)
+        name = c.defer(key, "png", {'dpi':300}, {'met':np.arange(3)})
+        self.assertEqual(name, c.name(key, "png"))
+        self.assertEqual(os.listdir(self._dir), ["private"])
+        spec, arrays = c.spec(name)
+        self.assertEqual(spec, {'dpi':300})
+        np.testing.assert_array_equal(arrays['met'], np.arange(3))
+        self.assertEqual(c.spec("0123456789abcdef0123.png"), None)
+        self.assertEqual(c.getDeferred(name, self.render), name)
+        self.assertEqual(c.get(key, "png", self.render), name)
+        self.assertEqual(self._renders, ["png"])
+
+    def testOwnFiles(self):
+        import os
+        import time
+        # Files of others, and graphs a page has just linked, are never evicted
+        os.mkdir(os.path.join(self._dir, "specs"))
+        for name in ["index.html", os.path.join("specs", "0123456789abcdef0123.png.pickle")]:
+            with open(os.path.join(self._dir, name), "w") as f:
+                f.write("x"*10000)
+            os.utime(os.path.join(self._dir, name), (time.time()-86400, time.time()-86400))
+        c = cache.RenderCache(self._dir, max_bytes=2500)
+        names = [c.get(('PER', i), "png", self.render) for i in range(5)]
+        self.assertEqual(sorted(os.listdir(self._dir)), sorted(names + ["index.html", "specs"]))
+        # Graphs which are old enough are
+        old = os.path.join(self._dir, names[0])
+        os.utime(old, (time.time()-3600, time.time()-3600))
+        c.get(('PER', 5), "png", self.render)
+        assert( not os.path.exists(old) )
+        c.clear()
+        self.assertEqual(sorted(os.listdir(self._dir)), ["index.html", "specs"])
+        self.assertEqual(len(os.listdir(os.path.join(self._dir, "specs"))), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
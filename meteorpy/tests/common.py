@@ -4,6 +4,8 @@ Created on 6 Aug 2011
 @author: geert
 '''
 import unittest
+import datetime
+import numpy as np
 from meteorpy import common
 
 class Test(unittest.TestCase):
@@ -12,8 +14,31 @@ class Test(unittest.TestCase):
     def testZenithAttraction(self):
         print common.zenith_attaction(53, 20)
         
+    def testSollonArray(self):
+        """ The vectorized solar longitude must agree with the scalar version """
+        dates = [datetime.datetime(2011, 8, 12, 22, 30), datetime.datetime(2011, 12, 14, 3, 0), \
+                 datetime.datetime(2012, 3, 20, 5, 14), datetime.datetime(1999, 12, 31, 23, 59, 59)]
+        result = common.sollon(np.array(dates, dtype='datetime64[s]'))
+        for i in range(len(dates)):
+            self.assertAlmostEqual(result[i], common.sollon(dates[i]), places=9)
+        # Julian Days are accepted too
+        julian = np.array([common.jd(d) for d in dates])
+        np.testing.assert_allclose(common.sollon(julian), result, atol=1e-9)
+        
+    def testSollonInverse(self):
+        """ Solving for thousands of longitudes must be accurate to well below a second """
+        lon = np.linspace(0, 359.99, 3000)
+        julian = common.sollon2jd(lon, 2011)
+        diff = np.mod(common.sollon(julian) - lon + 180.0, 360.0) - 180.0
+        assert( np.max(np.abs(diff)) * 86400 / common._SOLLON_RATE < 0.1 )
+        # All solutions are found after January 1st of the requested year
+        assert( np.min(julian) >= common.jd(datetime.datetime(2011, 1, 1)) )
+        
+        d = common.sollon2datetime(140.0, 2011)
+        self.assertEqual((d.year, d.month, d.day), (2011, 8, 13))
+        
 
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testZenithAttraction']
-    unittest.main()
\ No newline at end of file
+    unittest.main()
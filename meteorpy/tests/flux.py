@@ -16,6 +16,186 @@ class TestFlux(unittest.TestCase):
     def testGraph(self):
         graph = flux.FluxGraph("PER", "2011-07-20 00:00:00", "2011-07-22 00:00:00")
         graph.saveHTML()
+    
+    def testDates(self):
+        """ ISO strings are accepted as well as datetime objects """
+        import datetime
+        fd = flux.FluxData("PER", "2011-07-20 00:00:00", "2011-07-20 00:10:00")
+        self.assertEqual((fd._begin, fd._end), (datetime.datetime(2011, 7, 20), datetime.datetime(2011, 7, 20, 0, 10)))
+    
+    def testColdYear(self):
+        """ A year which is not cached yet reaches the binning one day at a time """
+        import shutil
+        import tempfile
+        import datetime
+        import numpy as np
+        from meteorpy import cache, timing
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, cache, "default", cache.default)
+        cache.default = cache.AggregateCache(directory)
+
+        def fetch(begin, end):
+            times = np.arange(np.datetime64(begin, 'm'), np.datetime64(end, 'm')+1)
+            for k in range(0, len(times), 50000):
+                chunk = np.zeros(len(times[k:k+50000]), dtype=[('time', 'datetime64[s]'), ('teff', 'f8'), \
+                                 ('eca', 'f8'), ('met', 'i8'), ('stations', 'i8')])
+                chunk['time'], chunk['teff'], chunk['eca'], chunk['met'] = times[k:k+50000], 1.0, 100.0, 1
+                yield chunk
+
+        graph = flux.FluxGraph("PER", "2011-01-01 00:00:00", "2011-12-31 23:59:00", min_interval=24.0)
+        graph._fluxdata._fetchChunks = fetch
+        with timing.record() as spans:
+            bins = graph._fluxdata.getBins()
+        self.assertEqual(bins['met'].sum(), 365*1440)
+        self.assertEqual(max(s.rows for s in spans if s.name == "flux.bin" and s.rows != None), 1440)
+
+    def testFetchChunks(self):
+        """ Streamed aggregates are fetched with binary COPY, in windows which do not overlap """
+        import datetime
+        import numpy as np
+        windows = []
+
+        def fetch(begin, end):
+            windows.append((begin, end))
+            times = np.arange(np.datetime64(begin, 'm'), np.datetime64(end, 'm')+1)
+            result = np.zeros(len(times), dtype=[('time', 'datetime64[s]'), ('met', 'i8')])
+            result['time'] = times
+            return result
+
+        fd = flux.FluxData("PER", "2011-01-01 00:00:00", "2011-03-01 00:00:00")
+        fd._fetch = fetch
+        fd._chunksize = 10000
+        chunks = list(fd._fetchChunks(fd._begin, fd._end))
+        self.assertEqual(windows, [(datetime.datetime(2011, 1, 1), datetime.datetime(2011, 1, 31, 23, 59, 59)), \
+                                   (datetime.datetime(2011, 2, 1), datetime.datetime(2011, 3, 1))])
+        self.assertEqual(max(len(c) for c in chunks), 10000)
+        self.assertEqual(sum(len(c) for c in chunks), 59*1440+1)
+
+    def testTickLabels(self):
+        """ Batch labels must equal the labels of single ticks """
+        import datetime
+        import matplotlib.dates
+        graph = flux.FluxGraph("PER", "2011-08-10 00:00:00", "2011-08-14 00:00:00", popindex=2.0)
+        ticks = matplotlib.dates.date2num([datetime.datetime(2011, 8, 12, h) for h in range(0, 24, 6)])
+        self.assertEqual(graph.sollon_labels(ticks), ["138.81", "139.05", "139.29", "139.53"])
+        self.assertEqual(graph.zhr_labels([0.0, 1.8, 20.0]), ["0.0", "9.0", "100"])
+        formatter = flux.BatchFormatter(graph.sollon_labels, graph.sollon_precision)
+        formatter.set_locs(ticks)
+        self.assertEqual([formatter(t) for t in ticks], graph.sollon_labels(ticks))
+    
+    def testTables(self):
+        """ Machine-readable tables, without database """
+        import json
+        import datetime
+        graph = flux.FluxGraph("PER", "2011-08-10 00:00:00", "2011-08-14 00:00:00", popindex=2.0)
+        graph._fluxdata._setBins([datetime.datetime(2011, 8, 12, 1), datetime.datetime(2011, 8, 12, 3)], \
+                                 [60.0, 120.0], [5000.0, 8000.0], [10, 20])
+        rows = json.loads(graph.getFluxTable(format="json"))["rows"]
+        self.assertEqual([r["time"] for r in rows], ["2011-08-12 01:00", "2011-08-12 03:00"])
+        self.assertEqual([r["met"] for r in rows], [10, 20])
+        self.assertAlmostEqual(rows[1]["teff"], 2.0)
+        lines = graph.getFluxTable(format="csv").splitlines()
+        self.assertEqual(lines[0], "time,sollon,teff,eca,met,flux,e_flux,zhr")
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(graph.getFluxTable(format="html").count("<tr>"), 2)
+        self.assertRaises(ValueError, graph.getFluxTable, format="xml")
+
+        # Observers without metadata: the whole column is NULL (NaN)
+        import numpy as np
+        from meteorpy import vmo
+        graph._stationdata = vmo.rows2recarray([("ST001", None, None, 600.0, 5000.0, 10, None), \
+                                                ("ST002", None, None, 1200.0, 8000.0, 20, 3)], \
+                                               ['station', 'observer', 'country', 'teff', 'eca', 'met', 'spo'])
+        text = graph.getObserverTable(format="json")
+        assert( "NaN" not in text )
+        rows = json.loads(text)["rows"]
+        self.assertEqual([(r["station"], r["observer"], r["spo"]) for r in rows], [("ST001", None, 0), ("ST002", None, 3)])
+        self.assertEqual(graph.getObserverTable(format="csv").splitlines()[1], "ST001,,,10.0,5.0,10,0")
+        assert( "None" not in graph.getObserverTable(format="html") )
+        graph._stationdata = None
+        self.assertEqual(json.loads(graph.getObserverTable(format="json"))["rows"], [])
+        self.assertEqual(graph.getObserverTable(format="csv").splitlines(), ["station,observer,country,teff,eca,met,spo"])
+
+    def testTemplates(self):
+        """ Figures are reused, also when a graph is not closed, without keeping its y limits """
+        import gc
+        import datetime
+        import cStringIO
+        def render(bins):
+            graph = flux.FluxGraph("PER", "2011-08-10 00:00:00", "2011-08-14 00:00:00", popindex=2.0)
+            if bins:
+                graph._fluxdata._setBins([datetime.datetime(2011, 8, 12, 1)], [60.0], [5000.0], [1000])
+            else:
+                graph._fluxdata._bins = []
+            graph.savePlot(cStringIO.StringIO(), dpi=80, format="png")
+            return graph
+        with render(False) as graph:
+            fig, ylim = graph._fig, graph._template['ax'].get_ylim()
+        graph = render(True)
+        self.assertTrue(graph._fig is fig)
+        assert( graph._template['ax'].get_ylim() != ylim )
+        del graph
+        gc.collect()
+        graph = render(False)
+        self.assertTrue(graph._fig is fig)
+        self.assertEqual(graph._template['ax'].get_ylim(), ylim)
+        graph.close()
+
+    def testMultiShower(self):
+        """ Several showers from one query, on synthetic data """
+        import datetime
+        import numpy as np
+        from numpy.lib import recfunctions
+        from meteorpy.benchmarks import synthetic
+        begin = datetime.datetime(2011, 8, 11)
+        end = begin + datetime.timedelta(days=2)
+        showers = ["PER", "GEM"]
+        parts = [synthetic.aggregate(synthetic.raw(s, begin, 2, stations=5, seed=i)) for i, s in enumerate(showers)]
+        rows = np.concatenate([recfunctions.append_fields(p, 'shower', np.repeat(i, len(p)).astype(np.int16), \
+                                                          usemask=False) for i, p in enumerate(parts)])
+        multi = flux.MultiFluxData(showers, begin, end, processes=1, rollup=False, min_meteors=10)
+        assert( "shower IN ('PER', 'GEM')" in multi._sql() )
+        multi._fetch = lambda begin, end: rows
+        for shower, part in zip(showers, parts):
+            # Views on the result of the query
+            assert( np.may_share_memory(multi.getData(shower), rows) )
+            single = flux.FluxData(shower, begin, end, min_meteors=10)
+            single._data = part
+            np.testing.assert_array_equal(multi.getBins(shower)['flux'], single.getBins()['flux'])
+        self.assertEqual(sorted(multi.getBins().keys()), ["GEM", "PER"])
+
+    def testStations(self):
+        """ Several stations, and their contribution to every bin, on synthetic data """
+        import datetime
+        import numpy as np
+        from meteorpy.benchmarks import synthetic
+        fd = flux.FluxData("PER", None, None, stations=" st000,ST001 ,, o'st")
+        self.assertEqual(fd.getStations(), ["ST000", "ST001", "O'ST"])
+        self.assertEqual(fd._stationcond().strip(), "AND UPPER(station) IN ('ST000', 'ST001', 'O''ST')")
+        self.assertEqual(flux.FluxData("PER", None, None)._stationcond(), "")
+
+        begin = datetime.datetime(2011, 8, 11)
+        raw = synthetic.raw("PER", begin, 3, stations=4)
+        parts = []
+        for code in np.unique(raw['station']):
+            part = synthetic.aggregate(raw[raw['station'] == code])
+            rows = np.zeros(len(part), dtype=[('station', 'S8')] + part.dtype.descr)
+            for name in part.dtype.names:
+                rows[name] = part[name]
+            rows['station'] = code
+            parts.append(rows)
+        data = np.concatenate(parts)
+        for keywords in [{}, {"bin_mode": "fixed", "min_interval": 1.0}, {"bin_mode": "fixed", "min_interval": 0.35}]:
+            fd = flux.FluxData("PER", begin, begin + datetime.timedelta(days=3), min_meteors=20, **keywords)
+            fd._fetchStations = lambda: data
+            matrix = fd.getStationMatrix()
+            fd._data = synthetic.aggregate(raw)
+            bins = fd.getBins()
+            self.assertEqual(matrix['flux'].shape, (4, len(bins['time'])))
+            np.testing.assert_array_equal(matrix['met'].sum(axis=0), bins['met'])
+            np.testing.assert_allclose(matrix['eca'].sum(axis=0), bins['eca'])
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.dataTest', 'Test.graphTest']
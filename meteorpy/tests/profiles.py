@@ -0,0 +1,61 @@
+'''
+Tests for the multi-year profiles, on synthetic data
+'''
+import unittest
+import datetime
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from meteorpy import profiles
+from meteorpy.benchmarks import synthetic
+
+
+class TestProfiles(unittest.TestCase):
+
+    def stack(self, years, **keywords):
+        stack = profiles.StackedProfiles("PER", 138.0, 142.0, years, step=0.1, processes=1, \
+                                         min_meteors=20, min_interval=0.5, **keywords)
+        data = [synthetic.aggregate(synthetic.raw("PER", begin, 6, stations=10, seed=begin.year)) \
+                for begin, end in stack.getIntervals()]
+        stack._fetch = lambda: np.concatenate(data)
+        return stack
+
+    def testIntervals(self):
+        stack = self.stack([2011, 2012])
+        (b1, e1), (b2, e2) = stack.getIntervals()
+        self.assertEqual(b1.strftime("%Y-%m-%d"), "2011-08-11")
+        self.assertEqual(b2.strftime("%Y-%m-%d"), "2012-08-10")
+        assert( datetime.timedelta(days=3.9) < e1-b1 < datetime.timedelta(days=4.2) )
+        # Intervals passing 360 degrees end in the next year
+        b, e = profiles.StackedProfiles("QUA", 270.0, 290.0, [2011]).getIntervals()[0]
+        self.assertEqual((b.year, e.year), (2011, 2012))
+
+    def testProfiles(self):
+        stack = self.stack([2011, 2012, 2013])
+        bins = stack.getBins()
+        self.assertEqual(len(bins), 3)
+        for b in bins:
+            assert( np.all((b['sollon'] >= 138.0) & (b['sollon'] <= 142.0)) )
+        p = stack.getProfiles()
+        self.assertEqual(sorted(p.keys()), ['e_flux', 'flux', 'met', 'sollon', 'years', 'zhr'])
+        for name in ['flux', 'e_flux', 'zhr', 'met']:
+            self.assertEqual(p[name].shape, (3, 41))
+        # Meteor counts of the bins, where the flux is known
+        valid = ~np.isnan(p['flux'])
+        np.testing.assert_array_equal(np.isnan(p['met']), ~valid)
+        for k, b in enumerate(bins):
+            assert( np.all(np.in1d(p['met'][k, valid[k]], b['met'])) )
+        # The peak of the synthetic profile is at 140 degrees
+        sollon, mean, error = stack.getMeanProfile()
+        assert( abs(sollon[np.nanargmax(mean)] - 140.0) < 1.0 )
+
+    def testParallel(self):
+        serial = self.stack([2011, 2012]).getProfiles()
+        stack = self.stack([2011, 2012])
+        stack._processes = 2
+        parallel = stack.getProfiles()
+        np.testing.assert_array_equal(serial['flux'], parallel['flux'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Tests for the per-minute rollup of metrecflux
+'''
+import unittest
+import datetime
+import numpy as np
+from meteorpy import rollup
+
+class TestRollup(unittest.TestCase):
+
+    def testCovers(self):
+        assert( rollup.covers(2.0, 0.01, "") )
+        assert( rollup.covers(1.5, 20, "") )
+        assert( not rollup.covers(1.9, 0.01, "") )
+        assert( not rollup.covers(2.0, 12.5, "") )
+        assert( not rollup.covers(2.0, 0.01, "BEMKA") )
+
+    def testSql(self):
+        sql = rollup.sql("PER", "2011-08-12 00:00:00", "2011-08-14 00:00:00", 2.0, 0.25, 20)
+        assert( "SUM(eca_g200)" in sql )
+        assert( "alt_bucket >= 20" in sql )
+
+
+
+class TestRefresh(unittest.TestCase):
+    """ Refresh of the rollup on a snapshot of synthetic data, in SQLite """
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        from numpy.lib import recfunctions
+        from meteorpy import vmo
+        from meteorpy.benchmarks import synthetic
+        self.begin = datetime.datetime(2011, 8, 11)
+        self.end = self.begin + datetime.timedelta(days=3)
+        raw = synthetic.raw("PER", self.begin, 3, stations=4)
+        # One MetRec file per station and night
+        night = (raw['time'] - np.datetime64(self.begin, 's') + np.timedelta64(12, 'h')) // np.timedelta64(1, 'D')
+        filename = np.array(["%s_%d.log" % (s, n) for s, n in zip(raw['station'], night)])
+        raw = recfunctions.append_fields(raw, 'filename', filename, usemask=False)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        np.save(os.path.join(directory, "metrecflux.npy"), raw)
+        self.conn = vmo.LocalVMO(directory)
+        self.addCleanup(self.conn.close)
+        rollup.create(self.conn)
+
+    def assertTotals(self):
+        from meteorpy import flux
+        for gamma, delta, min_alt in [(1.0, 0.0, 0.01), (2.0, 0.3, 0.01), (2.0, 0.0, 20)]:
+            fd = flux.FluxData("PER", self.begin, self.end, gamma=gamma, delta=delta, min_alt=min_alt, rollup=False)
+            expected = self.conn.sql2recarray(fd._sql(self.begin, self.end))
+            result = self.conn.sql2recarray(rollup.sql("PER", self.begin, self.end, gamma, delta, min_alt))
+            np.testing.assert_array_equal(result['time'], expected['time'])
+            np.testing.assert_array_equal(result['met'], expected['met'])
+            np.testing.assert_allclose(result['eca'], expected['eca'])
+
+    def testRefresh(self):
+        files = self.conn.sql2recarray("SELECT DISTINCT filename FROM metrecflux ORDER BY filename")['filename']
+        self.assertEqual(rollup.refresh(self.conn, batch=3), len(files))
+        self.assertTotals()
+        self.assertEqual(rollup.refresh(self.conn, batch=3), 0)
+        # A file is corrected, another one is removed and a new one is ingested
+        self.conn.query("UPDATE metrecflux SET met = met + 1 WHERE filename = '%s'" % files[0])
+        self.conn.query("DELETE FROM metrecflux WHERE filename = '%s'" % files[1])
+        self.conn.query("""INSERT INTO metrecflux (time, station, shower, teff, eca, alt, met, filename)
+                           SELECT time, 'NEW', shower, teff, eca, alt, met, 'new.log'
+                           FROM metrecflux WHERE filename = '%s'""" % files[2])
+        self.assertEqual(rollup.refresh(self.conn, batch=3), 3)
+        self.assertTotals()
+        self.assertEqual(rollup.refresh(self.conn), 0)
+        # Same as a rollup of all files at once
+        total = self.conn.sql2recarray("SELECT SUM(met) AS met FROM %s" % rollup.TABLE)['met'][0]
+        rollup.rebuild(self.conn)
+        self.assertEqual(self.conn.sql2recarray("SELECT SUM(met) AS met FROM %s" % rollup.TABLE)['met'][0], total)
+
+    def testNullFilename(self):
+        """ Rows without a filename are in the rollup, like in the raw query """
+        self.conn.query("""UPDATE metrecflux SET filename = NULL
+                           WHERE rowid IN (SELECT rowid FROM metrecflux WHERE met > 0 LIMIT 10)""")
+        rollup.refresh(self.conn)
+        self.assertTotals()
+        self.conn.query("""INSERT INTO metrecflux (time, station, shower, teff, eca, alt, met, filename)
+                           SELECT time, 'NEW', shower, teff, eca, alt, met, NULL
+                           FROM metrecflux WHERE filename IS NULL""")
+        self.assertEqual(rollup.refresh(self.conn), 1)
+        self.assertTotals()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+'''
+Tests for the request handling of the flux service
+'''
+import unittest
+from meteorpy import service
+
+
+class TestService(unittest.TestCase):
+
+    def call(self, path, query=""):
+        status = []
+        app = service.FluxService("/tmp")
+        body = app({"PATH_INFO": path, "QUERY_STRING": query}, lambda s, headers: status.append(s))
+        return status[0], "".join(body)
+
+    def testParse(self):
+        shower, begin, end, output, keywords = service.FluxService.parse( \
+            "shower=PER&begin_iso=2011-08-10&end=2011-08-14&min_meteors=30&ymax=&output=graph")
+        self.assertEqual((shower, begin, end, output), ("PER", "2011-08-10", "2011-08-14", "graph"))
+        self.assertEqual(keywords["min_meteors"], 30)
+        self.assertEqual(keywords["ymax"], None)
+        self.assertEqual(keywords["gamma"], 1.0)
+
+    def testBadRequest(self):
+        status, body = self.call("/flux", "shower=PER&begin=2011-08-10")
+        self.assertEqual(status, "400 Bad Request")
+        status, body = self.call("/flux", "shower=PER&begin=2011-08-10&end=2011-08-14&gamma=x")
+        self.assertEqual(status, "400 Bad Request")
+        assert( "gamma" in body )
+
+    def testDeferred(self):
+        """ High-resolution graphs are only rendered when requested """
+        import os, re, shutil, tempfile, cStringIO
+        from meteorpy import flux
+        plotdir = tempfile.mkdtemp()
+        try:
+            page = flux.FluxPage("PER", "2011-08-10T00:00:00", "2011-08-14T00:00:00", popindex=2.0)
+            page._fluxgraph._fluxdata._bins = []
+            page._fluxgraph._stationdata = []
+            html = cStringIO.StringIO()
+            page.printHTML("full", plotdir, stream=html, url="/tmp", lazy=True)
+            page.close()
+            names = re.findall("/tmp/([0-9a-f]+\.[a-z]+)", html.getvalue())
+            self.assertEqual(len(names), 3)
+            # The specs are not published
+            self.assertEqual(os.listdir(plotdir), [names[0]])
+
+            status = []
+            app = service.FluxService(plotdir, "/tmp")
+            body = app({"PATH_INFO": "/tmp/" + names[1]}, lambda s, headers: status.append(s))
+            self.assertEqual(status, ["200 OK"])
+            assert( "".join(body).startswith("%PDF") )
+        finally:
+            shutil.rmtree(plotdir)
+
+    def testEager(self):
+        """ High-resolution graphs are rendered by the pool before the page is complete """
+        import os, re, shutil, tempfile, cStringIO
+        from meteorpy import flux
+        plotdir = tempfile.mkdtemp()
+        try:
+            page = flux.FluxPage("PER", "2011-08-10T00:00:00", "2011-08-14T00:00:00", popindex=2.0)
+            page._fluxgraph._fluxdata._bins = []
+            page._fluxgraph._stationdata = []
+            html = cStringIO.StringIO()
+            page.printHTML("full", plotdir, stream=html, url="/tmp", lazy=False)
+            page.close()
+            names = re.findall("/tmp/([0-9a-f]+\.[a-z]+)", html.getvalue())
+            self.assertEqual(sorted(os.listdir(plotdir)), sorted(names))
+            pool = flux.renderers()
+            self.assertTrue(flux.renderers() is pool)
+        finally:
+            shutil.rmtree(plotdir)
+
+    def testNotFound(self):
+        self.assertEqual(self.call("/other")[0], "404 Not Found")
+        self.assertEqual(self.call("/tmp/../etc/passwd")[0], "404 Not Found")
+
+
+if __name__ == "__main__":
+    unittest.main()
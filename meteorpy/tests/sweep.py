@@ -0,0 +1,83 @@
+'''
+Tests for the parameter sweeps, on synthetic data
+'''
+import unittest
+import datetime
+import numpy as np
+from meteorpy import sweep
+from meteorpy.benchmarks import synthetic
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.begin = datetime.datetime(2011, 8, 11)
+        self.end = self.begin + datetime.timedelta(days=3)
+        self.raw = synthetic.raw("PER", self.begin, 3, stations=10)
+
+    def sweep(self, gammas, deltas, min_alts, **keywords):
+        s = sweep.ParameterSweep("PER", self.begin, self.end, gammas, deltas, min_alts, \
+                                 processes=1, min_meteors=20, min_interval=0.5, **keywords)
+        s._fetch = lambda: sweep.statistics(self.raw, s._gammas, s._min_alts)
+        return s
+
+    def testAggregates(self):
+        s = self.sweep([1.0, 1.5, 2.0], [0.0, 0.3], [0.01, 20.0, 35.37])
+        count = 0
+        for gamma, delta, min_alt, data in s.aggregates():
+            expected = synthetic.aggregate(self.raw, gamma, delta, min_alt)
+            np.testing.assert_array_equal(data['time'], expected['time'])
+            np.testing.assert_array_equal(data['met'], expected['met'])
+            np.testing.assert_array_equal(data['stations'], expected['stations'])
+            np.testing.assert_allclose(data['eca'], expected['eca'], rtol=1e-9)
+            count += 1
+        self.assertEqual(count, 18)
+
+    def testFluxData(self):
+        """ Same aggregates as the query of FluxData, on a snapshot in SQLite """
+        import os
+        import shutil
+        import tempfile
+        import ConfigParser
+        from meteorpy import vmo, flux
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        np.save(os.path.join(directory, "metrecflux.npy"), self.raw)
+        c = ConfigParser.ConfigParser()
+        c.add_section("DB")
+        c.set("DB", "backend", "sqlite")
+        c.set("DB", "path", directory)
+        self.addCleanup(setattr, vmo, "default", vmo.default)
+        self.addCleanup(setattr, vmo, "_config", vmo._config)
+        vmo._config, vmo.default = c, None
+        self.addCleanup(lambda: vmo.default and vmo.default.close())
+
+        s = sweep.ParameterSweep("PER", self.begin, self.end, [1.7], [0.25], [0.01, 27.5])
+        data = [d.copy() for gamma, delta, min_alt, d in s.aggregates()]
+        for d, min_alt in zip(data, [0.01, 27.5]):
+            expected = flux.FluxData("PER", self.begin, self.end, gamma=1.7, delta=0.25, min_alt=min_alt, \
+                                     cache=False, rollup=False).getData()
+            np.testing.assert_array_equal(d['time'], expected['time'])
+            np.testing.assert_array_equal(d['met'], expected['met'])
+            np.testing.assert_array_equal(d['stations'], expected['stations'])
+            np.testing.assert_allclose(d['eca'], expected['eca'], rtol=1e-9)
+
+    def testBins(self):
+        bins = self.sweep([1.0, 2.0], [0.0], [0.01]).getBins()
+        self.assertEqual(sorted(bins.keys()), [(1.0, 0.0, 0.01), (2.0, 0.0, 0.01)])
+        # The zenith correction reduces the ECA, so the flux is higher
+        assert( np.sum(bins[(2.0, 0.0, 0.01)]['eca']) < np.sum(bins[(1.0, 0.0, 0.01)]['eca']) )
+
+    def testCube(self):
+        cube = self.sweep([1.0, 1.5, 2.0], [0.0, 0.5], [0.01, 10.0, 30.0]).getCube(bin_length=2.0)
+        self.assertEqual(cube['flux'].shape, (3, 2, 3, 36))
+        self.assertEqual(len(cube['time']), 36)
+        self.assertEqual(cube['time'][0], self.begin + datetime.timedelta(hours=1))
+        # Nights have data, the days in between do not
+        assert( np.any(np.isfinite(cube['flux'])) and np.any(np.isnan(cube['flux'])) )
+        # gamma = 1 does not depend on delta
+        np.testing.assert_allclose(cube['flux'][0, 0], cube['flux'][0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+'''
+Tests for the timing of the stages behind a flux page
+'''
+import unittest
+import threading
+from meteorpy import timing
+
+
+class TestTiming(unittest.TestCase):
+
+    def testRecord(self):
+        with timing.Span("outside"):
+            pass
+        with timing.record() as spans:
+            with timing.Span("a", rows=10):
+                pass
+            with timing.Span("a") as span:
+                span.rows = 5
+                span.bytes = 100
+            def work():
+                with timing.Span("b"):
+                    pass
+            # Only threads working for this one are recorded
+            for target in [work, timing.wrap(work)]:
+                thread = threading.Thread(target=target)
+                thread.start()
+                thread.join()
+        self.assertEqual([s.name for s in spans], ["a", "a", "b"])
+        totals = timing.totals(spans)
+        self.assertEqual([t[0] for t in totals], ["a", "b"])
+        self.assertEqual(totals[0][1], 2)
+        self.assertEqual(totals[0][3:], (15, 100))
+        self.assertEqual(totals[1][3:], (None, None))
+        assert( "<td>a</td><td>2</td>" in timing.html(spans) )
+
+    def testThreads(self):
+        """ Concurrent requests do not record each other """
+        started = threading.Event()
+        recorded = []
+        def request():
+            with timing.record() as spans:
+                started.wait()
+                with timing.Span("other"):
+                    pass
+            recorded.append(spans)
+        thread = threading.Thread(target=request)
+        thread.start()
+        with timing.record() as spans:
+            with timing.Span("mine"):
+                started.set()
+                thread.join()
+            # Spans of a child process
+            timing.merge([timing.Span("child")])
+        self.assertEqual([s.name for s in spans], ["mine", "child"])
+        self.assertEqual([s.name for s in recorded[0]], ["other"])
+
+    def testSinks(self):
+        received = []
+        def failing(span):
+            raise Exception("Metrics server down")
+        timing.sinks.extend([received.append, failing])
+        try:
+            with timing.Span("c"):
+                pass
+        finally:
+            del timing.sinks[:]
+        self.assertEqual([s.name for s in received], ["c"])
+        assert( received[0].duration >= 0 )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,235 @@
+'''
+Tests for the conversion of VMO query results
+'''
+import unittest
+import threading
+import struct
+import datetime
+import decimal
+import numpy as np
+from meteorpy import vmo
+
+class TestVMO(unittest.TestCase):
+
+    def testRows2recarray(self):
+        rows = [('2011-08-12 23:59:00', 12.5, decimal.Decimal('3'), 4L, 'BEMKA'), \
+                ('2011-08-13 00:00:00', 7.25, decimal.Decimal('1'), 2L, 'AVIS2')]
+        result = vmo.rows2recarray(rows, ['time', 'teff', 'eca', 'met', 'station'])
+        self.assertEqual(result.dtype['time'], np.dtype('datetime64[s]'))
+        self.assertEqual(result.dtype['eca'], np.dtype(np.float64))
+        self.assertEqual(result.dtype['met'], np.dtype(np.int64))
+        self.assertEqual(result.dtype['station'], np.dtype('S5'))
+        self.assertEqual(result['time'][1].astype(datetime.datetime), datetime.datetime(2011, 8, 13))
+        self.assertEqual(result.itemsize, 8+8+8+8+5)
+
+    def testNullValues(self):
+        result = vmo.rows2recarray([(None, None, 'x'), (datetime.datetime(2011, 8, 13), 1L, None)], ['time', 'n', 's'])
+        assert( np.isnat(result['time'][0]) )
+        assert( np.isnan(result['n'][0]) )
+        self.assertEqual(result['s'][1], '')
+
+    def testDeclaredTypes(self):
+        """ The declared column types give the dtypes, not the Python values """
+        rows = [('2011-08-13 00:00:00', 12.5, 3, 4L), ('2011-08-13 00:01:00', None, 1, 2L)]
+        columns = [('time', 'timestamp'), ('eca', 'float4'), ('alt', 'int2'), ('met', 'int8')]
+        result = vmo.rows2recarray(rows, [name for name, pgtype in columns], columns)
+        self.assertEqual([result.dtype[name] for name, pgtype in columns], \
+                         [np.dtype('datetime64[s]'), np.dtype(np.float32), np.dtype(np.int16), np.dtype(np.int64)])
+        assert( np.isnan(result['eca'][1]) )
+        self.assertEqual(list(result['alt']), [3, 1])
+        # NULL values in integer columns
+        result = vmo.rows2recarray([(None,), (5,)], ['alt'], [('alt', 'int2')])
+        assert( np.isnan(result['alt'][0]) )
+
+    def testEmpty(self):
+        self.assertEqual(vmo.rows2recarray([], ['time']), None)
+
+    def testBinaryCopy(self):
+        columns = [('time', 'timestamp'), ('eca', 'float8'), ('met', 'int8')]
+        # 2011-08-13 00:00:00 and 00:01:00, counted in microseconds from 2000-01-01
+        t0 = (datetime.datetime(2011, 8, 13) - datetime.datetime(2000, 1, 1)).total_seconds()*1000000
+        rows = [(t0, 12.5, 3), (t0+60e6, 7.25, 1)]
+        data = vmo._BINARY_SIGNATURE + struct.pack(">ii", 0, 0)
+        for t, eca, met in rows:
+            data += struct.pack(">hiqidiq", 3, 8, t, 8, eca, 8, met)
+        result = vmo.decode_binary_copy(data + struct.pack(">h", -1), columns)
+        np.testing.assert_array_equal(vmo.decode_binary_copy(bytearray(data + struct.pack(">h", -1)), columns), result)
+        self.assertEqual(list(result['time'].astype(datetime.datetime)), \
+                         [datetime.datetime(2011, 8, 13), datetime.datetime(2011, 8, 13, 0, 1)])
+        self.assertEqual(list(result['eca']), [12.5, 7.25])
+        self.assertEqual(result.dtype['met'], np.dtype(np.int64))
+        
+        # NULL values take the slow path
+        data = vmo._BINARY_SIGNATURE + struct.pack(">ii", 0, 0) + struct.pack(">hiqidi", 3, 8, t0, 8, 2.0, -1) \
+               + struct.pack(">hiqidiq", 3, 8, t0, 8, 3.0, 8, 5) + struct.pack(">h", -1)
+        result = vmo.decode_binary_copy(data, columns)
+        assert( np.isnan(result['met'][0]) )
+        self.assertEqual(result['met'][1], 5)
+        # The buffer filled by copy2recarray
+        decoded = vmo.decode_binary_copy(bytearray(data), columns)
+        np.testing.assert_array_equal(decoded['eca'], result['eca'])
+        self.assertEqual(decoded['met'][1], 5)
+
+    def testBinaryCopySupport(self):
+        class Source(object):
+            pass
+        class Driver(object):
+            def source(self):
+                return self.src
+        db = Driver()
+        db.src = Source()
+        conn = vmo.VMO(connect=False)
+        conn.db = db
+        # Old source objects without getdata fall back to text rows
+        self.assertFalse(conn.supports_binary_copy())
+        db.src.getdata = lambda decode: -1
+        self.assertTrue(conn.supports_binary_copy())
+
+
+class DummyConnection(object):
+    """ Stands in for a VMO connection, counting how many are opened """
+    opened = 0
+    def __init__(self):
+        DummyConnection.opened += 1
+        self.lastused = 0
+    def ping(self):
+        return True
+    def sql2recarray(self, sql, columns=None):
+        return sql
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self._vmo = vmo.VMO
+        vmo.VMO = DummyConnection
+        DummyConnection.opened = 0
+
+    def tearDown(self):
+        vmo.VMO = self._vmo
+
+    def testReuse(self):
+        pool = vmo.Pool(size=2)
+        for i in range(10):
+            self.assertEqual(pool.sql2recarray("SELECT %d" % i), "SELECT %d" % i)
+        self.assertEqual(DummyConnection.opened, 1)
+
+    def testSize(self):
+        pool = vmo.Pool(size=2, timeout=0.05)
+        a, b = pool.acquire(), pool.acquire()
+        self.assertRaises(Exception, pool.acquire)
+        pool.release(a)
+        self.assertTrue(pool.acquire() is a)
+
+    def testThreads(self):
+        pool = vmo.Pool(size=3)
+        def work():
+            for i in range(50):
+                pool.sql2recarray("SELECT 1")
+        threads = [threading.Thread(target=work) for i in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert( DummyConnection.opened <= 3 )
+
+
+class TestLocalVMO(unittest.TestCase):
+    """ The queries of the package on a snapshot of synthetic data """
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import ConfigParser
+        from meteorpy.benchmarks import synthetic
+        self.begin = datetime.datetime(2011, 8, 11)
+        self.end = self.begin + datetime.timedelta(days=2)
+        self.raw = np.concatenate([synthetic.raw("PER", self.begin, 2, stations=4), \
+                                   synthetic.raw("QUA", self.begin, 2, stations=4, seed=1)])
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        np.save(os.path.join(self.directory, "metrecflux.npy"), self.raw)
+        c = ConfigParser.ConfigParser()
+        c.add_section("DB")
+        c.set("DB", "backend", "sqlite")
+        c.set("DB", "path", self.directory)
+        self._config, self._default = vmo._config, vmo.default
+        vmo._config, vmo.default = c, None
+
+    def tearDown(self):
+        pool = vmo.default
+        vmo._config, vmo.default = self._config, self._default
+        if pool != None:
+            pool.close()
+
+    def testFlux(self):
+        from meteorpy import flux
+        from meteorpy.benchmarks import synthetic
+        self.assertTrue(isinstance(vmo.pool().acquire(), vmo.LocalVMO))
+        per = self.raw[self.raw['shower'] == "PER"]
+        expected = synthetic.aggregate(per, gamma=2.0)
+        fd = flux.FluxData("PER", self.begin, self.end, cache=False, rollup=False)
+        data = fd.getData()
+        self.assertEqual(data.dtype, np.dtype(synthetic.AGGREGATE_DTYPE))
+        np.testing.assert_array_equal(data['time'], expected['time'])
+        np.testing.assert_array_equal(data['met'], expected['met'])
+        np.testing.assert_allclose(data['eca'], expected['eca'])
+        # Streamed in chunks
+        fd = flux.FluxData("PER", self.begin, self.end, cache=False, rollup=False, chunksize=500)
+        np.testing.assert_array_equal(fd.getBins()['met'], \
+                                      flux.FluxData("PER", self.begin, self.end, cache=False, rollup=False).getBins()['met'])
+        # Several showers and stations
+        multi = flux.MultiFluxData(["PER", "QUA"], self.begin, self.end, rollup=False, processes=1)
+        np.testing.assert_array_equal(multi.getData("PER")['met'], expected['met'])
+        fd = flux.FluxData("PER", self.begin, self.end, stations="st000,ST001", cache=False, rollup=False)
+        matrix = fd.getStationMatrix()
+        self.assertEqual(list(matrix['stations']), ["ST000", "ST001"])
+        np.testing.assert_array_equal(matrix['met'].sum(axis=0), fd.getBins()['met'])
+
+    def testCopyTypes(self):
+        """ copy2recarray keeps the width of the declared column types """
+        with vmo.pool().connection() as conn:
+            result = conn.copy2recarray("SELECT time, eca, alt::int2 AS alt FROM metrecflux LIMIT 5", \
+                                        [('time', 'timestamp'), ('eca', 'float4'), ('alt', 'int2')])
+        self.assertEqual(result.dtype, np.dtype([('time', 'datetime64[s]'), ('eca', np.float32), ('alt', np.int16)]))
+
+    def testObservers(self):
+        import json
+        from meteorpy import flux
+        graph = flux.FluxGraph("PER", str(self.begin), str(self.end), rollup=False)
+        rows = json.loads(graph.getObserverTable(format="json"))["rows"]
+        per = self.raw[self.raw['shower'] == "PER"]
+        self.assertEqual([r["station"] for r in rows], list(np.unique(per['station'])))
+        self.assertEqual(sum(r["met"] for r in rows), per['met'].sum())
+
+    def testSnapshot(self):
+        """ The snapshot is loaded once, into a file shared by the connections """
+        import os
+        from meteorpy import cache
+        a, b = vmo.LocalVMO(self.directory), vmo.LocalVMO(self.directory)
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        a.query("CREATE TABLE x (v int)")
+        a.query("INSERT INTO x VALUES (1)")
+        self.assertEqual(b.sql2recarray("SELECT v FROM x")['v'][0], 1)
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith(".sqlite")]), 1)
+        # Aggregates of the snapshot and of the server are cached apart
+        key = ("PER", 1.0, 0.0, 0.01, "")
+        local = cache.AggregateCache(self.directory)._path(key, "2011-08-11")
+        c, vmo._config = vmo._config, self._config
+        try:
+            assert( cache.AggregateCache(self.directory)._path(key, "2011-08-11") != local )
+        finally:
+            vmo._config = c
+
+    def testTranslate(self):
+        self.assertEqual(vmo.translate("SUM(eca * sin(radians(alt))^%.7f)::float8 AS eca" % 0.5), \
+                         "SUM(eca * power(sin(radians(alt)), 0.5000000)) AS eca")
+        self.assertEqual(vmo.translate("SELECT x ^ 2, '2011-08-12'::timestamp"), "SELECT power(x, 2), '2011-08-12'")
+        # Quoted text is left alone
+        self.assertEqual(vmo.translate("SELECT 'a^b::text', x^2 FROM t WHERE station = 'O''ST::1'"), \
+                         "SELECT 'a^b::text', power(x, 2) FROM t WHERE station = 'O''ST::1'")
+        self.assertRaises(ValueError, vmo.connect, "oracle")
+
+
+if __name__ == "__main__":
+    unittest.main()
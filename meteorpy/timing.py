@@ -0,0 +1,147 @@
+'''
+Lightweight timing of the stages behind a flux page.
+
+Every stage (query, conversion, binning, plotting, ...) is wrapped in a Span:
+
+    with timing.Span("vmo.copy") as span:
+        result = ...
+        span.rows = len(result)
+
+Finished spans are handed to the active recorders of their thread and to
+every sink:
+
+    with timing.record() as spans:
+        page.printHTML(...)
+    print timing.summary(spans)
+
+    timing.sinks.append(lambda span: statsd.timing(span.name, span.duration*1000))
+
+Recorders are per thread, so that concurrent requests in a threaded server
+do not record each other. Threads working for a request are run through
+wrap(), and spans of child processes are sent back and passed to merge().
+
+When nothing is recording and no sink is installed, a span only costs two
+calls of time.time().
+'''
+import time
+import threading
+
+# Lists collecting the spans of the current thread, see record()
+_local = threading.local()
+
+def _recorders():
+    if not hasattr(_local, "recorders"):
+        _local.recorders = []
+    return _local.recorders
+
+# Functions called with every finished span, e.g. to export it to a metrics system
+sinks = []
+
+
+class Span(object):
+    '''
+    Duration of a stage in seconds, with optional row count and size in bytes
+    '''
+    __slots__ = ["name", "start", "duration", "rows", "bytes"]
+
+    def __init__(self, name, rows=None, bytes=None):
+        self.name = name
+        self.start = None
+        self.duration = None
+        self.rows = rows
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self.start
+        if len(getattr(_local, "recorders", ())) > 0 or len(sinks) > 0:
+            _finish(self)
+        return False
+
+    def __repr__(self):
+        return "<Span %s %.4f s rows=%s bytes=%s>" % (self.name, self.duration or 0, self.rows, self.bytes)
+
+
+def _finish(span):
+    for spans in _recorders():
+        spans.append(span)
+    for sink in list(sinks):
+        try:
+            sink(span)
+        except Exception:
+            pass # Metrics must never break a request
+
+
+class record(object):
+    '''
+    Collect the spans finished by this thread (and the threads started
+    through wrap()) while the block runs: with record() as spans: ...
+    '''
+
+    def __enter__(self):
+        self._spans = []
+        _recorders().append(self._spans)
+        return self._spans
+
+    def __exit__(self, *exc_info):
+        _recorders().remove(self._spans)
+        return False
+
+
+def wrap(function):
+    """ Function calling function with the recorders of the current thread, to run it in another thread """
+    recorders = list(_recorders())
+    def wrapped(*args, **keywords):
+        previous = _recorders()
+        _local.recorders = previous + recorders
+        try:
+            return function(*args, **keywords)
+        finally:
+            _local.recorders = previous
+    return wrapped
+
+
+def merge(spans):
+    """ Hand spans finished elsewhere, e.g. in a child process, to the recorders of the current thread """
+    for recorded in _recorders():
+        recorded.extend(spans)
+
+
+def totals(spans):
+    """ List of (name, count, seconds, rows, bytes) per span name, in order of first appearance """
+    result = {}
+    order = []
+    for span in spans:
+        if span.name not in result:
+            result[span.name] = [span.name, 0, 0.0, None, None]
+            order.append(span.name)
+        t = result[span.name]
+        t[1] += 1
+        t[2] += span.duration
+        if span.rows != None:
+            t[3] = (t[3] or 0) + span.rows
+        if span.bytes != None:
+            t[4] = (t[4] or 0) + span.bytes
+    return [tuple(result[name]) for name in order]
+
+
+def summary(spans):
+    """ Plain-text table of totals(spans) """
+    lines = ["%-24s %5s %9s %10s %12s" % ("stage", "calls", "seconds", "rows", "bytes")]
+    for name, count, seconds, rows, size in totals(spans):
+        lines.append("%-24s %5d %9.3f %10s %12s" % (name, count, seconds, \
+                     "" if rows == None else rows, "" if size == None else size))
+    return "\n".join(lines)
+
+
+def html(spans):
+    """ HTML table of totals(spans), used as trailer of the flux page """
+    rows = ["\t<tr><td>%s</td><td>%d</td><td>%.3f</td><td>%s</td><td>%s</td></tr>\n" \
+            % (name, count, seconds, "" if rows == None else rows, "" if size == None else size) \
+            for name, count, seconds, rows, size in totals(spans)]
+    return "".join(["<div id='timing'>\n<table>\n", \
+                    "\t<thead><th>Stage</th><th>Calls</th><th>Time<br/>[s]</th><th>Rows</th><th>Bytes</th></thead>\n"] \
+                   + rows + ["</table>\n</div>"])
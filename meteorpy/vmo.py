@@ -1,56 +1,790 @@
 '''
-Connect to the PostgreSQL VMO database
+Connect to the PostgreSQL VMO database, or to a local snapshot of it
+
+The backend is chosen by [DB] backend in config/vmo.ini:
+    backend = postgresql -- the VMO server (default)
+    backend = sqlite     -- metrecflux/metrecflux_meta snapshots in [DB] path, see LocalVMO
 '''
 import numpy as np
 import os
+import re
+import csv
+import math
+import time
+import struct
+import hashlib
+import tempfile
+import datetime
+import decimal
+import threading
+import contextlib
+import sqlite3
 import pg   # Provided by Debian package "python-pygresql"
 import ConfigParser
 
+import timing
+
+
+""" Configuration of the database connection """
+_config = None
+def config():
+    """ Read config/vmo.ini once per process """
+    global _config
+    if _config == None:
+        c = ConfigParser.ConfigParser()
+        c.read(os.path.dirname(__file__)+"/config/vmo.ini")
+        _config = c
+    return _config
+
+
+def _option(name, default):
+    """ Optional setting in the [DB] section of vmo.ini """
+    if config().has_option("DB", name):
+        return type(default)(config().get("DB", name))
+    return default
+
+
+# Default number of rows per chunk when streaming query results
+CHUNKSIZE = 50000
+
+# Errors of all backends
+Error = (pg.Error, sqlite3.Error)
+
+
+class Connection(object):
+    '''
+    Interface of a connection to one of the backends
+    '''
+    
+    lastused = 0
+    
+    def connect(self):
+        """ (Re)open the connection """
+        raise NotImplementedError
+    
+    def close(self):
+        raise NotImplementedError
+    
+    def ping(self):
+        """ Is the connection still alive? """
+        raise NotImplementedError
+    
+    def sql2recarray(self, sql, columns=None):
+        """ 
+        Result of a query as a structured array (see rows2recarray), or None
+        @columns: optional list of (name, type) tuples which give the dtypes
+        """
+        raise NotImplementedError
+    
+    def copy2recarray(self, sql, columns):
+        """ Same as sql2recarray, with the dtypes given by columns (see _BINARY_TYPES) """
+        raise NotImplementedError
+    
+    def sql2chunks(self, sql, chunksize=CHUNKSIZE):
+        """ Generator yielding the result of a query in structured arrays of at most chunksize rows """
+        raise NotImplementedError
+
+
+def identity():
+    """ The database of the configured backend, e.g. to keep caches of different databases apart """
+    backend = _option("backend", "postgresql")
+    if backend == "sqlite":
+        return "sqlite:%s" % os.path.abspath(_option("path", ""))
+    return "%s:%s:%s/%s" % (backend, _option("host", ""), _option("port", ""), _option("name", ""))
+
 
-class VMO(object):
+def connect(backend=None):
+    """ New connection to the backend, default = [DB] backend in vmo.ini """
+    backend = backend or _option("backend", "postgresql")
+    if backend == "postgresql":
+        return VMO()
+    if backend == "sqlite":
+        return LocalVMO()
+    raise ValueError("Unknown database backend: %s" % backend)
+
+
+class VMO(Connection):
     '''
-    classdocs
+    A single connection to the VMO database
     '''
 
     db = None
+    lastused = 0
 
-    def __init__(self):
+    def __init__(self, connect=True):
         '''
         Constructor
+        @connect: open the connection immediately (otherwise on first use)
         '''
-        config = ConfigParser.ConfigParser()
-        config.read(os.path.dirname(__file__)+"/config/vmo.ini")
-        self.db = pg.connect(host=config.get("DB", "host"), port=int(config.get("DB", "port")), \
-                             dbname=config.get("DB", "name"), \
-                             user=config.get("DB", "user"), passwd=config.get("DB", "pass"))
+        if connect:
+            self.connect()
         
-     
+    
+    def connect(self):
+        """ (Re)open the connection using the settings in config/vmo.ini """
+        self.close()
+        c = config()
+        self.db = pg.connect(host=c.get("DB", "host"), port=int(c.get("DB", "port")), \
+                             dbname=c.get("DB", "name"), \
+                             user=c.get("DB", "user"), passwd=c.get("DB", "pass"))
+        self.lastused = time.time()
+    
+    def close(self):
+        if self.db != None:
+            try:
+                self.db.close()
+            except pg.Error:
+                pass # Connection was already broken
+            self.db = None
+    
+    def ping(self):
+        """ Is the connection still alive? """
+        if self.db == None:
+            return False
+        try:
+            self.db.query("SELECT 1")
+        except pg.Error:
+            return False
+        self.lastused = time.time()
+        return True
+    
+    def query(self, sql):
+        """ Run a query, reconnecting once if the connection turns out to be lost """
+        if self.db == None:
+            self.connect()
+        with timing.Span("vmo.query"):
+            try:
+                q = self.db.query(sql)
+            except pg.Error:
+                if self.ping():
+                    raise # The connection is fine, the query is not
+                self.connect()
+                q = self.db.query(sql)
+        self.lastused = time.time()
+        return q
        
-    def sql2recarray(self, sql):
+    def sql2recarray(self, sql, columns=None):
+        q = self.query(sql)
+        with timing.Span("vmo.convert") as span:
+            rows = q.getresult()
+            span.rows = len(rows)
+            return rows2recarray(rows, q.listfields(), columns)
+    
+    def supports_binary_copy(self):
+        """ Can the driver fetch raw COPY data? (source objects with getdata, PyGreSQL >= 5) """
         if self.db == None:
             self.connect()
+        if not hasattr(self.db, "source"):
+            return False
+        return hasattr(self.db.source(), "getdata")
+    
+    def copy2recarray(self, sql, columns):
+        """
+        Run COPY (sql) TO STDOUT WITH BINARY and decode the binary tuples
+        straight into a structured numpy array, avoiding the formatting and
+        parsing of every value as text. Falls back to sql2recarray if the
+        driver does not support it.
         
-        q = self.db.query(sql)
-        results = q.getresult()
-        if len(results) == 0:
-            return None
-        # What is the data type of each row?
-        formats = []
-        for col in results[0]:
-            t = str(np.dtype(col.__class__))
-            if t == "|S0":
-                # Due to a stupid bug in numpy, we need to set a fixed length for a string
-                t = "|S9999"
-            formats.append( t )
-        dt = np.dtype({'names':q.listfields(), 'formats':formats})
-        r = np.array(results, dt)
-        return r
+        @columns: list of (name, type) tuples describing the query result,
+                  e.g. [('time', 'timestamp'), ('eca', 'float8')]
+        """
+        if not self.supports_binary_copy():
+            return self.sql2recarray(sql, columns)
+        integer_datetimes = True
+        if hasattr(self.db, "parameter"):
+            integer_datetimes = self.db.parameter("integer_datetimes") != "off"
+        
+        # Make sure the connection is alive, as retrying halfway a COPY is impossible
+        if time.time()-self.lastused > 1 and not self.ping():
+            self.connect()
+        with timing.Span("vmo.copy") as span:
+            src = self.db.source()
+            src.execute("COPY (%s) TO STDOUT WITH BINARY" % sql)
+            # A single buffer, growing in place, which is decoded without copies
+            data = bytearray()
+            while True:
+                row = src.getdata(False)
+                if isinstance(row, (int, long)):
+                    break
+                data.extend(row)
+            span.bytes = len(data)
+        self.lastused = time.time()
+        with timing.Span("vmo.decode") as span:
+            result = decode_binary_copy(data, columns, integer_datetimes)
+            span.rows = 0 if result is None else len(result)
+        return result
+    
+    def sql2chunks(self, sql, chunksize=CHUNKSIZE):
+        """ 
+        Generator yielding the result of a query as structured arrays of at 
+        most chunksize rows, fetched from a server-side cursor. Unlike 
+        sql2recarray, the complete result never needs to fit in memory.
+        """
+        self.query("BEGIN")
+        try:
+            self.db.query("DECLARE vmo_chunks NO SCROLL CURSOR FOR %s" % sql)
+            while True:
+                with timing.Span("vmo.fetch") as span:
+                    q = self.db.query("FETCH FORWARD %d FROM vmo_chunks" % chunksize)
+                    rows = q.getresult()
+                    span.rows = len(rows)
+                    chunk = rows2recarray(rows, q.listfields())
+                if chunk == None:
+                    break
+                yield chunk
+        finally:
+            # Read-only transaction: rolling back also closes the cursor
+            self.db.query("ROLLBACK")
  
 
-""" Allow single-line queries """
+class Pool(object):
+    '''
+    Thread-safe pool of warm VMO connections.
+    
+    Connections are opened lazily up to the size of the pool, and are checked
+    with a ping before being handed out if they have been idle for longer
+    than check_interval seconds. Broken connections are reopened.
+    '''
+    
+    def __init__(self, size=None, timeout=None, check_interval=None, backend=None):
+        '''
+        @size: maximum number of connections, default = pool_size in vmo.ini or 4
+        @timeout: seconds to wait for a free connection, default = wait forever
+        @check_interval: idle seconds after which a connection is pinged, default = 30
+        @backend: see connect()
+        '''
+        self._backend = backend
+        self._size = size if size != None else _option("pool_size", 4)
+        self._timeout = timeout
+        self._check_interval = check_interval if check_interval != None else _option("pool_check_interval", 30.0)
+        self._lock = threading.Condition()
+        self._idle = []
+        self._count = 0
+        self._pid = os.getpid()
+    
+    
+    def acquire(self):
+        """ Take a connection from the pool, opening a new one if allowed """
+        deadline = None if self._timeout == None else time.time()+self._timeout
+        self._lock.acquire()
+        try:
+            # Connections must never be shared with a forked child process
+            if os.getpid() != self._pid:
+                self._idle, self._count, self._pid = [], 0, os.getpid()
+            while len(self._idle) == 0 and self._count >= self._size:
+                if deadline != None and time.time() >= deadline:
+                    raise Exception("Timed out waiting for a database connection.")
+                self._lock.wait(None if deadline == None else deadline-time.time())
+            if len(self._idle) > 0:
+                conn = self._idle.pop()
+            else:
+                conn = None
+                self._count += 1
+        finally:
+            self._lock.release()
+        
+        try:
+            if conn == None:
+                conn = connect(self._backend)
+            elif time.time()-conn.lastused > self._check_interval and not conn.ping():
+                conn.connect()
+        except:
+            self._discard()
+            raise
+        return conn
+    
+    def release(self, conn):
+        """ Return a connection to the pool """
+        self._lock.acquire()
+        try:
+            if os.getpid() == self._pid:
+                self._idle.append(conn)
+                self._lock.notify()
+        finally:
+            self._lock.release()
+    
+    def _discard(self):
+        """ Forget about a connection which could not be (re)opened """
+        self._lock.acquire()
+        try:
+            self._count -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+    
+    @contextlib.contextmanager
+    def connection(self):
+        """ Usage: with pool.connection() as conn: conn.sql2recarray(...) """
+        conn = self.acquire()
+        try:
+            yield conn
+        except Error:
+            # Leave the connection in a usable state for the next user
+            if not conn.ping():
+                conn.close()
+            raise
+        finally:
+            self.release(conn)
+    
+    def sql2recarray(self, sql, columns=None):
+        with self.connection() as conn:
+            return conn.sql2recarray(sql, columns)
+    
+    def copy2recarray(self, sql, columns):
+        with self.connection() as conn:
+            return conn.copy2recarray(sql, columns)
+    
+    def sql2chunks(self, sql, chunksize=CHUNKSIZE):
+        with self.connection() as conn:
+            for chunk in conn.sql2chunks(sql, chunksize):
+                yield chunk
+    
+    def close(self):
+        """ Close all idle connections """
+        self._lock.acquire()
+        try:
+            for conn in self._idle:
+                conn.close()
+            self._count -= len(self._idle)
+            self._idle = []
+        finally:
+            self._lock.release()
+
+
+class LocalVMO(Connection):
+    '''
+    Connection to a local snapshot of the VMO database, in SQLite
+    
+    The snapshot is either an SQLite database file, or a directory with the 
+    tables metrecflux and metrecflux_meta as structured arrays (<table>.npy, 
+    e.g. from benchmarks/synthetic.py) or CSV files with a header line 
+    (<table>.csv, e.g. from \\copy metrecflux TO 'metrecflux.csv' CSV HEADER), 
+    which are loaded once into an SQLite database file shared by all 
+    connections (see _snapshot); changes made through them are kept there 
+    until the files of the snapshot change. 
+    
+    Queries are translated from PostgreSQL (see translate), so that the 
+    queries of FluxData, FluxGraph and the sweeps run unchanged. Timestamps 
+    are stored as ISO strings. As with PyGreSQL, statements are committed 
+    unless they are enclosed in BEGIN and COMMIT.
+    '''
+    
+    db = None
+    
+    def __init__(self, path=None, connect=True):
+        '''
+        @path: snapshot file or directory, default = [DB] path in vmo.ini
+        '''
+        self._path = path or _option("path", "")
+        if connect:
+            self.connect()
+    
+    def connect(self):
+        self.close()
+        if os.path.isdir(self._path):
+            self.db = sqlite3.connect(_snapshot(self._path), check_same_thread=False, isolation_level=None)
+        elif os.path.isfile(self._path):
+            self.db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        else:
+            raise Exception("No database snapshot at '%s'." % self._path)
+        for name, nargs, function in _FUNCTIONS:
+            self.db.create_function(name, nargs, function)
+        self.lastused = time.time()
+    
+    def close(self):
+        if self.db != None:
+            self.db.close()
+            self.db = None
+    
+    def ping(self):
+        return self.db != None
+    
+    def query(self, sql):
+        if self.db == None:
+            self.connect()
+        with timing.Span("vmo.query"):
+            cursor = self.db.execute(translate(sql))
+        self.lastused = time.time()
+        return cursor
+    
+    def sql2recarray(self, sql, columns=None):
+        cursor = self.query(sql)
+        with timing.Span("vmo.convert") as span:
+            rows = cursor.fetchall()
+            span.rows = len(rows)
+            return rows2recarray(rows, [d[0] for d in cursor.description], columns)
+    
+    def copy2recarray(self, sql, columns):
+        return self.sql2recarray(sql, columns)
+    
+    def sql2chunks(self, sql, chunksize=CHUNKSIZE):
+        cursor = self.query(sql)
+        names = [d[0] for d in cursor.description]
+        while True:
+            with timing.Span("vmo.fetch") as span:
+                rows = cursor.fetchmany(chunksize)
+                span.rows = len(rows)
+                chunk = rows2recarray(rows, names)
+            if chunk is None:
+                break
+            yield chunk
+
+
+def _power(x, y):
+    if x == None or y == None:
+        return None
+    try:
+        return math.pow(x, y)
+    except ValueError:
+        return None
+
+def _math(function):
+    return lambda x: None if x == None else function(x)
+
+# Functions of PostgreSQL used in the queries
+_FUNCTIONS = [("sin", 1, _math(math.sin)), ("radians", 1, _math(math.radians)), \
+              ("floor", 1, _math(math.floor)), ("power", 2, _power)]
+
+# Tables of a snapshot, with the columns which are created if a table is missing
+_TABLES = [("metrecflux", ["time", "station", "shower", "teff", "eca", "alt", "met", "filename"]), \
+           ("metrecflux_meta", ["filename", "observer_firstname", "observer_lastname", "site_country"])]
+
+_snapshots_lock = threading.Lock()
+
+
+def _snapshot(directory):
+    """
+    SQLite database file with the tables of a snapshot directory. It is built
+    once for every version of the files, in the directory itself or else in
+    the temporary directory, and then shared by all connections and processes.
+    """
+    files = [os.path.join(directory, table + ext) for table, default in _TABLES for ext in (".npy", ".csv")]
+    version = [(f, os.stat(f).st_mtime, os.stat(f).st_size) for f in files if os.path.exists(f)]
+    name = "snapshot_%s.sqlite" % hashlib.sha1(repr((os.path.abspath(directory), version))).hexdigest()[:16]
+    with _snapshots_lock:
+        for parent in (directory, os.path.join(tempfile.gettempdir(), "meteorpy_snapshots")):
+            path = os.path.join(parent, name)
+            if os.path.exists(path):
+                return path
+            try:
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=parent)
+            except OSError:
+                continue # Read-only
+            os.close(fd)
+            try:
+                db = sqlite3.connect(tmp)
+                try:
+                    for table, columns, rows in _tables(directory):
+                        db.execute("CREATE TABLE %s (%s)" % (table, ", ".join("%s %s" % c for c in columns)))
+                        db.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?"*len(columns))), rows)
+                        if table == "metrecflux":
+                            db.execute("CREATE INDEX metrecflux_shower_time ON metrecflux (shower, time)")
+                    db.commit()
+                finally:
+                    db.close()
+                os.rename(tmp, path)
+            except:
+                os.remove(tmp)
+                raise
+            return path
+    raise Exception("No writable directory for the database of snapshot '%s'." % directory)
+
+
+def _tables(directory):
+    """ List of (table, [(column, type)], rows) for the files in a snapshot directory """
+    tables = []
+    for table, default in _TABLES:
+        filename = os.path.join(directory, table)
+        if os.path.exists(filename + ".npy"):
+            columns, rows = _npy2rows(np.load(filename + ".npy"))
+        elif os.path.exists(filename + ".csv"):
+            with open(filename + ".csv", "rb") as f:
+                columns, rows = _csv2rows(f)
+        else:
+            columns, rows = [], []
+        # Columns which are used by the queries but not in the snapshot are NULL
+        missing = [name for name in default if name not in [c for c, t in columns]]
+        columns += [(name, "") for name in missing]
+        rows = [row + (None,)*len(missing) for row in rows] if missing else rows
+        tables.append( (table, columns, rows) )
+    return tables
+
+
+def _npy2rows(data):
+    """ Columns and rows of a structured array, with timestamps as ISO strings """
+    columns, values = [], []
+    for name in data.dtype.names:
+        column = data[name]
+        if column.dtype.kind == "M":
+            values.append([str(v).replace("T", " ") for v in column.astype("datetime64[s]")])
+            columns.append( (name, "TEXT") )
+        else:
+            values.append(column.tolist())
+            columns.append( (name, {"b": "INTEGER", "i": "INTEGER", "u": "INTEGER", "f": "REAL"}.get(column.dtype.kind, "TEXT")) )
+    return columns, zip(*values)
+
+
+def _csv2rows(f):
+    """ Columns and rows of a CSV file with header, numbers are converted """
+    def value(v):
+        if v == "":
+            return None
+        for kind in (int, float):
+            try:
+                return kind(v)
+            except ValueError:
+                pass
+        return v.decode("utf-8")
+    reader = csv.reader(f)
+    header = reader.next()
+    return [(name, "") for name in header], [tuple(value(v) for v in row) for row in reader]
+
+
+# PostgreSQL casts: 'literal'::type, (expression)::float8, ...
+_re_cast = re.compile(r"::\w+")
+# Quoted string literals, and the names which stand in for them during the translation
+_re_literal = re.compile(r"'(?:[^']|'')*'")
+_re_placeholder = re.compile(r"__literal(\d+)__")
+_re_exponent = re.compile(r"^\s*(-?[0-9.]+|[a-z_][a-z0-9_.]*)", re.IGNORECASE)
+
+def translate(sql):
+    """
+    Translate the PostgreSQL syntax used by the queries of this package to SQLite:
+    casts are dropped and a^b becomes power(a, b), outside of string literals
+    
+    >>> translate("SELECT (sin(radians(alt))^2.0000000)::float8 AS x")
+    'SELECT (power(sin(radians(alt)), 2.0000000)) AS x'
+    """
+    literals = _re_literal.findall(sql)
+    sql = _re_literal.sub(lambda m: "__literal%d__" % literals.index(m.group(0)), sql)
+    sql = _translate(sql)
+    return _re_placeholder.sub(lambda m: literals[int(m.group(1))], sql)
+
+def _translate(sql):
+    sql = _re_cast.sub("", sql)
+    while "^" in sql:
+        k = sql.index("^")
+        right = _re_exponent.match(sql[k+1:])
+        if right == None:
+            raise ValueError("Unsupported exponent in query: %s" % sql[k:k+40])
+        # The operand to the left: a name, a number or a (function call in) parentheses
+        i = k
+        while i > 0 and sql[i-1].isspace():
+            i -= 1
+        end = i
+        if sql[i-1] == ")":
+            depth = 0
+            while True:
+                i -= 1
+                depth += {")": 1, "(": -1}.get(sql[i], 0)
+                if depth == 0:
+                    break
+        while i > 0 and (sql[i-1].isalnum() or sql[i-1] in "_."):
+            i -= 1
+        sql = "%spower(%s, %s)%s" % (sql[:i], sql[i:end], right.group(1), sql[k+1+right.end():])
+    return sql
+
+
+""" Conversion of query results into numpy arrays """
+
+# Timestamps as returned by PostgreSQL in ISO DateStyle
+_re_timestamp = re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}$")
+
+
+def column2array(values, pgtype=None):
+    """
+    Convert a column of Python values, as returned by the database driver, 
+    into a numpy array with a suitable dtype:
+    timestamps become datetime64[s], integers int64, other numbers float64
+    and strings get the width of the longest value in the column.
+    NULL values become NaN, NaT or empty strings.
+    
+    @pgtype: declared type of the column; the types in _BINARY_TYPES get the
+             same dtype as in decode_binary_copy, e.g. float4 gives float32
+    """
+    if pgtype in _BINARY_TYPES:
+        dtype = np.dtype(_BINARY_TYPES[pgtype][1])
+        nulls = any(v is None for v in values)
+        if dtype.kind == "M":
+            return np.array(["NaT" if v is None else v for v in values], dtype=dtype)
+        if dtype.kind in "biu" and not nulls:
+            return np.array(values, dtype=dtype)
+        if dtype.kind == "f":
+            return np.array([np.nan if v is None else float(v) for v in values], dtype=dtype)
+        # NULL values in integer columns: float64, as in decode_binary_copy
+    
+    present = [v for v in values if v is not None]
+    if len(present) == 0:
+        return np.array([np.nan]*len(values))
+    kinds = set(v.__class__ for v in present)
+    
+    if kinds <= set([bool]):
+        return np.array(values, dtype=bool)
+    if kinds <= set([int, long]) and len(present) == len(values):
+        return np.array(values, dtype=np.int64)
+    if kinds <= set([int, long, float, decimal.Decimal]):
+        return np.array([np.nan if v is None else float(v) for v in values], dtype=np.float64)
+    if kinds <= set([datetime.datetime]):
+        return np.array(values, dtype="datetime64[s]")
+    if kinds <= set([str]):
+        if all(_re_timestamp.match(v) for v in present):
+            return np.array(["NaT" if v is None else v for v in values], dtype="datetime64[s]")
+        width = max(1, max(len(v) for v in present))
+        return np.array(["" if v is None else v for v in values], dtype="S%d" % width)
+    if kinds <= set([str, unicode]):
+        width = max(1, max(len(v) for v in present))
+        return np.array([u"" if v is None else v for v in values], dtype="U%d" % width)
+    return np.array(values, dtype=object)
+
+
+def rows2recarray(rows, names, columns=None):
+    """
+    Convert a list of result tuples into a structured numpy array with one 
+    field per column (see column2array), or None if there are no rows.
+    @columns: optional list of (name, type) tuples with the declared types
+    """
+    if len(rows) == 0:
+        return None
+    pgtypes = [pgtype for name, pgtype in columns] if columns != None else [None]*len(names)
+    arrays = [column2array(col, pgtype) for col, pgtype in zip(zip(*rows), pgtypes)]
+    result = np.empty(len(rows), dtype=[(name, col.dtype) for name, col in zip(names, arrays)])
+    for name, col in zip(names, arrays):
+        result[name] = col
+    return result
+
+
+""" Decoding of the PostgreSQL binary COPY format """
+
+_BINARY_SIGNATURE = "PGCOPY\n\377\r\n\0"
+
+# Fixed-size types: (big-endian dtype of the value on the wire, dtype of the result)
+_BINARY_TYPES = {"timestamp": (">i8", "datetime64[s]"), \
+                 "timestamptz": (">i8", "datetime64[s]"), \
+                 "date": (">i4", "datetime64[D]"), \
+                 "float8": (">f8", np.float64), \
+                 "float4": (">f4", np.float32), \
+                 "int8": (">i8", np.int64), \
+                 "int4": (">i4", np.int32), \
+                 "int2": (">i2", np.int16), \
+                 "bool": ("?", bool)}
+
+# PostgreSQL counts timestamps from 2000-01-01, numpy from 1970-01-01
+_PG_EPOCH_SECONDS = 946684800
+_PG_EPOCH_DAYS = 10957
+
+
+def decode_binary_copy(data, columns, integer_datetimes=True):
+    """
+    Decode the output of COPY ... TO STDOUT WITH BINARY into a structured 
+    numpy array, or None if there are no rows.
+    
+    Rows without NULL values and fixed-size types only, which is the case for
+    the flux aggregates, are decoded in one go with a big-endian record dtype. 
+    Otherwise every tuple is parsed on its own.
+    
+    @data: byte string or bytearray holding the complete COPY output
+    @columns: list of (name, type) tuples, see _BINARY_TYPES; 
+              other types are returned as strings
+    """
+    if data[:len(_BINARY_SIGNATURE)] != _BINARY_SIGNATURE:
+        raise ValueError("Not a binary COPY stream.")
+    extension = struct.unpack_from(">i", data, len(_BINARY_SIGNATURE)+4)[0]
+    # The tuples are data[start:stop], which is never copied
+    start = len(_BINARY_SIGNATURE)+8+extension
+    stop = len(data)
+    # Strip the file trailer
+    if stop-start >= 2 and data[stop-2:stop] == "\377\377":
+        stop -= 2
+    if stop <= start:
+        return None
+    
+    names = [name for name, pgtype in columns]
+    wire = None
+    if all(pgtype in _BINARY_TYPES for name, pgtype in columns):
+        wire = [("nfields", ">i2")]
+        for k, (name, pgtype) in enumerate(columns):
+            wire += [("length%d" % k, ">i4"), (name, _BINARY_TYPES[pgtype][0])]
+        wire = np.dtype(wire)
+    
+    if wire != None and (stop-start) % wire.itemsize == 0:
+        raw = np.frombuffer(data, dtype=wire, count=(stop-start)//wire.itemsize, offset=start)
+        fast = np.all(raw["nfields"] == len(columns))
+        for k in range(len(columns)):
+            fast = fast and np.all(raw["length%d" % k] == wire[2*k+2].itemsize)
+        if fast:
+            result = np.empty(len(raw), dtype=[(name, _BINARY_TYPES[pgtype][1]) for name, pgtype in columns])
+            for name, pgtype in columns:
+                result[name] = _binary_column(raw[name], pgtype, integer_datetimes)
+            return result
+    
+    # Slow path: tuples with NULL values or variable-size fields
+    values = [[] for c in columns]
+    offset = start
+    while offset < stop:
+        offset += 2
+        for k in range(len(columns)):
+            length = struct.unpack_from(">i", data, offset)[0]
+            offset += 4
+            if length < 0:
+                values[k].append(None)
+            else:
+                values[k].append(str(data[offset:offset+length]))
+                offset += length
+    
+    arrays = []
+    for (name, pgtype), col in zip(columns, values):
+        if pgtype not in _BINARY_TYPES:
+            arrays.append(column2array(col))
+            continue
+        present = np.array([v != None for v in col])
+        raw = np.frombuffer("".join(v for v in col if v != None), dtype=_BINARY_TYPES[pgtype][0])
+        decoded = _binary_column(raw, pgtype, integer_datetimes)
+        if present.all():
+            arrays.append(decoded)
+            continue
+        if decoded.dtype.kind in "biu":
+            decoded = decoded.astype(np.float64)
+        result = np.zeros(len(col), dtype=decoded.dtype)
+        result[~present] = np.nan if result.dtype.kind == "f" else np.datetime64("NaT")
+        result[present] = decoded
+        arrays.append(result)
+    result = np.empty(len(values[0]), dtype=[(name, a.dtype) for name, a in zip(names, arrays)])
+    for name, a in zip(names, arrays):
+        result[name] = a
+    return result
+
+
+def _binary_column(raw, pgtype, integer_datetimes):
+    """ Convert big-endian wire values into native numpy values """
+    if pgtype in ("timestamp", "timestamptz"):
+        if not integer_datetimes:
+            # Old servers send timestamps as float8 seconds
+            seconds = np.floor(raw.view(">f8")).astype(np.int64)
+        else:
+            seconds = raw.astype(np.int64) // 1000000
+        return (seconds + _PG_EPOCH_SECONDS).astype("datetime64[s]")
+    if pgtype == "date":
+        return (raw.astype(np.int64) + _PG_EPOCH_DAYS).astype("datetime64[D]")
+    return raw.astype(_BINARY_TYPES[pgtype][1])
+
+
+""" Allow single-line queries, using a pool of connections shared by the whole process """
 default = None
+_default_lock = threading.Lock()
+def pool():
+    global default
+    with _default_lock:
+        if default == None:
+            default = Pool()
+    return default
+
 def sql(sql):
-    if default == None:
-        vmo = VMO()
-    return vmo.sql2recarray(sql)
+    return pool().sql2recarray(sql)
+
+def copy(sql, columns):
+    return pool().copy2recarray(sql, columns)
 
+def chunks(sql, chunksize=CHUNKSIZE):
+    return pool().sql2chunks(sql, chunksize)